@@ -0,0 +1,543 @@
+# this is the file for benchmarking the API endpoints locally
+# the app is booted against a throwaway SQLite database (aiosqlite) instead of RDS, the database is
+# seeded with synthetic data shaped like Newest_db_dump.sql, and then every route in main.py is driven
+# with concurrent requests (httpx over the ASGI transport, so no server or network is involved).
+# Throughput and p50/p95/p99 latency per endpoint are written out as JSON so runs can be compared.
+# Run with: python -m <package>.bench_endpoints --users 20 --requests 200 --concurrency 16 --output bench.json
+# needs aiosqlite and httpx (see requirements.txt)
+import argparse
+import asyncio
+import contextlib
+import json
+import logging
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from dataclasses import dataclass, field
+from datetime import date, datetime, timedelta
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+DEFAULT_MEDICATIONS = 50
+DEFAULT_USERS = 20
+DEFAULT_PRESCRIPTIONS = 10           # per user
+DEFAULT_DETAILS = 3                  # medications per prescription
+DEFAULT_NOTIFICATIONS = 20           # per user
+DEFAULT_SIDE_EFFECTS = 20            # per user
+DEFAULT_REQUESTS = 200               # per endpoint
+DEFAULT_CONCURRENCY = 16
+BATCH_SIZE = 10                      # rows sent to the /batch endpoints per request
+BENCH_PASSWORD = "benchpassword1"
+BENCH_SECRET_KEY = "bench-secret-key-not-for-production"
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark every API endpoint against a local SQLite database")
+    parser.add_argument("--medications", type=int, default=DEFAULT_MEDICATIONS)
+    parser.add_argument("--users", type=int, default=DEFAULT_USERS)
+    parser.add_argument("--prescriptions", type=int, default=DEFAULT_PRESCRIPTIONS, help="prescriptions per user")
+    parser.add_argument("--details", type=int, default=DEFAULT_DETAILS, help="medications per prescription")
+    parser.add_argument("--notifications", type=int, default=DEFAULT_NOTIFICATIONS, help="notifications per user")
+    parser.add_argument("--side-effects", type=int, default=DEFAULT_SIDE_EFFECTS, help="side effects per user")
+    parser.add_argument("--requests", type=int, default=DEFAULT_REQUESTS, help="requests per endpoint")
+    parser.add_argument("--concurrency", type=int, default=DEFAULT_CONCURRENCY)
+    parser.add_argument("--only", action="append", help="only run endpoints containing this text (repeatable)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--db", help="SQLite file to use (default: a temp file that is removed afterwards)")
+    parser.add_argument("--read-db", help="second SQLite file used as the read replica (DATABASE_READ_URL) -- a copy of --db "
+                                          "taken after seeding, writes made during the run never reach it")
+    parser.add_argument("--track-queries", action="store_true",
+                        help="count statements per request and add the worst routes / N+1 queries to the report (query_tracker.py)")
+    parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    args = parser.parse_args(argv)
+    args.details = min(args.details, args.medications)
+    return args
+
+
+@dataclass
+class BenchUser:
+    user_id: str
+    headers: Dict[str, str]
+    prescription_ids: List[int] = field(default_factory=list)
+    medication_ids: Dict[int, List[int]] = field(default_factory=dict)  # prescription_id -> medication ids
+    notification_ids: List[int] = field(default_factory=list)
+    side_effect_ids: List[int] = field(default_factory=list)
+
+
+# Everything a scenario needs: the seeded users and the spare rows set aside for the delete/create scenarios
+@dataclass
+class BenchContext:
+    args: Any
+    rng: random.Random
+    medication_ids: List[int]
+    users: List[BenchUser]
+    seeder: Any = None
+    spares: Dict[str, list] = field(default_factory=dict)
+
+    def user(self, i: int) -> BenchUser:
+        return self.users[i % len(self.users)]
+
+    def pick(self, i: int, values: list):
+        return values[(i // len(self.users)) % len(values)]
+
+
+# One endpoint to benchmark
+# call sends request number i, setup (optional) creates the rows the calls will consume
+@dataclass
+class Scenario:
+    method: str
+    path: str
+    call: Callable[[Any, BenchContext, int], Awaitable[Any]]
+    expected: tuple = (200,)
+    setup: Optional[Callable[[BenchContext, int], Awaitable[None]]] = None
+
+    @property
+    def name(self) -> str:
+        return f"{self.method} {self.path}"
+
+
+class Seeder:
+    """
+    Fills the database with synthetic rows shaped like the tables in Newest_db_dump.sql.
+    Ids are assigned here (not by autoincrement) so the scenarios know which rows belong to whom.
+    """
+
+    def __init__(self, session_factory, rng: random.Random, password_hash: str):
+        self.session_factory = session_factory
+        self.rng = rng
+        self.password_hash = password_hash
+        self.next_ids = {"prescription": 1, "notification": 1, "side_effect": 1}
+        self.user_count = 0
+
+    def _ids(self, table: str, count: int) -> List[int]:
+        start = self.next_ids[table]
+        self.next_ids[table] = start + count
+        return list(range(start, start + count))
+
+    async def _insert(self, model, rows: List[dict]):
+        from sqlalchemy import insert
+        if not rows:
+            return
+        async with self.session_factory() as session:
+            await session.execute(insert(model), rows)
+            await session.commit()
+
+    async def medications(self, count: int) -> List[int]:
+        from .models import Medication
+        rows = [
+            {"medication_id": i, "medication_name": f"med {i}", "medication_use": f"med {i} use for help"}
+            for i in range(1, count + 1)
+        ]
+        await self._insert(Medication, rows)
+        return [row["medication_id"] for row in rows]
+
+    async def users(self, count: int, prefix: str = "bench_user") -> List[BenchUser]:
+        from .models import User
+        from .tokens import create_access_token, ACCESS_TOKEN_EXPIRE_MINUTES
+        now = datetime.utcnow()
+        rows = []
+        users = []
+        for _ in range(count):
+            self.user_count += 1
+            user_id = f"{prefix}_{self.user_count}"
+            rows.append({
+                "user_id": user_id,
+                "user_email": f"{user_id}@example.com",
+                "user_phone": "44 720192837",
+                "user_pwd": self.password_hash,
+                "user_gender": self.rng.randint(0, 1),
+                "user_dob": date(1950, 1, 1) + timedelta(days=self.rng.randint(0, 20000)),
+                "user_height": self.rng.randint(55, 80),
+                "user_weight": self.rng.randint(100, 300),
+                "created_at": now,
+                "updated_at": now,
+            })
+            token = create_access_token(data={"sub": user_id}, expires_delta=timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES))
+            users.append(BenchUser(user_id=user_id, headers={"Authorization": f"Bearer {token}"}))
+        await self._insert(User, rows)
+        return users
+
+    async def prescriptions(self, user: BenchUser, count: int, medication_ids: List[int], details: int) -> List[int]:
+        from .models import Prescription, PrescriptionDetail
+        from .dosing import schedule_columns
+        ids = self._ids("prescription", count)
+        prescription_rows = []
+        detail_rows = []
+        for prescription_id in ids:
+            start = date(2023, 1, 1) + timedelta(days=self.rng.randint(0, 700))
+            prescription_rows.append({
+                "prescription_id": prescription_id,
+                "user_id": user.user_id,
+                "prescription_date_start": start,
+                "prescription_date_end": start + timedelta(days=self.rng.randint(7, 180)),
+                "prescription_status": self.rng.randint(0, 1),
+            })
+            chosen = sorted(self.rng.sample(medication_ids, details)) if details else []
+            user.medication_ids[prescription_id] = chosen
+            for medication_id in chosen:
+                detail = {
+                    "prescription_id": prescription_id,
+                    "medication_id": medication_id,
+                    "presc_dose": f"{self.rng.choice([5, 10, 20, 50])}mg",
+                    "presc_qty": self.rng.choice([30, 60, 90]),
+                    "presc_type": self.rng.choice(["tablet", "capsule", "drops"]),
+                    "presc_frequency": self.rng.choice(["once a day", "twice a day", "every 8 hours"]),
+                }
+                detail.update(schedule_columns(detail["presc_frequency"], detail["presc_dose"], detail["presc_type"]))
+                detail_rows.append(detail)
+        await self._insert(Prescription, prescription_rows)
+        await self._insert(PrescriptionDetail, detail_rows)
+        return ids
+
+    async def notifications(self, user: BenchUser, count: int) -> List[int]:
+        from .models import Notification
+        ids = self._ids("notification", count)
+        now = datetime.utcnow()
+        rows = [{
+            "notification_id": notification_id,
+            "user_id": user.user_id,
+            "notification_type": self.rng.randint(1, 2),
+            "notification_message": "Time to take your medication",
+            "notification_date": now + timedelta(hours=self.rng.randint(-500, 500)),
+            "notification_status": self.rng.choice([None, 0, 1]),
+            "created_at": now - timedelta(minutes=self.rng.randint(0, 100000)),
+            "updated_at": now,
+        } for notification_id in ids]
+        await self._insert(Notification, rows)
+        return ids
+
+    async def side_effects(self, user: BenchUser, count: int, medication_ids: List[int]) -> List[int]:
+        from .models import SideEffect
+        ids = self._ids("side_effect", count)
+        now = datetime.utcnow()
+        rows = [{
+            "side_effects_id": side_effects_id,
+            "user_id": user.user_id,
+            "medication_id": self.rng.choice(medication_ids),
+            "side_effect_desc": self.rng.choice(["headache", "nausea", "dizziness", "fatigue"]),
+            "created_at": now - timedelta(minutes=self.rng.randint(0, 100000)),
+            "updated_at": now,
+        } for side_effects_id in ids]
+        await self._insert(SideEffect, rows)
+        return ids
+
+
+async def seed(session_factory, args, rng: random.Random) -> BenchContext:
+    from .hashing import pwd_context
+    seeder = Seeder(session_factory, rng, pwd_context.hash(BENCH_PASSWORD))  # every user shares one bcrypt hash
+    medication_ids = await seeder.medications(args.medications)
+    users = await seeder.users(args.users)
+    for user in users:
+        user.prescription_ids = await seeder.prescriptions(user, args.prescriptions, medication_ids, args.details)
+        user.notification_ids = await seeder.notifications(user, args.notifications)
+        user.side_effect_ids = await seeder.side_effects(user, args.side_effects, medication_ids)
+    return BenchContext(args=args, rng=rng, medication_ids=medication_ids, users=users, seeder=seeder)
+
+
+# ---- setup steps: rows that a scenario uses up (one per request) ----
+async def spare_users(ctx: BenchContext, count: int):
+    ctx.spares["users"] = await ctx.seeder.users(count, prefix="bench_spare")
+
+async def spare_notifications(ctx: BenchContext, count: int):
+    ctx.spares["notifications"] = [
+        (user, notification_id)
+        for user in ctx.users
+        for notification_id in await ctx.seeder.notifications(user, count // len(ctx.users) + 1)
+    ]
+
+async def spare_side_effects(ctx: BenchContext, count: int):
+    ctx.spares["side_effects"] = [
+        (user, side_effects_id)
+        for user in ctx.users
+        for side_effects_id in await ctx.seeder.side_effects(user, count // len(ctx.users) + 1, ctx.medication_ids)
+    ]
+
+def spare_prescriptions(name: str, details: int):
+    async def setup(ctx: BenchContext, count: int):
+        ctx.spares[name] = [
+            (user, prescription_id)
+            for user in ctx.users
+            for prescription_id in await ctx.seeder.prescriptions(user, count // len(ctx.users) + 1, ctx.medication_ids, details)
+        ]
+    return setup
+
+
+def scenarios() -> List[Scenario]:
+    def spare(ctx, name, i):
+        return ctx.spares[name][i]
+
+    def notification_body(ctx, i):
+        return {
+            "notification_type": 1 + i % 2,
+            "notification_message": "Refill your prescription",
+            "notification_date": (datetime.utcnow() + timedelta(days=1)).isoformat(),
+        }
+
+    def detail_body(medication_id):
+        return {"medication_id": medication_id, "presc_dose": "10mg", "presc_qty": 30, "presc_type": "tablet", "presc_frequency": "twice a day"}
+
+    def update_detail(c, ctx, i):
+        user = ctx.user(i)
+        prescription_id = ctx.pick(i, user.prescription_ids)
+        return c.put(f"/prescriptions/{prescription_id}/details/{user.medication_ids[prescription_id][0]}",
+                     headers=user.headers, json={"presc_qty": 30 + i % 60})
+
+    def delete_detail(c, ctx, i):
+        user, prescription_id = spare(ctx, "detail_prescriptions", i)
+        return c.delete(f"/prescriptions/{prescription_id}/details/{user.medication_ids[prescription_id][0]}", headers=user.headers)
+
+    # an app resuming after its first sync -- only what the other scenarios wrote since (the seeded rows have no change_seq)
+    def sync_since(c, ctx, i):
+        from .pagination import encode_cursor
+        from .sync import SYNC_CURSOR_VERSION
+        return c.get("/sync", headers=ctx.user(i).headers, params={"since": encode_cursor([SYNC_CURSOR_VERSION, 0, datetime.utcnow()])})
+
+    return [
+        # users
+        Scenario("POST", "/register", lambda c, ctx, i: c.post("/register", json={
+            "user_id": f"bench_reg_{i}", "user_pwd": BENCH_PASSWORD, "user_dob": "1990-01-01",
+            "user_height": 70, "user_weight": 150})),
+        Scenario("POST", "/token", lambda c, ctx, i: c.post("/token", json={
+            "user_id": ctx.user(i).user_id, "user_pwd": BENCH_PASSWORD})),
+        Scenario("GET", "/users/me", lambda c, ctx, i: c.get("/users/me", headers=ctx.user(i).headers)),
+        Scenario("PUT", "/users/me", lambda c, ctx, i: c.put("/users/me", headers=ctx.user(i).headers, json={
+            "user_weight": 100 + i % 200})),
+        Scenario("DELETE", "/users/me", lambda c, ctx, i: c.request("DELETE", "/users/me", headers=spare(ctx, "users", i).headers, json={
+            "user_id": spare(ctx, "users", i).user_id, "user_pwd": BENCH_PASSWORD}), setup=spare_users),
+        Scenario("GET", "/users/me/export", lambda c, ctx, i: c.get("/users/me/export", headers=ctx.user(i).headers)),
+        Scenario("GET", "/users/me/calendar", lambda c, ctx, i: c.get(
+            "/users/me/calendar", headers=ctx.user(i).headers, params={"from": "2024-01-01", "to": "2024-01-31"})),
+        Scenario("GET", "/sync", lambda c, ctx, i: c.get("/sync", headers=ctx.user(i).headers)),
+        Scenario("GET", "/sync?since", sync_since),
+        # medications
+        Scenario("GET", "/metrics", lambda c, ctx, i: c.get("/metrics")),
+        Scenario("GET", "/medications/", lambda c, ctx, i: c.get("/medications/")),
+        Scenario("GET", "/medications/search", lambda c, ctx, i: c.get("/medications/search", params={"q": f"med {i % 50}"})),
+        # notifications
+        Scenario("POST", "/notifications/", lambda c, ctx, i: c.post("/notifications/", headers=ctx.user(i).headers,
+            json=notification_body(ctx, i))),
+        Scenario("POST", "/notifications/batch", lambda c, ctx, i: c.post("/notifications/batch", headers=ctx.user(i).headers,
+            json=[notification_body(ctx, i) for _ in range(BATCH_SIZE)])),
+        Scenario("GET", "/notifications/{notification_id}", lambda c, ctx, i: c.get(
+            f"/notifications/{ctx.pick(i, ctx.user(i).notification_ids)}", headers=ctx.user(i).headers)),
+        Scenario("GET", "/notifications", lambda c, ctx, i: c.get("/notifications", headers=ctx.user(i).headers)),
+        Scenario("PUT", "/notifications/{notification_id}", lambda c, ctx, i: c.put(
+            f"/notifications/{ctx.pick(i, ctx.user(i).notification_ids)}", headers=ctx.user(i).headers,
+            json={"notification_status": i % 2})),
+        Scenario("DELETE", "/notifications/{notification_id}", lambda c, ctx, i: c.delete(
+            f"/notifications/{spare(ctx, 'notifications', i)[1]}", headers=spare(ctx, "notifications", i)[0].headers),
+            setup=spare_notifications),
+        # prescriptions
+        Scenario("POST", "/prescriptions/", lambda c, ctx, i: c.post("/prescriptions/", headers=ctx.user(i).headers, json={
+            "prescription_date_start": "2024-01-01", "prescription_status": 0})),
+        Scenario("GET", "/prescriptions/{prescription_id}", lambda c, ctx, i: c.get(
+            f"/prescriptions/{ctx.pick(i, ctx.user(i).prescription_ids)}", headers=ctx.user(i).headers)),
+        Scenario("GET", "/prescriptions/", lambda c, ctx, i: c.get("/prescriptions/", headers=ctx.user(i).headers)),
+        Scenario("PUT", "/prescriptions/{prescription_id}", lambda c, ctx, i: c.put(
+            f"/prescriptions/{ctx.pick(i, ctx.user(i).prescription_ids)}", headers=ctx.user(i).headers,
+            json={"prescription_status": i % 2})),
+        Scenario("DELETE", "/prescriptions/{prescription_id}", lambda c, ctx, i: c.delete(
+            f"/prescriptions/{spare(ctx, 'delete_prescriptions', i)[1]}", headers=spare(ctx, "delete_prescriptions", i)[0].headers),
+            setup=spare_prescriptions("delete_prescriptions", DEFAULT_DETAILS)),
+        # prescription details
+        Scenario("POST", "/prescriptions/{prescription_id}/details/", lambda c, ctx, i: c.post(
+            f"/prescriptions/{spare(ctx, 'empty_prescriptions', i)[1]}/details/", headers=spare(ctx, "empty_prescriptions", i)[0].headers,
+            json=detail_body(ctx.medication_ids[0])), setup=spare_prescriptions("empty_prescriptions", 0)),
+        Scenario("POST", "/prescriptions/{prescription_id}/details/batch", lambda c, ctx, i: c.post(
+            f"/prescriptions/{spare(ctx, 'batch_prescriptions', i)[1]}/details/batch", headers=spare(ctx, "batch_prescriptions", i)[0].headers,
+            json=[detail_body(m) for m in ctx.medication_ids[:BATCH_SIZE]]), setup=spare_prescriptions("batch_prescriptions", 0)),
+        Scenario("GET", "/prescriptions/{prescription_id}/details/", lambda c, ctx, i: c.get(
+            f"/prescriptions/{ctx.pick(i, ctx.user(i).prescription_ids)}/details/", headers=ctx.user(i).headers)),
+        Scenario("PUT", "/prescriptions/{prescription_id}/details/{medication_id}", update_detail),
+        Scenario("DELETE", "/prescriptions/{prescription_id}/details/{medication_id}", delete_detail,
+            setup=spare_prescriptions("detail_prescriptions", 1)),
+        # side effects
+        Scenario("POST", "/side_effects/", lambda c, ctx, i: c.post("/side_effects/", headers=ctx.user(i).headers, json={
+            "medication_id": ctx.pick(i, ctx.medication_ids), "side_effect_desc": "headache"})),
+        Scenario("POST", "/side_effects/batch", lambda c, ctx, i: c.post("/side_effects/batch", headers=ctx.user(i).headers, json=[
+            {"medication_id": m, "side_effect_desc": "nausea"} for m in ctx.medication_ids[:BATCH_SIZE]])),
+        Scenario("GET", "/side_effects/", lambda c, ctx, i: c.get("/side_effects/", headers=ctx.user(i).headers)),
+        Scenario("GET", "/side_effects/medication/{medication_id}/user/", lambda c, ctx, i: c.get(
+            f"/side_effects/medication/{ctx.pick(i, ctx.medication_ids)}/user/", headers=ctx.user(i).headers)),
+        Scenario("GET", "/side_effects/stats", lambda c, ctx, i: c.get("/side_effects/stats", headers=ctx.user(i).headers)),
+        Scenario("GET", "/side_effects/stats/{medication_id}", lambda c, ctx, i: c.get(
+            f"/side_effects/stats/{ctx.pick(i, ctx.medication_ids)}", headers=ctx.user(i).headers)),
+        Scenario("PUT", "/side_effects/{side_effects_id}", lambda c, ctx, i: c.put(
+            f"/side_effects/{ctx.pick(i, ctx.user(i).side_effect_ids)}", headers=ctx.user(i).headers,
+            json={"side_effect_desc": f"dizziness {i}"})),
+        Scenario("DELETE", "/side_effects/{side_effects_id}", lambda c, ctx, i: c.delete(
+            f"/side_effects/{spare(ctx, 'side_effects', i)[1]}", headers=spare(ctx, "side_effects", i)[0].headers),
+            setup=spare_side_effects),
+    ]
+
+
+def percentile(sorted_values: List[float], pct: float) -> float:
+    # nearest-rank percentile
+    if not sorted_values:
+        return 0.0
+    rank = max(1, int(round(pct / 100 * len(sorted_values) + 0.5)))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+async def run_scenario(client, ctx: BenchContext, scenario: Scenario) -> dict:
+    total = ctx.args.requests
+    latencies = []
+    statuses: Dict[str, int] = {}
+    errors = 0
+    next_request = iter(range(total))
+
+    async def worker():
+        nonlocal errors
+        for i in next_request:
+            start = time.perf_counter()
+            try:
+                response = await scenario.call(client, ctx, i)
+                status = response.status_code
+            except Exception as e:  # a crash inside the app counts as an error, the run keeps going
+                logging.getLogger(__name__).warning("%s request %s failed: %r", scenario.name, i, e)
+                status = "exception"
+            latencies.append(time.perf_counter() - start)
+            statuses[str(status)] = statuses.get(str(status), 0) + 1
+            if status not in scenario.expected:
+                errors += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(min(ctx.args.concurrency, total))))
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    to_ms = lambda seconds: round(seconds * 1000, 3)
+    return {
+        "requests": total,
+        "errors": errors,
+        "status_codes": statuses,
+        "throughput_rps": round(total / elapsed, 2) if elapsed else 0.0,
+        "mean_ms": to_ms(sum(latencies) / len(latencies)) if latencies else 0.0,
+        "p50_ms": to_ms(percentile(latencies, 50)),
+        "p95_ms": to_ms(percentile(latencies, 95)),
+        "p99_ms": to_ms(percentile(latencies, 99)),
+        "max_ms": to_ms(latencies[-1]) if latencies else 0.0,
+    }
+
+
+# Routes in the app that no scenario covers -- so a new endpoint shows up in the report until it gets one
+def uncovered_routes(app, covered: List[Scenario]) -> List[str]:
+    from fastapi.routing import APIRoute
+    names = {s.name for s in covered}
+    missing = []
+    for route in app.routes:
+        if isinstance(route, APIRoute):
+            for method in sorted(route.methods):
+                if f"{method} {route.path}" not in names:
+                    missing.append(f"{method} {route.path}")
+    return missing
+
+
+async def run(args) -> dict:
+    # imported here so DATABASE_URL / SECRET_KEY are set before database.py and tokens.py load
+    import httpx
+    from sqlalchemy import event
+    from . import database
+    from .models import Base
+    from .main import app
+    from .side_effect_rollup import rebuild_side_effect_rollup
+    from .query_tracker import query_tracker
+
+    logging.disable(logging.INFO)  # main.py turns on DEBUG logging for everything
+
+    def sqlite_pragmas(dbapi_connection, connection_record):
+        # WAL + busy timeout so concurrent writers wait for the lock instead of failing
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA busy_timeout=30000")
+        cursor.close()
+
+    engines = [database.engine] if database.read_engine is database.engine else [database.engine, database.read_engine]
+    for engine in engines:
+        engine.echo = False  # SQL logging would dominate the timings
+        event.listen(engine.sync_engine, "connect", sqlite_pragmas)
+
+    async with database.engine.begin() as connection:
+        await connection.run_sync(Base.metadata.drop_all)
+        await connection.run_sync(Base.metadata.create_all)
+
+    rng = random.Random(args.seed)
+    seed_started = time.perf_counter()
+    ctx = await seed(database.AsyncSessionLocal, args, rng)
+    selected = [s for s in scenarios() if not args.only or any(text in s.name for text in args.only)]
+    for scenario in selected:
+        # spare rows are made up front so their ids can't clash with rows the API creates during the run
+        if scenario.setup is not None:
+            await scenario.setup(ctx, args.requests)
+    await rebuild_side_effect_rollup(database.AsyncSessionLocal)  # seeded side effects skip the API, count them once here
+    if args.read_db:
+        # the replica starts out as a copy of the seeded primary (VACUUM INTO also picks up what is still in the WAL)
+        if os.path.exists(args.read_db):
+            os.remove(args.read_db)
+        async with database.engine.connect() as connection:
+            await connection.exec_driver_sql("VACUUM INTO ?", (args.read_db,))
+    seed_seconds = time.perf_counter() - seed_started
+    results = {}
+    async with app.router.lifespan_context(app):
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+            for scenario in selected:
+                results[scenario.name] = await run_scenario(client, ctx, scenario)
+                print(f"{scenario.name:<60} {results[scenario.name]['throughput_rps']:>9} req/s  "
+                      f"p50 {results[scenario.name]['p50_ms']:>8} ms  p99 {results[scenario.name]['p99_ms']:>8} ms  "
+                      f"errors {results[scenario.name]['errors']}", file=sys.stderr)
+    for engine in engines:
+        await engine.dispose()
+
+    return {
+        "generated_at": datetime.utcnow().isoformat() + "Z",
+        "database": "sqlite+aiosqlite",
+        "read_replica": bool(args.read_db),
+        "config": {
+            "medications": args.medications, "users": args.users, "prescriptions_per_user": args.prescriptions,
+            "details_per_prescription": args.details, "notifications_per_user": args.notifications,
+            "side_effects_per_user": args.side_effects, "requests_per_endpoint": args.requests,
+            "concurrency": args.concurrency, "seed": args.seed,
+        },
+        "seed_seconds": round(seed_seconds, 3),
+        "endpoints": results,
+        "uncovered_routes": uncovered_routes(app, selected) if not args.only else [],
+        "queries": query_tracker.report() if args.track_queries else None,
+    }
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    workdir = None
+    db_path = args.db
+    if db_path is None:
+        workdir = tempfile.mkdtemp(prefix="medication_app_bench_")
+        db_path = os.path.join(workdir, "bench.db")
+    os.environ["DATABASE_URL"] = f"sqlite+aiosqlite:///{db_path}"
+    if args.read_db:
+        os.environ["DATABASE_READ_URL"] = f"sqlite+aiosqlite:///{args.read_db}"
+    os.environ.setdefault("SECRET_KEY", BENCH_SECRET_KEY)
+    os.environ.setdefault("APP_ENV", "bench")  # database settings profile (settings.py)
+    if args.track_queries:
+        os.environ["DB_TRACK_QUERIES"] = "1"
+
+    try:
+        # the app prints to stdout, keep it out of the JSON report
+        with contextlib.redirect_stdout(sys.stderr):
+            report = asyncio.run(run(args))
+    finally:
+        if workdir is not None:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
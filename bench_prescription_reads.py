@@ -0,0 +1,103 @@
+# this is the file for benchmarking the prescription read path
+# compares the per-prescription cost of building the GET /prescriptions/ response body:
+#   before: PrescriptionDetailRead / PrescriptionRead models built by hand, validated again
+#           by the response_model and then serialized
+#   after:  joined rows grouped into dicts and turned into JSON bytes by pydantic-core
+# Only the python side is measured (the rows are made up), so the numbers show the cost the
+# fast path removes on top of the database round trips it saves.
+# Run with: python -m <package>.bench_prescription_reads [prescriptions] [details_per_prescription]
+import json
+import sys
+import time
+from collections import namedtuple
+from datetime import date
+from typing import List
+from fastapi.encoders import jsonable_encoder
+from pydantic import TypeAdapter
+from .prescription_reads import group_prescription_rows, dump_json
+from .schemas import PrescriptionRead, PrescriptionDetailRead
+
+REPEAT = 5  # Best of REPEAT runs is reported
+
+Row = namedtuple("Row", [
+    "prescription_id", "user_id", "prescription_date_start", "prescription_date_end",
+    "prescription_status", "medication_id", "medication_name", "presc_dose",
+    "presc_qty", "presc_type", "presc_frequency",
+])
+
+
+def make_rows(prescriptions: int, details: int) -> List[Row]:
+    rows = []
+    for prescription_id in range(1, prescriptions + 1):
+        for medication_id in range(1, details + 1):
+            rows.append(Row(
+                prescription_id, "bench_user", date(2024, 1, 1), None, 1,
+                medication_id, f"medication {medication_id}", "10mg", 30, "tablet", "twice a day",
+            ))
+    return rows
+
+
+response_adapter = TypeAdapter(List[PrescriptionRead])
+
+
+# What the endpoint used to do once the ORM objects were loaded
+def before(rows: List[Row]) -> bytes:
+    prescriptions = {}
+    for row in rows:
+        prescription = prescriptions.get(row.prescription_id)
+        if prescription is None:
+            prescription = prescriptions[row.prescription_id] = PrescriptionRead(
+                prescription_id=row.prescription_id,
+                user_id=row.user_id,
+                prescription_date_start=row.prescription_date_start,
+                prescription_date_end=row.prescription_date_end,
+                prescription_status=row.prescription_status,
+                prescription_details=[],
+            )
+        prescription.prescription_details.append(PrescriptionDetailRead(
+            prescription_id=row.prescription_id,
+            medication_id=row.medication_id,
+            medication_name=row.medication_name,
+            presc_dose=row.presc_dose,
+            presc_qty=row.presc_qty,
+            presc_type=row.presc_type,
+            presc_frequency=row.presc_frequency,
+        ))
+    # response_model validation + jsonable_encoder + json render, as FastAPI does
+    validated = response_adapter.validate_python(list(prescriptions.values()), from_attributes=True)
+    content = jsonable_encoder(validated)
+    return dump_json(content)
+
+
+def after(rows: List[Row]) -> bytes:
+    return dump_json(group_prescription_rows(rows))
+
+
+def best_time(func, rows: List[Row]) -> float:
+    times = []
+    for _ in range(REPEAT):
+        start = time.perf_counter()
+        func(rows)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def main():
+    prescriptions = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    details = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    rows = make_rows(prescriptions, details)
+
+    # Both paths have to produce the same JSON
+    if json.loads(before(rows)) != json.loads(after(rows)):
+        raise SystemExit("before and after produced different responses")
+
+    before_us = best_time(before, rows) / prescriptions * 1e6
+    after_us = best_time(after, rows) / prescriptions * 1e6
+    print(f"{prescriptions} prescriptions x {details} details")
+    print(f"before: {before_us:8.2f} us per prescription")
+    print(f"after:  {after_us:8.2f} us per prescription")
+    print(f"speedup: {before_us / after_us:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
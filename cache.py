@@ -0,0 +1,92 @@
+# this is the file for small in-process caches used by the API
+# each uvicorn worker keeps its own copy, so entries always need an expiry
+# to limit how stale one worker can get compared to the others
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, Optional
+
+
+class LRUCache:
+    """
+    Least-recently-used cache where every entry also has its own expiry time.
+
+    :param maxsize: Max number of entries, the least recently used entry is dropped when full
+    :param ttl: Default time to live in seconds (None = entries only expire when set with expires_at)
+    :param maxbytes: Max total size of the values (None = no limit), least recently used entries are dropped to fit
+    :param sizeof: Size of one value for maxbytes (default len, eg. for bytes)
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: Optional[float] = None, maxbytes: Optional[int] = None,
+                 sizeof: Callable[[Any], int] = len):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.maxbytes = maxbytes
+        self.sizeof = sizeof
+        self.bytes = 0  # total size of the values (only counted when maxbytes is set)
+        self._data: "OrderedDict[Hashable, tuple]" = OrderedDict()  # key -> (expires_at, value, size)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        entry = self._data.get(key)
+        if entry is None:
+            self.misses += 1
+            return default
+
+        expires_at, value, size = entry
+        if expires_at is not None and expires_at <= time.time():
+            # Entry is past its expiry -- drop it and count as a miss
+            del self._data[key]
+            self.bytes -= size
+            self.expirations += 1
+            self.misses += 1
+            return default
+
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    # Store a value -- expires_at (unix time) overrides the default ttl
+    def set(self, key: Hashable, value: Any, expires_at: Optional[float] = None) -> None:
+        if expires_at is None and self.ttl is not None:
+            expires_at = time.time() + self.ttl
+        size = self.sizeof(value) if self.maxbytes is not None else 0
+        old = self._data.get(key)
+        if old is not None:
+            self.bytes -= old[2]
+        self._data[key] = (expires_at, value, size)
+        self.bytes += size
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize or (self.maxbytes is not None and self.bytes > self.maxbytes and self._data):
+            _, (_, _, evicted_size) = self._data.popitem(last=False)
+            self.bytes -= evicted_size
+            self.evictions += 1
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        entry = self._data.pop(key, None)
+        if entry is None:
+            return default
+        self.bytes -= entry[2]
+        return entry[1]
+
+    def clear(self) -> None:
+        self._data.clear()
+        self.bytes = 0
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "bytes": self.bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
@@ -0,0 +1,143 @@
+# this is the file for the in-memory medication catalog
+# the medication table changes rarely and is the same for every user, so instead of
+# scanning it on every request each worker keeps a snapshot of it:
+#   - every medication already serialized to JSON bytes (GET /medications/ just joins a page of them)
+#   - an ETag for the catalog so clients can send If-None-Match and get a 304
+#   - a medication_id -> MedicationRead dict for the "does this medication exist" checks
+# The snapshot is reloaded every CATALOG_REFRESH_SECONDS or right away after bump_version()
+import asyncio
+import bisect
+import hashlib
+import logging
+import time
+from typing import Dict, List, Optional, Tuple
+from pydantic import TypeAdapter
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.future import select
+from .models import Medication
+from .schemas import MedicationRead
+
+logger = logging.getLogger(__name__)
+
+CATALOG_REFRESH_SECONDS = 300  # Reload the catalog from the database at least every 5 minutes
+
+_medication_adapter = TypeAdapter(MedicationRead)
+
+
+class CatalogSnapshot:
+    def __init__(self, medications: List[MedicationRead], version: int):
+        self.version = version
+        self.loaded_at = time.monotonic()
+        self.medications = medications  # ordered by medication_id
+        self.ids = [m.medication_id for m in medications]
+        self.by_id: Dict[int, MedicationRead] = {m.medication_id: m for m in medications}
+        self.item_bodies: List[bytes] = [_medication_adapter.dump_json(m) for m in medications]
+        # ETag is based on the content so every worker hands out the same value for the same catalog
+        digest = hashlib.sha256()
+        for body in self.item_bodies:
+            digest.update(body)
+        self.etag_base = digest.hexdigest()[:32]
+        self.etag = '"' + self.etag_base + '"'
+
+    # JSON list of up to limit medications with medication_id > after_id
+    # returns the bytes and the last medication_id on the page if there are more after it
+    def page(self, after_id: Optional[int], limit: int) -> Tuple[bytes, Optional[int]]:
+        start = 0 if after_id is None else bisect.bisect_right(self.ids, after_id)
+        end = min(start + limit, len(self.ids))
+        body = b"[" + b",".join(self.item_bodies[start:end]) + b"]"
+        next_after_id = self.ids[end - 1] if end < len(self.ids) else None
+        return body, next_after_id
+
+    # ETag for one page of the catalog
+    def page_etag(self, after_id: Optional[int], limit: int) -> str:
+        return f'"{self.etag_base}-{after_id or 0}-{limit}"'
+
+
+class MedicationCatalog:
+    def __init__(self, refresh_seconds: float = CATALOG_REFRESH_SECONDS):
+        self.refresh_seconds = refresh_seconds
+        self.version = 0  # bumped when the medication table is known to have changed
+        self._snapshot: Optional[CatalogSnapshot] = None
+        self._lock = asyncio.Lock()
+
+    # Mark the snapshot as stale -- the next request reloads it
+    def bump_version(self):
+        self.version += 1
+
+    def _is_fresh(self) -> bool:
+        snapshot = self._snapshot
+        return (
+            snapshot is not None
+            and snapshot.version == self.version
+            and time.monotonic() - snapshot.loaded_at < self.refresh_seconds
+        )
+
+    # Get the current snapshot, reloading it from the database if it is stale
+    async def get(self, db: AsyncSession) -> CatalogSnapshot:
+        if self._is_fresh():
+            return self._snapshot
+        async with self._lock:
+            # Another request may have reloaded while we were waiting on the lock
+            if not self._is_fresh():
+                version = self.version
+                result = await db.execute(select(Medication).order_by(Medication.medication_id))
+                medications = [MedicationRead.model_validate(m) for m in result.scalars().all()]
+                self._snapshot = CatalogSnapshot(medications, version)
+                logger.info("Medication catalog loaded: %s medications (version %s)", len(medications), version)
+        return self._snapshot
+
+    # Look up one medication by id, None if it does not exist
+    async def get_medication(self, db: AsyncSession, medication_id: int) -> Optional[MedicationRead]:
+        snapshot = await self.get(db)
+        medication = snapshot.by_id.get(medication_id)
+        if medication is not None:
+            return medication
+
+        # Not in the snapshot -- it may have been added since the last reload, so check the table directly
+        result = await db.execute(select(Medication).filter(Medication.medication_id == medication_id))
+        row = result.scalars().first()
+        if row is None:
+            return None
+        self.bump_version()  # The snapshot is out of date, reload it on the next request
+        return MedicationRead.model_validate(row)
+
+    # Look up many medications at once, returns {medication_id: MedicationRead} for the ones that exist
+    # ids missing from the snapshot are checked with a single IN query
+    async def get_medications(self, db: AsyncSession, medication_ids) -> Dict[int, MedicationRead]:
+        snapshot = await self.get(db)
+        found = {}
+        unknown = set()
+        for medication_id in medication_ids:
+            medication = snapshot.by_id.get(medication_id)
+            if medication is not None:
+                found[medication_id] = medication
+            else:
+                unknown.add(medication_id)
+
+        if unknown:
+            result = await db.execute(select(Medication).filter(Medication.medication_id.in_(unknown)))
+            rows = result.scalars().all()
+            if rows:
+                self.bump_version()  # The snapshot is out of date, reload it on the next request
+            for row in rows:
+                found[row.medication_id] = MedicationRead.model_validate(row)
+        return found
+
+
+# Shared catalog used by the API
+medication_catalog = MedicationCatalog()
+
+
+# Check an If-None-Match header against an ETag
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+        if candidate == etag:
+            return True
+    return False
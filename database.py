@@ -8,50 +8,199 @@
 # instal newest SQLalchemy 
 from .models import Base
 import asyncio
+import functools
+import inspect
+from contextvars import ContextVar
+from typing import Optional
 #from sqlalchemy import create_engine
+from fastapi.routing import APIRoute
+from sqlalchemy import event
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import sessionmaker, Session
 from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy.future import select  # Import `select` to handle queries properly
-from .secret_secrets import * 
+from .cache import LRUCache
+from .settings import settings
+from .metrics import InstrumentedQueuePool, instrument_engine
+from .query_tracker import track_queries
+from .slow_query_log import slow_query_log
 
-# Database connection details
-# this is the local connection using my local SQL server and SQL workbench 
-hostname = "app-db.clsm00w6ehfa.us-east-1.rds.amazonaws.com" 
+# Database connection details, pool sizes etc. come from settings.py (APP_ENV profile, SETTINGS_FILE, environment)
+# DATABASE_URL in the environment replaces the RDS connection
+# eg. sqlite+aiosqlite:///bench.db for the local benchmark (bench_endpoints.py)
+SQLALCHEMY_DATABASE_URL = settings.url
+if SQLALCHEMY_DATABASE_URL is None:
+    from .secret_secrets import * 
 
-username = db_user
-password = db_pwd
+    username = db_user
+    password = db_pwd
 
-port = 3306
-database = "app_db"
+    SQLALCHEMY_DATABASE_URL = (
+        f"mysql+aiomysql://{username}:{password}@{settings.host}:{settings.port}/{settings.name}"
+    )
 
-SQLALCHEMY_DATABASE_URL = (
-    f"mysql+aiomysql://{username}:{password}@{hostname}:{port}/{database}"
-)
+# DATABASE_READ_URL in the environment points the read-only endpoints at a read replica
+# without it reads go to the primary as well (same engine, same pool)
+# eg. sqlite+aiosqlite:///replica.db next to DATABASE_URL=sqlite+aiosqlite:///bench.db to try it locally (bench_endpoints.py --read-db)
+SQLALCHEMY_READ_DATABASE_URL = settings.read_url
 
-# Create an asynchronous engine instance
-engine = create_async_engine(
-    SQLALCHEMY_DATABASE_URL, 
-    echo=True, # Log all SQL queries for debugging
-    pool_size=10,  # Initial pool size is 10 connections
-    max_overflow=20  # Allow 20 overflow connections if needed
-)
+READ_YOUR_WRITES_SECONDS = 5   # After a user's own write their reads go to the primary for this long (should be more than the replica lag)
+RECENT_WRITERS_SIZE = 100000   # Max users remembered as having just written, per worker
+
+
+# Limit how long one statement may run on the server (settings.statement_timeout_ms), set on every new connection
+def _statement_timeout_sql(dialect_name: str, timeout_ms: int) -> Optional[str]:
+    if dialect_name in ("mysql", "mariadb"):
+        return f"SET SESSION max_execution_time = {int(timeout_ms)}"  # MySQL only applies this to SELECTs
+    if dialect_name == "postgresql":
+        return f"SET statement_timeout = {int(timeout_ms)}"
+    return None  # SQLite has no statement timeout
+
+
+# Create an asynchronous engine instance from the settings
+# name is the engine's label on GET /metrics (metrics.py)
+def _create_engine(url: str, name: str):
+    pool_size, max_overflow = settings.pool_limits()
+    new_engine = create_async_engine(
+        url,
+        echo=settings.echo,  # Log all SQL queries (DB_ECHO=1) -- the slow query log is usually what you want
+        poolclass=InstrumentedQueuePool,  # the MySQL default pool (SQLite would get none) + checkout wait timing
+        pool_size=pool_size,  # Connections kept open per worker
+        max_overflow=max_overflow,  # Extra connections allowed when the pool is busy
+        pool_timeout=settings.pool_timeout,  # Seconds to wait for a free connection
+        pool_recycle=settings.pool_recycle,  # Replace connections before the server drops them
+        pool_pre_ping=settings.pool_pre_ping,  # Test connections before handing them out
+    )
+    instrument_engine(new_engine, name)  # statement count / time for GET /metrics
+    track_queries(new_engine)  # statements per request / N+1 warnings (query_tracker.py)
+    slow_query_log.instrument_engine(new_engine, name)  # statements over settings.slow_query_ms (slow_query_log.py)
+
+    timeout_sql = _statement_timeout_sql(new_engine.dialect.name, settings.statement_timeout_ms) if settings.statement_timeout_ms else None
+    if timeout_sql is not None:
+        @event.listens_for(new_engine.sync_engine, "connect")
+        def set_statement_timeout(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            cursor.execute(timeout_sql)
+            cursor.close()
+    return new_engine
+
+engine = _create_engine(SQLALCHEMY_DATABASE_URL, "primary")
+
+# Engine for the read replica -- its own pool so GETs don't wait behind writes for a primary connection
+read_engine = _create_engine(SQLALCHEMY_READ_DATABASE_URL, "read") if SQLALCHEMY_READ_DATABASE_URL else engine
+
+
+# Sessions on the primary -- commits that wrote something are recorded for read-your-writes (see below)
+class PrimarySession(Session):
+    pass
 
 # Create an asynchronous sessionmaker
 AsyncSessionLocal = sessionmaker(
     bind=engine, 
     class_=AsyncSession, 
+    sync_session_class=PrimarySession,
+    expire_on_commit=False
+)
+
+# Sessions for read-only work -- never commit anything through these
+AsyncReadSessionLocal = sessionmaker(
+    bind=read_engine,
+    class_=AsyncSession,
     expire_on_commit=False
 )
 
+# Read-your-writes: a replica can be a little behind the primary, so a user who just saved something could
+# read it back from the replica and not see it. The user of the current request is kept in request_user_id
+# (set by get_current_user_id in tokens.py); when a primary session commits a write for that user, the user
+# is remembered for READ_YOUR_WRITES_SECONDS and read_sessionmaker() sends their reads to the primary.
+# Each uvicorn worker remembers its own writers -- a read landing on another worker right after the write
+# can still come from the replica.
+request_user_id: ContextVar[Optional[str]] = ContextVar("request_user_id", default=None)
+recent_writers = LRUCache(maxsize=RECENT_WRITERS_SIZE, ttl=READ_YOUR_WRITES_SECONDS)  # user_id -> True
+
+@event.listens_for(PrimarySession, "do_orm_execute")
+def _note_write_statement(orm_execute_state):
+    if orm_execute_state.is_insert or orm_execute_state.is_update or orm_execute_state.is_delete:
+        orm_execute_state.session.info["wrote"] = True
+
+@event.listens_for(PrimarySession, "after_flush")
+def _note_flush(session, flush_context):
+    session.info["wrote"] = True
+
+@event.listens_for(PrimarySession, "after_commit")
+def _remember_writer(session):
+    user_id = request_user_id.get()
+    if session.info.pop("wrote", False) and user_id is not None:
+        recent_writers.set(user_id, True)
+
+@event.listens_for(PrimarySession, "after_rollback")
+def _forget_write(session):
+    session.info.pop("wrote", None)
+
+# Sessionmaker to read a user's data with -- the primary right after their own write, otherwise the replica
+def read_sessionmaker(user_id: Optional[str] = None):
+    if read_engine is engine or (user_id is not None and recent_writers.get(user_id)):
+        return AsyncSessionLocal
+    return AsyncReadSessionLocal
+
+# Stands in for an AsyncSession and only creates it the first time it is used, so a request that fails before
+# the handler touches the database (bad token, validation error, cache hit ...) never builds a session.
+# A session itself only checks out a pooled connection on its first execute and gives it back on
+# commit / rollback / close -- SessionReleasingRoute closes it right after the handler returns.
+class LazySession:
+    __slots__ = ("_factory", "_session")
+
+    def __init__(self, factory):
+        self._factory = factory
+        self._session: Optional[AsyncSession] = None
+
+    def __getattr__(self, name):
+        session = self._session
+        if session is None:
+            session = self._session = self._factory()
+        return getattr(session, name)
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+
 # Dependency for obtaining a session (asynchronous)
 async def get_db():
-    # Using context manager to ensure session is closed correctly
-    async with AsyncSessionLocal() as session:
-        try:
-            yield session
-        finally:
-            await session.close()  # Explicitly close the session after use
+    session = LazySession(AsyncSessionLocal)
+    try:
+        yield session
+    finally:
+        await session.close()  # Explicitly close the session after use
+
+# Dependency for read-only endpoints that are the same for every user (eg. the medication catalog)
+# for reads of the current user's own rows use get_user_read_db in tokens.py (read-your-writes)
+async def get_read_db():
+    session = LazySession(AsyncReadSessionLocal)
+    try:
+        yield session
+    finally:
+        await session.close()
+
+# Route class for the app (set in tokens.py): closes the handler's sessions as soon as the handler returns
+# FastAPI only runs the dependency clean up after the response model is serialized, so without this the
+# connection stays checked out while the response is built. Sessions are closed, not committed -- handlers
+# commit their own writes, anything left uncommitted is rolled back like before. Objects the handler returns
+# keep their loaded values (expire_on_commit=False), only lazy loads during serialization would fail (and
+# those don't work with AsyncSession anyway).
+class SessionReleasingRoute(APIRoute):
+    def __init__(self, path: str, endpoint, **kwargs):
+        if inspect.iscoroutinefunction(endpoint):
+            handler = endpoint
+
+            @functools.wraps(handler)
+            async def endpoint(*args, **values):
+                try:
+                    return await handler(*args, **values)
+                finally:
+                    for value in values.values():
+                        if isinstance(value, (LazySession, AsyncSession)):
+                            await value.close()
+        super().__init__(path, endpoint, **kwargs)
 
 # Function to create tables asynchronously
 async def create_tables():
@@ -92,6 +241,8 @@ async def test_connection():
 async def close_connections():
     # Ensure connections are explicitly closed before exiting
     await engine.dispose()
+    if read_engine is not engine:
+        await read_engine.dispose()
     print("Connections closed.")
     # Ensures no nested event loops or calls to asyncio.run() that can close the event loop prematurely.
   
@@ -0,0 +1,227 @@
+# this is the file for the dose calendar (GET /users/me/calendar)
+# every active prescription of the user is expanded into the concrete dose events (date + time, medication,
+# dose) that fall inside the requested window, using the dose schedule stored with each detail (dosing.py).
+# Three caches keep opening the calendar cheap:
+#   calendars  -- per user: the finished JSON for each window asked for lately. A repeat request is served
+#                 from here without touching the database. Dropped by invalidate() whenever one of the
+#                 user's prescriptions / details is written (see main.py).
+#   rows       -- per user: the active prescription + detail rows, with the user's sync change counter
+#                 (sync.py) they were read at. A new window only reads the counter (one primary key lookup)
+#                 and runs the row query again when it moved.
+#   expansions -- per prescription: the events worked out last time for a span of EXPANSION_MARGIN_DAYS
+#                 around the window asked for, together with the version (the prescription + detail rows)
+#                 they came from. A window inside the span is sliced out of it, so moving the window a week
+#                 expands nothing; after a write only the prescriptions whose rows changed are expanded again.
+# Each uvicorn worker keeps its own caches, so a calendar cached by another worker can be up to
+# CALENDAR_CACHE_TTL_SECONDS old.
+import bisect
+import heapq
+import itertools
+from datetime import date, datetime, time, timedelta
+from itertools import groupby
+from typing import Any, Dict, List, Optional
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.future import select
+from .cache import LRUCache
+from .dosing import DoseSchedule, DAY_START_MINUTES, decode_schedule, parse_schedule
+from .models import Prescription, PrescriptionDetail, Medication, SyncCounter
+from .prescription_reads import dump_json
+
+CALENDAR_MAX_DAYS = 62                 # Longest window one request can ask for
+CALENDAR_CACHE_SIZE = 10000            # Users whose calendars are kept in memory per worker
+CALENDAR_CACHE_TTL_SECONDS = 60        # How long a cached calendar is served before it is built again
+CALENDAR_WINDOWS_PER_USER = 4          # Windows (from / to) cached per user -- the oldest is dropped first
+ROWS_CACHE_TTL_SECONDS = 600           # Cached rows are read again after this long even if the counter did not move
+EXPANSION_CACHE_SIZE = 50000           # Expanded prescriptions kept in memory per worker
+EXPANSION_MARGIN_DAYS = 31             # Days expanded on each side of the window asked for
+
+PRESCRIPTION_STATUS_ACTIVE = 0         # prescription_status: 0 = active, 1 = archive
+
+
+# Minutes after midnight the doses of one day are taken at
+def _daily_times(schedule: DoseSchedule) -> tuple:
+    if schedule.times_of_day:
+        return schedule.times_of_day
+    if not schedule.interval_hours:
+        return (DAY_START_MINUTES,)
+    # presc_schedule had too many doses to list them -- go around the clock from the first dose of the day
+    step = max(1, int(round(schedule.interval_hours * 60)))
+    return tuple(sorted({(DAY_START_MINUTES + offset) % (24 * 60) for offset in range(0, 24 * 60, step)}))
+
+
+# Dose times of one prescription detail between first_day and last_day (both included), in order
+# doses less than once a day (every other day, weekly ...) count their days from anchor, the prescription start
+def dose_times(schedule: DoseSchedule, first_day: date, last_day: date, anchor: date) -> List[datetime]:
+    if not schedule.doses_per_day or first_day > last_day:
+        return []
+    times = [timedelta(minutes=minutes) for minutes in _daily_times(schedule)]
+    step_days = 1
+    if schedule.interval_hours and schedule.interval_hours >= 24:
+        step_days = max(1, int(round(schedule.interval_hours / 24)))
+        times = times[:1]
+        # move to the first dose day on or after first_day
+        offset = (first_day - anchor).days % step_days
+        if offset:
+            first_day += timedelta(days=step_days - offset)
+
+    events = []
+    day = first_day
+    while day <= last_day:
+        midnight = datetime.combine(day, datetime.min.time())
+        events.extend(midnight + time for time in times)
+        day += timedelta(days=step_days)
+    return events
+
+
+# Dose events of one prescription (its detail rows) inside the window
+def expand_prescription(rows: List[Any], date_from: date, date_to: date) -> List[Dict[str, Any]]:
+    events = []
+    for row in rows:
+        if row.presc_schedule is not None:
+            schedule = decode_schedule(row.presc_schedule)
+        else:
+            schedule = parse_schedule(row.presc_frequency, row.presc_dose, row.presc_type)  # saved before presc_schedule existed
+        first_day = max(date_from, row.prescription_date_start or date_from)
+        last_day = min(date_to, row.prescription_date_end or date_to)
+        for dose_time in dose_times(schedule, first_day, last_day, row.prescription_date_start or date_from):
+            events.append({
+                "dose_time": dose_time,
+                "prescription_id": row.prescription_id,
+                "medication_id": row.medication_id,
+                "medication_name": row.medication_name,
+                "presc_dose": row.presc_dose,
+                "amount": schedule.amount,
+                "unit": schedule.unit,
+            })
+    events.sort(key=lambda event: (event["dose_time"], event["medication_id"]))
+    return events
+
+
+def _event_order(event: Dict[str, Any]) -> tuple:
+    return event["dose_time"], event["prescription_id"], event["medication_id"]
+
+
+class DoseCalendar:
+    def __init__(self):
+        self.calendars = LRUCache(maxsize=CALENDAR_CACHE_SIZE, ttl=CALENDAR_CACHE_TTL_SECONDS)  # user_id -> {(from, to): JSON bytes}
+        self.rows = LRUCache(maxsize=CALENDAR_CACHE_SIZE, ttl=ROWS_CACHE_TTL_SECONDS)  # user_id -> (change_seq, rows)
+        self.expansions = LRUCache(maxsize=EXPANSION_CACHE_SIZE)  # prescription_id -> (version, first day, last day, dose times, events)
+        self.generations = LRUCache(maxsize=CALENDAR_CACHE_SIZE)  # user_id -> generation, bumped by invalidate()
+        # one counter for all users -- a user whose generation was dropped from the LRU gets a number never used before
+        self._counter = itertools.count(1)
+        # Metrics
+        self.builds = 0        # calendars built (cache misses)
+        self.row_reads = 0     # row queries run while building (the rest used the rows cache)
+        self.expanded = 0      # prescriptions expanded while building
+        self.reused = 0        # prescriptions sliced from the expansions cache while building
+
+    # All active prescription details of the user, one row per detail -- filtered to the window in _build
+    def _rows_query(self, user_id: str):
+        return (
+            select(
+                Prescription.prescription_id,
+                Prescription.prescription_date_start,
+                Prescription.prescription_date_end,
+                PrescriptionDetail.medication_id,
+                Medication.medication_name,
+                PrescriptionDetail.presc_dose,
+                PrescriptionDetail.presc_type,
+                PrescriptionDetail.presc_frequency,
+                PrescriptionDetail.presc_schedule,
+            )
+            .join(PrescriptionDetail, PrescriptionDetail.prescription_id == Prescription.prescription_id)
+            .outerjoin(Medication, Medication.medication_id == PrescriptionDetail.medication_id)
+            .where(Prescription.user_id == user_id, Prescription.prescription_status == PRESCRIPTION_STATUS_ACTIVE)
+            .order_by(Prescription.prescription_id, PrescriptionDetail.medication_id)
+        )
+
+    # The user's rows -- from the rows cache while the user's change counter has not moved
+    async def _user_rows(self, db: AsyncSession, user_id: str) -> list:
+        result = await db.execute(select(SyncCounter.change_seq).where(SyncCounter.user_id == user_id))
+        change_seq = result.scalar_one_or_none()
+        cached = self.rows.get(user_id)
+        if cached is not None and cached[0] == change_seq:
+            return cached[1]
+        result = await db.execute(self._rows_query(user_id))
+        rows = result.all()
+        self.rows.set(user_id, (change_seq, rows))
+        self.row_reads += 1
+        return rows
+
+    # Events of one prescription inside the window -- sliced from the cached span when it covers the window
+    def _events(self, prescription_id: int, rows: list, date_from: date, date_to: date) -> List[Dict[str, Any]]:
+        version = tuple(tuple(row) for row in rows)  # any change to the prescription or its details makes a new version
+        cached = self.expansions.get(prescription_id)
+        if cached is not None and cached[0] == version and cached[1] <= date_from and date_to <= cached[2]:
+            self.reused += 1
+            _, _, _, times, events = cached
+        else:
+            span_from = date_from - timedelta(days=EXPANSION_MARGIN_DAYS)
+            span_to = date_to + timedelta(days=EXPANSION_MARGIN_DAYS)
+            events = expand_prescription(rows, span_from, span_to)
+            times = [event["dose_time"] for event in events]
+            self.expansions.set(prescription_id, (version, span_from, span_to, times, events))
+            self.expanded += 1
+        start = bisect.bisect_left(times, datetime.combine(date_from, time.min))
+        end = bisect.bisect_right(times, datetime.combine(date_to, time.max))
+        return events[start:end]
+
+    async def _build(self, db: AsyncSession, user_id: str, date_from: date, date_to: date) -> bytes:
+        per_prescription = []
+        for prescription_id, rows in groupby(await self._user_rows(db, user_id), key=lambda row: row.prescription_id):
+            rows = list(rows)
+            start, end = rows[0].prescription_date_start, rows[0].prescription_date_end
+            if (start is not None and start > date_to) or (end is not None and end < date_from):
+                continue  # not in the window
+            per_prescription.append(self._events(prescription_id, rows, date_from, date_to))
+        self.builds += 1
+        return dump_json(list(heapq.merge(*per_prescription, key=_event_order)))
+
+    def _generation(self, user_id: str) -> int:
+        generation = self.generations.get(user_id)
+        if generation is None:
+            generation = next(self._counter)
+            self.generations.set(user_id, generation)
+        return generation
+
+    # The user's calendar for the window as JSON bytes (a list of DoseEventRead)
+    async def get(self, db: AsyncSession, user_id: str, date_from: date, date_to: date) -> bytes:
+        window = (date_from, date_to)
+        windows: Optional[dict] = self.calendars.get(user_id)
+        if windows is not None and window in windows:
+            return windows[window]
+
+        generation = self._generation(user_id)
+        content = await self._build(db, user_id, date_from, date_to)
+        # The user wrote something while this was being built -- it may be missing from the rows, don't cache it
+        if generation == self._generation(user_id):
+            windows = self.calendars.get(user_id)
+            if windows is None:
+                windows = {}
+                self.calendars.set(user_id, windows)
+            windows[window] = content
+            while len(windows) > CALENDAR_WINDOWS_PER_USER:
+                windows.pop(next(iter(windows)))
+        return content
+
+    # Drop the cached calendars and rows of a user (after one of the user's prescriptions or details is written)
+    # the expansions stay -- they are only used again if their version still matches the rows
+    def invalidate(self, user_id: str) -> None:
+        self.generations.set(user_id, next(self._counter))
+        self.calendars.pop(user_id)
+        self.rows.pop(user_id)
+
+    def metrics(self) -> dict:
+        return {
+            "calendars": self.calendars.stats(),
+            "rows": self.rows.stats(),
+            "expansions": self.expansions.stats(),
+            "builds": self.builds,
+            "row_reads": self.row_reads,
+            "prescriptions_expanded": self.expanded,
+            "prescriptions_reused": self.reused,
+        }
+
+
+# Shared calendar used by the API
+dose_calendar = DoseCalendar()
@@ -0,0 +1,281 @@
+# this is the file for turning the free text dosing fields of a prescription detail into a schedule
+# presc_frequency ("twice a day", "every 8 hours", "8am and 8pm") and presc_dose / presc_type
+# ("10mg", "0.5 g", "2" + "Drops") are parsed once, when the detail is written, into a DoseSchedule:
+#   doses_per_day  -- 2.0, 3.0, 0.5 (every other day) ...
+#   interval_hours -- hours between doses
+#   times_of_day   -- minutes after midnight for each dose (defaults spread over the waking day)
+#   amount, unit   -- amount per dose normalized to mg / ml (or a count unit like tablet / drop)
+# The schedule is stored with the detail in two columns:
+#   presc_doses_per_day -- a plain number so bulk jobs (refill_forecast.py) can do array math on it
+#   presc_schedule      -- a compact encoding of the whole schedule, eg. "2|12|480,1200|10|mg"
+# decode_schedule() turns the encoding back into a DoseSchedule and is cached, so reading schedules in
+# a loop does no string parsing after the first time a schedule is seen.
+import asyncio
+import logging
+import re
+from functools import lru_cache
+from typing import NamedTuple, Optional, Tuple
+from sqlalchemy import update
+from sqlalchemy.future import select
+from .models import PrescriptionDetail
+from .pagination import keyset_after
+
+logger = logging.getLogger(__name__)
+
+DAY_START_MINUTES = 8 * 60        # first dose of the day when the frequency doesn't say (08:00)
+DAY_END_MINUTES = 20 * 60         # last dose of the day for spread out doses (20:00)
+SCHEDULE_CACHE_SIZE = 4096        # distinct (frequency, dose, type) / encoded schedules kept in memory
+BACKFILL_CHUNK_SIZE = 5000        # details updated per statement by backfill_schedules()
+SCHEDULE_MAX_LENGTH = 160         # size of the presc_schedule column
+MAX_DOSES_PER_DAY = 24 * 60       # more doses a day than this (one a minute) can't be read -- nothing sane asks for it
+MIN_INTERVAL_HOURS = 1 / 60       # "every N hours" below a minute can't be read either
+
+# Fields of a prescription detail the schedule is built from -- it has to be rebuilt when one of them changes
+SCHEDULE_SOURCE_FIELDS = {"presc_frequency", "presc_dose", "presc_type"}
+
+
+class DoseSchedule(NamedTuple):
+    doses_per_day: Optional[float]
+    interval_hours: Optional[float]
+    times_of_day: Tuple[int, ...]     # minutes after midnight
+    amount: Optional[float]           # per dose, in unit
+    unit: Optional[str]               # mg, ml or a count unit (tablet, capsule, drop, puff, unit)
+
+    @property
+    def daily_amount(self) -> Optional[float]:
+        if self.amount is None or self.doses_per_day is None:
+            return None
+        return self.amount * self.doses_per_day
+
+
+EMPTY_SCHEDULE = DoseSchedule(None, None, (), None, None)
+
+_WORD_NUMBERS = {"once": 1, "twice": 2, "thrice": 3, "one": 1, "two": 2, "three": 3, "four": 4, "five": 5, "six": 6}
+
+# Named times of day -> minutes after midnight
+_NAMED_TIMES = {
+    "morning": 8 * 60, "breakfast": 8 * 60, "noon": 12 * 60, "lunch": 12 * 60, "midday": 12 * 60,
+    "afternoon": 15 * 60, "evening": 18 * 60, "dinner": 18 * 60, "supper": 18 * 60,
+    "night": 22 * 60, "bedtime": 22 * 60, "nightly": 22 * 60,
+}
+
+# Dose units -> (normalized unit, factor to get there)
+_UNITS = {
+    "mg": ("mg", 1.0), "milligram": ("mg", 1.0), "milligrams": ("mg", 1.0),
+    "g": ("mg", 1000.0), "gram": ("mg", 1000.0), "grams": ("mg", 1000.0),
+    "mcg": ("mg", 0.001), "ug": ("mg", 0.001), "µg": ("mg", 0.001), "microgram": ("mg", 0.001), "micrograms": ("mg", 0.001),
+    "kg": ("mg", 1000000.0),
+    "ml": ("ml", 1.0), "milliliter": ("ml", 1.0), "milliliters": ("ml", 1.0), "millilitre": ("ml", 1.0), "millilitres": ("ml", 1.0),
+    "l": ("ml", 1000.0), "liter": ("ml", 1000.0), "litre": ("ml", 1000.0),
+    "tsp": ("ml", 5.0), "teaspoon": ("ml", 5.0), "teaspoons": ("ml", 5.0),
+    "tbsp": ("ml", 15.0), "tablespoon": ("ml", 15.0), "tablespoons": ("ml", 15.0),
+    "drop": ("drop", 1.0), "drops": ("drop", 1.0), "gtt": ("drop", 1.0),
+    "tablet": ("tablet", 1.0), "tablets": ("tablet", 1.0), "tab": ("tablet", 1.0), "tabs": ("tablet", 1.0),
+    "pill": ("tablet", 1.0), "pills": ("tablet", 1.0),
+    "capsule": ("capsule", 1.0), "capsules": ("capsule", 1.0), "cap": ("capsule", 1.0), "caps": ("capsule", 1.0),
+    "puff": ("puff", 1.0), "puffs": ("puff", 1.0),
+    "unit": ("unit", 1.0), "units": ("unit", 1.0), "iu": ("unit", 1.0),
+}
+
+_CLOCK_TIME = re.compile(r"\b(\d{1,2})(?::(\d{2}))?\s*(am|pm)\b|\b(\d{1,2}):(\d{2})\b")
+_INTERVAL = re.compile(r"every\s+(\d+(?:\.\d+)?)?\s*(hour|hr|h|day|week)s?\b")
+_COUNT = re.compile(r"\b(\d+|once|twice|thrice|one|two|three|four|five|six)\s*(?:x|times?)?\s*(?:a|per|/)?\s*(day|daily|week|weekly)?\b")
+_AMOUNT = re.compile(r"(\d+(?:\.\d+)?|\.\d+)\s*([a-zµ]+)?")
+
+
+# Explicit times in the text: "8am and 8pm", "at 21:00", "morning and bedtime"
+def _explicit_times(text: str) -> Tuple[int, ...]:
+    times = set()
+    for match in _CLOCK_TIME.finditer(text):
+        if match.group(3):
+            hour = int(match.group(1)) % 12 + (12 if match.group(3) == "pm" else 0)
+            minute = int(match.group(2) or 0)
+        else:
+            hour, minute = int(match.group(4)), int(match.group(5))
+        if hour < 24 and minute < 60:
+            times.add(hour * 60 + minute)
+    for word, minutes in _NAMED_TIMES.items():
+        if re.search(rf"\b{word}\b", text):
+            times.add(minutes)
+    return tuple(sorted(times))
+
+
+# Doses spread over the waking day: 1 -> 08:00, 2 -> 08:00 + 20:00, 3 -> 08:00 + 14:00 + 20:00 ...
+# interval_hours (every N hours) is used as is from the first dose, around the clock
+def _default_times(doses_per_day: float, interval_hours: Optional[float]) -> Tuple[int, ...]:
+    if doses_per_day <= 1:
+        return (DAY_START_MINUTES,)
+    if interval_hours is not None:
+        step = int(round(interval_hours * 60))
+        return tuple(sorted((DAY_START_MINUTES + i * step) % (24 * 60) for i in range(int(round(doses_per_day)))))
+    count = int(round(doses_per_day))
+    step = (DAY_END_MINUTES - DAY_START_MINUTES) / (count - 1)
+    return tuple(int(round(DAY_START_MINUTES + i * step)) for i in range(count))
+
+
+# presc_frequency -> (doses per day, hours between doses, times of day), None doses per day if it can't be read
+def parse_frequency(frequency: Optional[str]) -> Tuple[Optional[float], Optional[float], Tuple[int, ...]]:
+    if not frequency:
+        return None, None, ()
+    text = frequency.strip().lower()
+    times = _explicit_times(text)
+    doses_per_day = None
+    interval_hours = None
+
+    interval = _INTERVAL.search(text)
+    if "every other day" in text:
+        doses_per_day = 0.5
+    elif interval:
+        every = float(interval.group(1) or 1)
+        unit = interval.group(2)
+        interval_hours = every if unit in ("hour", "hr", "h") else every * 24 if unit == "day" else every * 24 * 7
+        if interval_hours < MIN_INTERVAL_HOURS:
+            return None, None, ()  # "every 0 hours" -- also keeps 24 / interval_hours from dividing by zero
+        doses_per_day = 24 / interval_hours
+    else:
+        # "<count> [x|times] [a|per] day/week" -- the first count followed by a period wins ("1 tablet 3 times a day")
+        for match in _COUNT.finditer(text):
+            count, period = match.groups()
+            if period is None and count not in ("once", "twice", "thrice"):
+                continue
+            count = float(count) if count.isdigit() else float(_WORD_NUMBERS[count])
+            doses_per_day = count / 7 if period in ("week", "weekly") else count
+            break
+
+    if doses_per_day is None:
+        if times:
+            doses_per_day = float(len(times))      # "8am and 8pm", "morning and night"
+        elif re.search(r"\b(daily|qd|a day)\b", text):
+            doses_per_day = 1.0
+        elif re.search(r"\bweekly\b", text):
+            doses_per_day = 1 / 7
+        else:
+            return None, None, ()
+
+    # "0 times a day", "2000000 times a day" -- unreadable like any other text, and the times of day below are
+    # built one per dose, so a huge count must never get that far
+    if not 0 < doses_per_day <= MAX_DOSES_PER_DAY:
+        return None, None, ()
+
+    if not times:
+        times = _default_times(doses_per_day, interval_hours)  # only set yet for "every N hours"
+    if interval_hours is None and doses_per_day > 0:
+        interval_hours = 24 / doses_per_day
+    return doses_per_day, interval_hours, times
+
+
+# presc_dose (+ presc_type when the dose has no unit) -> (amount per dose, normalized unit)
+def parse_dose(dose: Optional[str], presc_type: Optional[str] = None) -> Tuple[Optional[float], Optional[str]]:
+    if not dose:
+        return None, None
+    match = _AMOUNT.search(dose.strip().lower())
+    if not match:
+        return None, None
+    amount = float(match.group(1))
+    unit_text = match.group(2) or (presc_type.strip().lower() if presc_type else None)
+    if unit_text is None:
+        return amount, None
+    unit = _UNITS.get(unit_text)
+    if unit is None:
+        return amount, unit_text[:10]  # unknown unit -- kept as written
+    name, factor = unit
+    return round(amount * factor, 6), name
+
+
+# The full schedule for one prescription detail -- cached, the same strings come up over and over
+@lru_cache(maxsize=SCHEDULE_CACHE_SIZE)
+def parse_schedule(frequency: Optional[str], dose: Optional[str] = None, presc_type: Optional[str] = None) -> DoseSchedule:
+    doses_per_day, interval_hours, times = parse_frequency(frequency)
+    amount, unit = parse_dose(dose, presc_type)
+    return DoseSchedule(doses_per_day, interval_hours, times, amount, unit)
+
+
+def _number(value: Optional[float]) -> str:
+    return "" if value is None else f"{value:.10g}"
+
+# DoseSchedule -> compact string for presc_schedule, eg. "2|12|480,1200|10|mg"
+def encode_schedule(schedule: DoseSchedule) -> Optional[str]:
+    if schedule == EMPTY_SCHEDULE:
+        return None
+    fields = [
+        _number(schedule.doses_per_day),
+        _number(schedule.interval_hours),
+        ",".join(str(t) for t in schedule.times_of_day),
+        _number(schedule.amount),
+        schedule.unit or "",
+    ]
+    if len("|".join(fields)) > SCHEDULE_MAX_LENGTH:
+        fields[2] = ""  # too many doses a day to list -- interval_hours still says when they are
+    return "|".join(fields)
+
+# presc_schedule -> DoseSchedule -- cached so hot loops only pay for each distinct schedule once
+@lru_cache(maxsize=SCHEDULE_CACHE_SIZE)
+def decode_schedule(encoded: Optional[str]) -> DoseSchedule:
+    if not encoded:
+        return EMPTY_SCHEDULE
+    doses_per_day, interval_hours, times, amount, unit = encoded.split("|")
+    return DoseSchedule(
+        float(doses_per_day) if doses_per_day else None,
+        float(interval_hours) if interval_hours else None,
+        tuple(int(t) for t in times.split(",")) if times else (),
+        float(amount) if amount else None,
+        unit or None,
+    )
+
+
+# Column values to store with a prescription detail
+def schedule_columns(frequency: Optional[str], dose: Optional[str], presc_type: Optional[str]) -> dict:
+    schedule = parse_schedule(frequency, dose, presc_type)
+    return {"presc_doses_per_day": schedule.doses_per_day, "presc_schedule": encode_schedule(schedule)}
+
+
+# Fill in the schedule columns for details written before they existed (or before a parser change)
+# python -m <package>.dosing
+async def backfill_schedules(session_factory=None, chunk_size: int = BACKFILL_CHUNK_SIZE, rebuild: bool = False) -> int:
+    from .database import AsyncSessionLocal
+    session_factory = session_factory or AsyncSessionLocal
+    query = select(
+        PrescriptionDetail.prescription_id,
+        PrescriptionDetail.medication_id,
+        PrescriptionDetail.presc_frequency,
+        PrescriptionDetail.presc_dose,
+        PrescriptionDetail.presc_type,
+    )
+    if not rebuild:
+        query = query.where(PrescriptionDetail.presc_schedule.is_(None))
+    sort_key = (PrescriptionDetail.prescription_id, PrescriptionDetail.medication_id)
+
+    updated = 0
+    after = None
+    async with session_factory() as session:
+        while True:
+            chunk_query = query if after is None else query.where(keyset_after(sort_key, after))
+            rows = (await session.execute(chunk_query.order_by(*sort_key).limit(chunk_size))).all()
+            if not rows:
+                break
+            after = (rows[-1].prescription_id, rows[-1].medication_id)
+            params = []
+            for row in rows:
+                columns = schedule_columns(row.presc_frequency, row.presc_dose, row.presc_type)
+                if columns["presc_schedule"] is None and not rebuild:
+                    continue  # nothing readable -- stays NULL
+                params.append({"prescription_id": row.prescription_id, "medication_id": row.medication_id, **columns})
+            if params:
+                await session.execute(update(PrescriptionDetail), params)  # bulk UPDATE by primary key (executemany)
+                await session.commit()
+                updated += len(params)
+    logger.info("Dose schedules backfilled for %s prescription details", updated)
+    return updated
+
+
+async def main():
+    from .database import close_connections
+    try:
+        print(f"Updated {await backfill_schedules()} prescription details")
+    finally:
+        await close_connections()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(main())
@@ -0,0 +1,116 @@
+# this is the file for exporting everything we have stored for one user
+# the export is written as NDJSON (one JSON object per line) and streamed to the client while
+# the rows are still being read with server side cursors, so memory use does not grow with the
+# size of the user's history. Each line looks like {"type": "prescription", "data": {...}}
+import logging
+from typing import AsyncIterator
+from sqlalchemy.future import select
+from .database import read_sessionmaker
+from .models import Prescription, PrescriptionDetail, Medication, SideEffect, Notification
+from .schemas import PrescriptionRead, PrescriptionDetailRead, SideEffectRead, NotificationRead
+
+logger = logging.getLogger(__name__)
+
+EXPORT_BATCH_SIZE = 500  # Rows fetched from the server side cursor at a time
+
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+
+
+def _line(record_type: str, model) -> bytes:
+    return b'{"type":"' + record_type.encode() + b'","data":' + model.model_dump_json().encode() + b"}\n"
+
+
+# Prescriptions with their details and medication names -- one line per prescription
+# rows come back ordered by prescription_id so the details of one prescription are next to each other
+async def _export_prescriptions(session, user_id: str) -> AsyncIterator[bytes]:
+    query = (
+        select(
+            Prescription.prescription_id,
+            Prescription.user_id,
+            Prescription.prescription_date_start,
+            Prescription.prescription_date_end,
+            Prescription.prescription_status,
+            PrescriptionDetail.medication_id,
+            PrescriptionDetail.presc_dose,
+            PrescriptionDetail.presc_qty,
+            PrescriptionDetail.presc_type,
+            PrescriptionDetail.presc_frequency,
+            Medication.medication_name,
+        )
+        .outerjoin(PrescriptionDetail, PrescriptionDetail.prescription_id == Prescription.prescription_id)
+        .outerjoin(Medication, Medication.medication_id == PrescriptionDetail.medication_id)
+        .where(Prescription.user_id == user_id)
+        .order_by(Prescription.prescription_id, PrescriptionDetail.medication_id)
+        .execution_options(stream_results=True, yield_per=EXPORT_BATCH_SIZE)
+    )
+    result = await session.stream(query)
+
+    current = None
+    async for row in result:
+        if current is None or current.prescription_id != row.prescription_id:
+            if current is not None:
+                yield _line("prescription", current)
+            current = PrescriptionRead(
+                prescription_id=row.prescription_id,
+                user_id=row.user_id,
+                prescription_date_start=row.prescription_date_start,
+                prescription_date_end=row.prescription_date_end,
+                prescription_status=row.prescription_status,
+                prescription_details=[],
+            )
+        # Outer join -- a prescription without details has one row with NULL detail columns
+        if row.medication_id is not None:
+            current.prescription_details.append(PrescriptionDetailRead(
+                prescription_id=row.prescription_id,
+                medication_id=row.medication_id,
+                medication_name=row.medication_name,
+                presc_dose=row.presc_dose,
+                presc_qty=row.presc_qty,
+                presc_type=row.presc_type,
+                presc_frequency=row.presc_frequency,
+            ))
+    if current is not None:
+        yield _line("prescription", current)
+
+
+async def _export_side_effects(session, user_id: str) -> AsyncIterator[bytes]:
+    query = (
+        select(SideEffect)
+        .where(SideEffect.user_id == user_id)
+        .order_by(SideEffect.side_effects_id)
+        .execution_options(stream_results=True, yield_per=EXPORT_BATCH_SIZE)
+    )
+    result = await session.stream_scalars(query)
+    async for side_effect in result:
+        yield _line("side_effect", SideEffectRead.model_validate(side_effect))
+
+
+async def _export_notifications(session, user_id: str) -> AsyncIterator[bytes]:
+    query = (
+        select(Notification)
+        .where(Notification.user_id == user_id)
+        .order_by(Notification.notification_id)
+        .execution_options(stream_results=True, yield_per=EXPORT_BATCH_SIZE)
+    )
+    result = await session.stream_scalars(query)
+    async for notification in result:
+        yield _line("notification", NotificationRead.model_validate(notification))
+
+
+# Stream every record for the user as NDJSON lines
+# This opens its own session: the response body is produced after the endpoint returns,
+# and by then the request's get_db session has already been closed.
+# Read from the replica unless the user has just written something (see read_sessionmaker in database.py)
+async def export_user_records(user_id: str) -> AsyncIterator[bytes]:
+    async with read_sessionmaker(user_id)() as session:
+        try:
+            async for line in _export_prescriptions(session, user_id):
+                yield line
+            async for line in _export_side_effects(session, user_id):
+                yield line
+            async for line in _export_notifications(session, user_id):
+                yield line
+        except Exception:
+            # Headers are already sent so we can't return an error status -- log it and end the stream
+            logger.exception("Export failed for user %s", user_id)
+            raise
@@ -0,0 +1,145 @@
+# this is the file for running password hashing off the event loop
+# bcrypt is slow on purpose (~200ms+ per hash) and passlib runs it synchronously,
+# so calling it directly inside an async handler blocks every other request on the worker.
+# Here the work is handed to a bounded thread or process pool and awaited instead.
+import asyncio
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from fastapi import HTTPException, status
+from passlib.context import CryptContext
+
+logger = logging.getLogger(__name__)
+
+# Pool settings -- "thread" works well because bcrypt releases the GIL while hashing,
+# "process" can be used if hashing ever becomes CPU bound in python code
+PASSWORD_HASH_POOL_KIND = "thread"
+PASSWORD_HASH_POOL_WORKERS = 4      # Number of hashes that can run at the same time
+PASSWORD_HASH_MAX_QUEUE = 64        # Requests allowed to wait for a worker before we reject with 503
+PASSWORD_HASH_TIMEOUT_SECONDS = 5   # Max time (queue wait + hashing) before we give up with 503
+
+# Initialize password hashing context (bcrypt)
+# kept at module level so process pool workers can build their own copy on import
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+
+
+# Worker functions -- module level so they can be pickled for the process pool
+def _hash(password: str) -> str:
+    return pwd_context.hash(password)
+
+def _verify(plain_password: str, hashed_password: str) -> bool:
+    return pwd_context.verify(plain_password, hashed_password)
+
+
+class PasswordHasher:
+    def __init__(self, kind: str = PASSWORD_HASH_POOL_KIND, workers: int = PASSWORD_HASH_POOL_WORKERS,
+                 max_queue: int = PASSWORD_HASH_MAX_QUEUE, timeout: float = PASSWORD_HASH_TIMEOUT_SECONDS):
+        if kind not in ("thread", "process"):
+            raise ValueError(f"Unknown password hash pool kind: {kind}")
+        self.kind = kind
+        self.workers = workers
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self._executor = None
+        # Jobs that are running or waiting for a worker (bounded by workers + max_queue)
+        self._pending = 0
+        # Per-pool metrics
+        self.submitted = 0
+        self.completed = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.failed = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+
+    # The pool is created on first use so importing the app does not fork processes
+    def _get_executor(self):
+        if self._executor is None:
+            if self.kind == "process":
+                self._executor = ProcessPoolExecutor(max_workers=self.workers)
+            else:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="pwd-hash")
+        return self._executor
+
+    async def _run(self, func, *args):
+        # Reject straight away when the queue is full instead of letting requests pile up
+        if self._pending >= self.workers + self.max_queue:
+            self.rejected += 1
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="Server is busy, please try again shortly.",
+                headers={"Retry-After": "1"},
+            )
+
+        start = time.perf_counter()
+        loop = asyncio.get_running_loop()
+        job = self._get_executor().submit(func, *args)
+        # A job still counts after wait_for gives up on it -- it keeps its worker (or its place in the queue)
+        # until it finishes or is cancelled, so _pending only goes down when the job itself is done
+        self._pending += 1
+        self.submitted += 1
+        job.add_done_callback(lambda _: self._job_done(loop))
+        try:
+            result = await asyncio.wait_for(asyncio.wrap_future(job), timeout=self.timeout)
+        except asyncio.TimeoutError:
+            self.timed_out += 1
+            logger.warning("Password hashing timed out after %ss (%s pool)", self.timeout, self.kind)
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="Server is busy, please try again shortly.",
+                headers={"Retry-After": "1"},
+            )
+        except HTTPException:
+            raise
+        except Exception:
+            self.failed += 1
+            raise
+
+        elapsed = time.perf_counter() - start
+        self.completed += 1
+        self.total_seconds += elapsed
+        self.max_seconds = max(self.max_seconds, elapsed)
+        return result
+
+    # Runs in the pool thread that finished the job -- the counter is only changed on the event loop
+    def _job_done(self, loop):
+        try:
+            loop.call_soon_threadsafe(self._release_slot)
+        except RuntimeError:  # loop already closed (shutdown)
+            pass
+
+    def _release_slot(self):
+        self._pending -= 1
+
+    # Hash a password without blocking the event loop
+    async def hash(self, password: str) -> str:
+        return await self._run(_hash, password)
+
+    # Verify a password without blocking the event loop
+    async def verify(self, plain_password: str, hashed_password: str) -> bool:
+        return await self._run(_verify, plain_password, hashed_password)
+
+    def metrics(self) -> dict:
+        return {
+            "pool": self.kind,
+            "workers": self.workers,
+            "max_queue": self.max_queue,
+            "pending": self._pending,
+            "submitted": self.submitted,
+            "completed": self.completed,
+            "rejected": self.rejected,
+            "timed_out": self.timed_out,
+            "failed": self.failed,
+            "avg_seconds": round(self.total_seconds / self.completed, 4) if self.completed else 0.0,
+            "max_seconds": round(self.max_seconds, 4),
+        }
+
+    # Called on app shutdown
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+# Shared hasher used by the API
+password_hasher = PasswordHasher()
@@ -0,0 +1,183 @@
+# this is the file for checking drug-drug interactions when a medication is added to a prescription
+# The interactions come from a local CSV file (INTERACTIONS_FILE) with one row per interacting pair:
+#   medication_id_a,medication_id_b,severity,description
+#   12,40,major,Increased risk of bleeding
+# severity is minor / moderate / major. The file is loaded into an InteractionIndex:
+#   - every medication that has an interaction gets a dense index 0..n-1
+#   - each of them has a bitset (a Python int) with a bit set for every medication it interacts with
+# Checking a new medication against all of the user's active medications is one AND of its bitset with the
+# bitset of the user's medications -- only the bits left over are looked up for their severity / description.
+# Memory is at most n * n / 8 bytes (a 3000 medication table is ~1 MB).
+# The file is checked for changes every INTERACTIONS_RELOAD_SECONDS and reloaded when it changed.
+import csv
+import logging
+import os
+import time
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.future import select
+from .catalog import medication_catalog
+from .models import Prescription, PrescriptionDetail
+from .schemas import InteractionWarning
+
+logger = logging.getLogger(__name__)
+
+# CSV of interacting pairs -- interactions.csv next to this file unless INTERACTIONS_FILE is set in the environment
+INTERACTIONS_FILE = os.environ.get("INTERACTIONS_FILE") or os.path.join(os.path.dirname(os.path.abspath(__file__)), "interactions.csv")
+INTERACTIONS_RELOAD_SECONDS = 300    # How often the file is checked for changes
+PRESCRIPTION_STATUS_ACTIVE = 0       # prescription_status: 0 = active, 1 = archive
+
+SEVERITY_RANK = {"major": 3, "moderate": 2, "minor": 1}  # warnings are listed most severe first
+
+
+class Interaction(NamedTuple):
+    medication_id: int
+    interacting_medication_id: int
+    severity: str
+    description: Optional[str]
+
+
+class InteractionIndex:
+    def __init__(self, pairs: Iterable[Tuple[int, int, str, Optional[str]]] = ()):
+        self._positions: Dict[int, int] = {}       # medication_id -> dense index
+        self._medication_ids: List[int] = []        # dense index -> medication_id
+        self._bits: List[int] = []                  # dense index -> bitset of interacting medications
+        self._details: Dict[Tuple[int, int], Tuple[str, Optional[str]]] = {}  # (lower id, higher id) -> (severity, description)
+        for medication_id_a, medication_id_b, severity, description in pairs:
+            if medication_id_a == medication_id_b:
+                continue
+            a, b = self._position(medication_id_a), self._position(medication_id_b)
+            self._bits[a] |= 1 << b
+            self._bits[b] |= 1 << a
+            key = (min(medication_id_a, medication_id_b), max(medication_id_a, medication_id_b))
+            current = self._details.get(key)
+            # a pair listed twice keeps its most severe entry
+            if current is None or SEVERITY_RANK.get(severity, 0) > SEVERITY_RANK.get(current[0], 0):
+                self._details[key] = (severity, description)
+
+    def _position(self, medication_id: int) -> int:
+        position = self._positions.get(medication_id)
+        if position is None:
+            position = self._positions[medication_id] = len(self._medication_ids)
+            self._medication_ids.append(medication_id)
+            self._bits.append(0)
+        return position
+
+    def __len__(self) -> int:
+        return len(self._details)
+
+    def has_interactions(self, medication_id: int) -> bool:
+        return medication_id in self._positions
+
+    # Bitset of a group of medications (medications without any interaction are left out)
+    def mask(self, medication_ids: Iterable[int]) -> int:
+        bits = 0
+        for medication_id in medication_ids:
+            position = self._positions.get(medication_id)
+            if position is not None:
+                bits |= 1 << position
+        return bits
+
+    # Interactions of one medication with any medication in the mask, most severe first
+    def check(self, medication_id: int, other_mask: int) -> List[Interaction]:
+        position = self._positions.get(medication_id)
+        if position is None:
+            return []
+        hits = self._bits[position] & other_mask & ~(1 << position)
+        interactions = []
+        while hits:
+            low_bit = hits & -hits
+            other_id = self._medication_ids[low_bit.bit_length() - 1]
+            severity, description = self._details[(min(medication_id, other_id), max(medication_id, other_id))]
+            interactions.append(Interaction(medication_id, other_id, severity, description))
+            hits ^= low_bit
+        interactions.sort(key=lambda i: (-SEVERITY_RANK.get(i.severity, 0), i.interacting_medication_id))
+        return interactions
+
+
+# Rows of an interaction CSV file -> (medication_id_a, medication_id_b, severity, description)
+def read_interaction_file(path: str):
+    with open(path, newline="", encoding="utf-8") as file:
+        for line_number, row in enumerate(csv.DictReader(file), start=2):
+            try:
+                yield (
+                    int(row["medication_id_a"]),
+                    int(row["medication_id_b"]),
+                    (row.get("severity") or "moderate").strip().lower(),
+                    (row.get("description") or "").strip() or None,
+                )
+            except (KeyError, TypeError, ValueError):
+                logger.warning("Skipping bad interaction row %s in %s: %s", line_number, path, row)
+
+
+class InteractionChecker:
+    def __init__(self, path: str = INTERACTIONS_FILE, reload_seconds: float = INTERACTIONS_RELOAD_SECONDS):
+        self.path = path
+        self.reload_seconds = reload_seconds
+        self._index = InteractionIndex()
+        self._loaded_mtime: Optional[float] = None
+        self._checked_at: Optional[float] = None
+        self._missing = False
+
+    # The current index -- (re)loads the file the first time and when it has changed since the last load
+    def get(self) -> InteractionIndex:
+        now = time.monotonic()
+        if self._checked_at is not None and now - self._checked_at < self.reload_seconds:
+            return self._index
+        self._checked_at = now
+        try:
+            mtime = os.path.getmtime(self.path)
+        except OSError:
+            if not self._missing:
+                logger.warning("Interaction file %s not found -- interaction checks are off", self.path)
+            self._index, self._loaded_mtime, self._missing = InteractionIndex(), None, True
+            return self._index
+        self._missing = False
+        if mtime != self._loaded_mtime:
+            self.load(mtime)
+        return self._index
+
+    def load(self, mtime: Optional[float] = None):
+        started = time.perf_counter()
+        self._index = InteractionIndex(read_interaction_file(self.path))
+        self._loaded_mtime = mtime if mtime is not None else os.path.getmtime(self.path)
+        logger.info("Loaded %s drug interactions from %s in %.3fs", len(self._index), self.path, time.perf_counter() - started)
+
+
+# Shared checker used by the API
+interaction_checker = InteractionChecker()
+
+
+# Interaction warnings for medications about to be added for a user, {medication_id: [InteractionWarning]}
+# each one is checked against every medication on the user's active prescriptions and against the other new ones
+# the user's medications are only read when one of the new medications has any interaction at all
+async def interaction_warnings(db: AsyncSession, user_id: str, medication_ids: List[int]) -> Dict[int, List[InteractionWarning]]:
+    index = interaction_checker.get()
+    to_check = [medication_id for medication_id in medication_ids if index.has_interactions(medication_id)]
+    if not to_check:
+        return {}
+
+    result = await db.execute(
+        select(PrescriptionDetail.medication_id)
+        .join(Prescription, Prescription.prescription_id == PrescriptionDetail.prescription_id)
+        .where(Prescription.user_id == user_id, Prescription.prescription_status == PRESCRIPTION_STATUS_ACTIVE)
+        .distinct()
+    )
+    mask = index.mask(set(result.scalars().all()) | set(medication_ids))
+
+    found = {medication_id: index.check(medication_id, mask) for medication_id in to_check}
+    names = await medication_catalog.get_medications(db, {i.interacting_medication_id for hits in found.values() for i in hits})
+    return {
+        medication_id: [
+            InteractionWarning(
+                medication_id=medication_id,
+                interacting_medication_id=i.interacting_medication_id,
+                interacting_medication_name=names[i.interacting_medication_id].medication_name if i.interacting_medication_id in names else None,
+                severity=i.severity,
+                description=i.description,
+            )
+            for i in hits
+        ]
+        for medication_id, hits in found.items()
+        if hits
+    }
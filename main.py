@@ -1,58 +1,89 @@
 
-from typing import List
+from typing import List, Optional
 import logging
-from sqlalchemy.exc import SQLAlchemyError
-from fastapi import FastAPI, HTTPException, Depends, status, Response
-from fastapi.responses import JSONResponse
-from sqlalchemy import delete
+from sqlalchemy.exc import SQLAlchemyError, IntegrityError
+from fastapi import FastAPI, HTTPException, Depends, status, Response, Request, Query
+from fastapi.responses import JSONResponse, StreamingResponse
+from sqlalchemy import delete, insert, update
 from sqlalchemy.orm import selectinload
 from sqlalchemy.orm import joinedload
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.future import select
-from datetime import datetime, timezone
+from datetime import datetime, timezone, date
 from .models import User  # SQLAlchemy model for User
 from .models import Notification  # SQLAlchemy model for Notification
 from .models import Medication  # SQLAlchemy model for Medication
 from .models import Prescription # SQLAlchemy model for Prescription 
 from .models import PrescriptionDetail # SQLAlchemy model for PrescriptionDetail 
 from .models import SideEffect # SQLAlchemy model for Side Effect
+from .models import SyncTombstone, SyncCounter # SQLAlchemy models for deleted rows and change counters (GET /sync)
 #import models 
 from .schemas import UserCreate, UserUpdate, UserRead, UserDelete, UserDeleteResponse, PasswordUpdateResponse, Token, UserResponse, UserLogin # Pydantic models
 from .schemas import SideEffectCreate, SideEffectRead, SideEffectUpdate, SideEffectDelete, SideEffectDeleteResponse
+from .schemas import SideEffectMedicationCount, SideEffectMedicationStats, SideEffectDayCount, SideEffectDescCount
 from .schemas import NotificationCreate, NotificationUpdate, NotificationRead, NotificationDelete, NotificationDeleteResponse  # Pydantic schemas
 from .schemas import MedicationRead  # Pydantic schema for Medication
 from .schemas import PrescriptionCreate, PrescriptionUpdate, PrescriptionRead, PrescriptionDelete, PrescriptionDeleteResponse # Pydantic schemas for Prescription 
 from .schemas import PrescriptionDetailCreate, PrescriptionDetailUpdate, PrescriptionDetailRead, PrescriptionDetailDelete, PrescriptionDetailDeleteResponse# Pydantic schemas for PrescriptionDetail
-from .database import get_db  # Async database session
+from .schemas import DoseEventRead  # Pydantic schema for the dose calendar
+from .schemas import PrescriptionDetailCreateResponse  # PrescriptionDetailRead + drug interaction warnings
+from .schemas import SyncResponse  # Rows changed since the last sync
+from .database import get_db, get_read_db  # Async database sessions (primary / read replica)
 from passlib.context import CryptContext  # For password hashing and comparison
 from .tokens import *
+from .catalog import medication_catalog, etag_matches
+from .search_index import medication_search, SEARCH_DEFAULT_LIMIT, SEARCH_MAX_LIMIT
+from .export import export_user_records, NDJSON_MEDIA_TYPE
+from .notification_dispatcher import notification_dispatcher
+from .dosing import schedule_columns, SCHEDULE_SOURCE_FIELDS
+from .dose_calendar import dose_calendar, CALENDAR_MAX_DAYS
+from .interactions import interaction_warnings
+from .side_effect_rollup import apply_rollup, rollup_deltas, user_rollup_deltas, medication_totals, medication_breakdown
+from .prescription_reads import prescription_rows_query, group_prescription_rows, dump_json
+from .metrics import MetricsMiddleware, registry as metrics_registry, PROMETHEUS_CONTENT_TYPE
+from .hashing import password_hasher
+from .query_tracker import QueryTrackerMiddleware
+from .settings import settings
+from .response_cache import response_cache
+from .sync import user_changes, record_deletes, next_change_seq
+from .pagination import DEFAULT_PAGE_LIMIT, MAX_PAGE_LIMIT, NEXT_CURSOR_HEADER, encode_cursor, decode_cursor, paginate, split_page, parse_datetime
 
 # Configure logging
 logging.basicConfig(level=logging.DEBUG)
 
+BATCH_MAX_ROWS = 500  # Max rows accepted by one call to the batch create endpoints
 
-# Initialize FastAPI app
-#app = FastAPI()
+# Check the size of a batch create request
+def check_batch_size(items: list):
+    if not items:
+        raise HTTPException(status_code=422, detail="Batch is empty")
+    if len(items) > BATCH_MAX_ROWS:
+        raise HTTPException(status_code=422, detail=f"Batch is too large, max {BATCH_MAX_ROWS} rows per call")
 
-'''# Initialize password hashing context (bcrypt)
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto") 
 
+# Initialize FastAPI app
+#app = FastAPI()
 
-# Helper function to hash passwords
-def hash_password(password: str) -> str:
-    return pwd_context.hash(password)
+# Per route latency / DB statements / pool wait for GET /metrics (see metrics.py)
+app.add_middleware(MetricsMiddleware)
+metrics_registry.register_collector("password_hasher", password_hasher.metrics)
+metrics_registry.register_collector("token_cache", token_cache.stats)
+metrics_registry.register_collector("principal_cache", principal_cache.stats)
+metrics_registry.register_collector("notification_dispatcher", notification_dispatcher.metrics)
+metrics_registry.register_collector("dose_calendar", dose_calendar.metrics)
+metrics_registry.register_collector("medication_search", medication_search.metrics)
+metrics_registry.register_collector("slow_query_log", slow_query_log.metrics)
+metrics_registry.register_collector("response_cache", response_cache.metrics)
+
+# Statements per request and N+1 warnings while developing (see query_tracker.py) -- on in the dev profile
+if settings.track_queries:
+    app.add_middleware(QueryTrackerMiddleware)
+
+# Prometheus metrics of this worker (GET) -- no token so the scraper can read it, keep it off the public load balancer
+@app.get("/metrics", include_in_schema=False)
+async def get_metrics():
+    return Response(content=metrics_registry.render(), media_type=PROMETHEUS_CONTENT_TYPE)
 
-# Helper function to verify passwords
-# Helper function to verify passwords
-def verify_password(plain_password: str, hashed_password: str) -> bool:
-    """
-    Verifies a plain password against a hashed password using the configured password context.
-    
-    :param plain_password: The plain text password from the user input
-    :param hashed_password: The hashed password from the database
-    :return: True if passwords match, False otherwise
-    """
-    return pwd_context.verify(plain_password, hashed_password)'''
 #======================== User API Calls ===============================================
 """@app.post("/token/refresh")
 async def refresh_access_token(refresh_token: str, db: AsyncSession = Depends(get_db)):
@@ -101,7 +132,7 @@ async def create_user(user: UserCreate, db: AsyncSession = Depends(get_db)):
         )
 
     # Hash the user's password before saving
-    hashed_password = hash_password(user.user_pwd)
+    hashed_password = await hash_password_async(user.user_pwd)
     print(f"User data: {user}")
 
     # Create a new user instance
@@ -181,17 +212,15 @@ async def read_user(current_user: User = Depends(get_current_user), token_info:
 # Update a user by user_id (PUT)
 @app.put("/users/me")
 async def update_user(
-    user_update: UserUpdate, current_user: UserRead = Depends(get_current_user), db: AsyncSession = Depends(get_db)
+    user_update: UserUpdate, user_id: str = Depends(get_current_user_id), db: AsyncSession = Depends(get_db)
     ):
-    # The user_id is automatically derived from the current_user (token), no need to pass it in the path
-    user_id = current_user.user_id
-
-    # Query the user by user_id
+    # The user_id is automatically derived from the token, no need to pass it in the path
+    # the user row is loaded once here (get_current_user would load it a second time)
     result = await db.execute(select(User).filter(User.user_id == user_id))
     user = result.scalars().first()
 
     if not user:
-        raise HTTPException(status_code=404, detail="User not found")
+        raise HTTPException(status_code=401, detail="User not found", headers={"WWW-Authenticate": "Bearer"})
 
     # Check if only password fields are passed (old and new passwords)
     if user_update.user_old_pwd and user_update.user_pwd:
@@ -200,11 +229,11 @@ async def update_user(
             raise HTTPException(status_code=400, detail="Old password is required to update the password")
 
         # Verify the old password
-        if not verify_password(user_update.user_old_pwd, user.user_pwd):
+        if not await verify_password_async(user_update.user_old_pwd, user.user_pwd):
             raise HTTPException(status_code=401, detail="Old password is incorrect")
 
         # Hash the new password
-        user_update.user_pwd = hash_password(user_update.user_pwd)
+        user_update.user_pwd = await hash_password_async(user_update.user_pwd)
 
         # Update the user's password in the database
         user.user_pwd = user_update.user_pwd  # Update the password in the User model
@@ -213,11 +242,12 @@ async def update_user(
         user.updated_at = datetime.now(timezone.utc)
 
         try:
-            await db.commit()  # Commit the transaction
-            await db.refresh(user)  # Refresh the instance with updated data
+            await db.commit()  # Commit the transaction (the instance keeps its values, expire_on_commit=False)
         except Exception as e:
             await db.rollback()  # Rollback in case of an error
             raise HTTPException(status_code=500, detail="Error updating user: " + str(e))
+        invalidate_principal(user_id)  # Drop the cached copy of this user
+        await response_cache.invalidate(user_id)
 
         # Return PasswordUpdateResponse with a success message
         return JSONResponse(
@@ -235,11 +265,12 @@ async def update_user(
     user.updated_at = datetime.now(timezone.utc)
 
     try:
-        await db.commit()  # Commit the transaction
-        await db.refresh(user)  # Refresh the instance with updated data
+        await db.commit()  # Commit the transaction (the instance keeps its values, expire_on_commit=False)
     except Exception as e:
         await db.rollback()  # Rollback in case of an error
         raise HTTPException(status_code=500, detail="Error updating user: " + str(e))
+    invalidate_principal(user_id)  # Drop the cached copy of this user
+    await response_cache.invalidate(user_id)
 
     # Return the updated user object (Pydantic model) - UserRead response
     return user  # This will use the UserRead response model for non-password updates
@@ -263,32 +294,100 @@ async def delete_user(
         raise HTTPException(status_code=404, detail="User not found")
     
     # Check if the password matches
-    if not verify_password(user_delete.user_pwd, user.user_pwd):  # Hash comparison
+    if not await verify_password_async(user_delete.user_pwd, user.user_pwd):  # Hash comparison
         raise HTTPException(status_code=401, detail="Incorrect password")
     
     # If password matches, delete the user
     try:
+        await apply_rollup(db, await user_rollup_deltas(db, user.user_id))  # the user's side effects go with the user
+        await db.execute(delete(SyncTombstone).where(SyncTombstone.user_id == user.user_id))
+        await db.execute(delete(SyncCounter).where(SyncCounter.user_id == user.user_id))
         await db.delete(user)
         await db.commit()  # Commit the transaction
     except Exception as e:
         await db.rollback()  # Rollback in case of an error
         raise HTTPException(status_code=500, detail="Error deleting user: " + str(e))
+    invalidate_principal(user.user_id)  # Deleted users must not be served from the cache
+    await response_cache.invalidate(user.user_id)
+    dose_calendar.invalidate(user.user_id)
 
     # Return the success message with user_id
     return UserDeleteResponse(msg="User deleted successfully", user_id=user.user_id)
+
+# Export everything stored for the current user (GET)
+# streams NDJSON: prescriptions (with details + medication names), then side effects, then notifications
+@app.get("/users/me/export")
+async def export_user(user_id: str = Depends(get_current_user_id)):
+    return StreamingResponse(
+        export_user_records(user_id),
+        media_type=NDJSON_MEDIA_TYPE,
+        headers={"Content-Disposition": f'attachment; filename="{user_id}_export.ndjson"'}
+    )
+
+# Rows of the current user changed since the last sync (GET) -- see sync.py
+# pass the cursor of the previous response as since, leave it out for everything
+# reads the primary: a change the replica hasn't got yet would be behind the new cursor and never sent
+@app.get("/sync", response_model=SyncResponse)
+async def sync_changes(since: Optional[str] = None, db: AsyncSession = Depends(get_db), user_id: str = Depends(get_current_user_id)):
+    return Response(content=dump_json(await user_changes(db, user_id, since)), media_type="application/json")
+
+# Dose calendar of the current user (GET) -- every dose of the active prescriptions between from and to (both included)
+# served from the per user calendar cache (see dose_calendar.py), which is dropped whenever a prescription changes
+@app.get("/users/me/calendar", response_model=List[DoseEventRead])
+async def get_dose_calendar(
+    date_from: date = Query(..., alias="from"),
+    date_to: date = Query(..., alias="to"),
+    db: AsyncSession = Depends(get_user_read_db),
+    user_id: str = Depends(get_current_user_id)
+):
+    if date_to < date_from:
+        raise HTTPException(status_code=422, detail="to must be on or after from")
+    if (date_to - date_from).days >= CALENDAR_MAX_DAYS:
+        raise HTTPException(status_code=422, detail=f"Calendar window is too long, max {CALENDAR_MAX_DAYS} days")
+
+    content = await dose_calendar.get(db, user_id, date_from, date_to)
+    return Response(content=content, media_type="application/json")
 #======================== END User API Calls ===============================================
 # ========================== Medication API calls ===============================================
-# Get all medications (GET)
+# Get all medications (GET) -- one page at a time, ordered by medication_id
+# served from the in-memory catalog (see catalog.py) -- clients can send If-None-Match to get a 304
+# pass the X-Next-Cursor response header back as cursor to get the next page
 @app.get("/medications/", response_model=List[MedicationRead])
-async def get_medications(db: AsyncSession = Depends(get_db)):
-    # Query the database to get all medications
-    result = await db.execute(select(Medication))  # No filtering, just select all medications
-    medications = result.scalars().all()
+async def get_medications(
+    request: Request,
+    cursor: Optional[str] = None,
+    limit: int = Query(DEFAULT_PAGE_LIMIT, ge=1, le=MAX_PAGE_LIMIT),
+    db: AsyncSession = Depends(get_read_db)
+):
+    catalog = await medication_catalog.get(db)
 
-    if not medications:
+    if not catalog.medications:
         raise HTTPException(status_code=404, detail="No medications found.")
 
-    return medications  # FastAPI will automatically convert the list of Medication objects to MedicationRead
+    after_id = decode_cursor(cursor, int)[0] if cursor else None
+    etag = catalog.page_etag(after_id, limit)
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    body, next_after_id = catalog.page(after_id, limit)
+    if next_after_id is not None:
+        headers[NEXT_CURSOR_HEADER] = encode_cursor([next_after_id])
+
+    # The client already has this version of the page
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+    # Pre-serialized JSON list of MedicationRead
+    return Response(content=body, media_type="application/json", headers=headers)
+
+# Search medications by name / use for autocomplete (GET) -- best matches first
+# served from the in-memory search index over the catalog (see search_index.py), an empty list when nothing matches
+@app.get("/medications/search", response_model=List[MedicationRead])
+async def search_medications(
+    q: str = Query(..., min_length=1, max_length=100),
+    limit: int = Query(SEARCH_DEFAULT_LIMIT, ge=1, le=SEARCH_MAX_LIMIT),
+    db: AsyncSession = Depends(get_read_db)
+):
+    body = await medication_search.search_json(db, q, limit)
+    return Response(content=body, media_type="application/json")
 # ========================== End Medication API calls ===========================================
 
 # =================== Notification API calls ==============================
@@ -310,19 +409,57 @@ async def create_notification(
         updated_at=datetime.now(timezone.utc)   # Set updated_at to the current UTC time
     )
   # Add and commit the new notification to the database
-    db.add(new_notification)
     try:
+        new_notification.change_seq = await next_change_seq(db, current_user.user_id)
+        db.add(new_notification)
         await db.commit()
         await db.refresh(new_notification)  # Refresh the instance with data from the DB
     except Exception as e:
         await db.rollback()  # Rollback in case of an error
         raise HTTPException(status_code=500, detail="Error creating notification: " + str(e))
+    await response_cache.invalidate(current_user.user_id)
 
     return new_notification
 
+# Create many notifications in one call (POST)
+# all rows go in with one multi-row INSERT inside one transaction -- for clients syncing offline data
+@app.post("/notifications/batch", response_model=List[NotificationRead])
+async def create_notifications_batch(
+    notifications: List[NotificationCreate],
+    current_user: User = Depends(get_current_user),  # Automatically get the user from the token
+    db: AsyncSession = Depends(get_db)
+):
+    check_batch_size(notifications)
+
+    current_time = datetime.now(timezone.utc)
+    rows = [
+        {
+            "user_id": current_user.user_id,
+            "notification_type": notification.notification_type,
+            "notification_message": notification.notification_message,
+            "notification_date": notification.notification_date or current_time,  # Set to current time if not provided
+            "created_at": current_time,
+            "updated_at": current_time,
+        }
+        for notification in notifications
+    ]
+
+    try:
+        change_seq = await next_change_seq(db, current_user.user_id)
+        new_notifications = await data_access_operations.bulk_insert(
+            db, Notification, Notification.notification_id, current_user.user_id, [{**row, "change_seq": change_seq} for row in rows]
+        )
+        await db.commit()
+    except Exception as e:
+        await db.rollback()  # Rollback in case of an error
+        raise HTTPException(status_code=500, detail="Error creating notifications: " + str(e))
+    await response_cache.invalidate(current_user.user_id)
+
+    return new_notifications
+
 # Read a notification by notification_id (GET)
 @app.get("/notifications/{notification_id}", response_model=NotificationRead)
-async def read_notification(notification_id: int, db: AsyncSession = Depends(get_db), current_user: User = Depends(get_current_user)):
+async def read_notification(notification_id: int, db: AsyncSession = Depends(get_user_read_db), user_id: str = Depends(get_current_user_id)):
     # Fetch the notification by ID
     result = await db.execute(select(Notification).filter(Notification.notification_id == notification_id))
     notification = result.scalars().first()
@@ -330,78 +467,108 @@ async def read_notification(notification_id: int, db: AsyncSession = Depends(get
     if not notification:
         raise HTTPException(status_code=404, detail="Notification not found")
      # Check if the notification belongs to the current user
-    if notification.user_id != current_user.user_id:
+    if notification.user_id != user_id:
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
             detail="You do not have permission to view this notification"
         )
     return notification
 
-# Get all notifications for the current user (GET)
+# Get all notifications for the current user (GET) -- one page at a time, ordered by created_at
+# optional filters: notification_status, notification_type, notification_date range (date_from / date_to)
+# pass the X-Next-Cursor response header back as cursor to get the next page
+# pages are cached per user until the user's notifications change (see response_cache.py)
 @app.get("/notifications", response_model=List[NotificationRead])
-async def get_user_notifications(db: AsyncSession = Depends(get_db), current_user: User = Depends(get_current_user)):
-    # Query the database to get notifications by current user's user_id
-    result = await db.execute(select(Notification).filter(Notification.user_id == current_user.user_id))
-    notifications = result.scalars().all()
+async def get_user_notifications(
+    request: Request,
+    notification_status: Optional[int] = Query(None, ge=0, le=1),
+    notification_type: Optional[int] = Query(None, ge=1, le=2),
+    date_from: Optional[datetime] = None,
+    date_to: Optional[datetime] = None,
+    cursor: Optional[str] = None,
+    limit: int = Query(DEFAULT_PAGE_LIMIT, ge=1, le=MAX_PAGE_LIMIT),
+    db: AsyncSession = Depends(get_user_read_db),
+    user_id: str = Depends(get_current_user_id)
+):
+    cache_key = await response_cache.key(request, user_id)
+    cached = await response_cache.get(cache_key)
+    if cached is not None:
+        return cached
 
-    if not notifications:
+    # Query the database to get notifications by current user's user_id
+    query = select(Notification).filter(Notification.user_id == user_id)
+    if notification_status is not None:
+        query = query.filter(Notification.notification_status == notification_status)
+    if notification_type is not None:
+        query = query.filter(Notification.notification_type == notification_type)
+    if date_from is not None:
+        query = query.filter(Notification.notification_date >= date_from)
+    if date_to is not None:
+        query = query.filter(Notification.notification_date <= date_to)
+
+    sort_key = (Notification.created_at, Notification.notification_id)
+    cursor_values = decode_cursor(cursor, parse_datetime, int) if cursor else None
+    result = await db.execute(paginate(query, sort_key, cursor_values, limit))
+    notifications, next_cursor = split_page(result.scalars().all(), limit, lambda n: (n.created_at, n.notification_id))
+
+    if not notifications and cursor is None:
         raise HTTPException(status_code=404, detail="No notifications found for the user.")
 
-    return notifications  # FastAPI will handle serialization to NotificationRead
+    # Return the list of NotificationRead (as JSON), the next page cursor goes in the X-Next-Cursor header
+    return await response_cache.put(cache_key, dump_json([NotificationRead.model_validate(n) for n in notifications]), next_cursor)
 
 # Update a notification by notification_id (PUT)
+# one conditional UPDATE (id + user_id), then the updated row is read back in the same transaction
 @app.put("/notifications/{notification_id}", response_model=NotificationRead)
 async def update_notification(notification_id: int, notification_update: NotificationUpdate, db: AsyncSession = Depends(get_db), current_user: User = Depends(get_current_user)):
-    # Query the notification by notification_id
-    result = await db.execute(select(Notification).filter(Notification.notification_id == notification_id))
-    notification = result.scalars().first()
-
-    if not notification:
-        raise HTTPException(status_code=404, detail="Notification not found")
-    
-    # Check if the notification belongs to the current user
-    if notification.user_id != current_user.user_id:
-        raise HTTPException(
-            status_code=status.HTTP_403_FORBIDDEN,
-            detail="You are not authorized to update this notification"
-        )
-     # Update the notification fields using model_dump()
-    for field, value in notification_update.model_dump(exclude_unset=True).items():
-        setattr(notification, field, value)
-
+    values = notification_update.model_dump(exclude_unset=True)
     # Set the updated_at field to the current UTC time
-    notification.updated_at = datetime.now(timezone.utc)
+    values["updated_at"] = datetime.now(timezone.utc)
 
     try:
+        values["change_seq"] = await next_change_seq(db, current_user.user_id)
+        await data_access_operations.execute_owned(
+            db,
+            update(Notification)
+            .where(Notification.notification_id == notification_id, Notification.user_id == current_user.user_id)
+            .values(**values),
+            owner_query=select(Notification.user_id).filter(Notification.notification_id == notification_id),
+            user_id=current_user.user_id,
+            not_found_detail="Notification not found",
+            forbidden_detail="You are not authorized to update this notification"
+        )
+        result = await db.execute(select(Notification).filter(Notification.notification_id == notification_id))
+        notification = result.scalars().first()
         await db.commit()  # Commit the transaction
-        await db.refresh(notification)  # Refresh the instance with updated data
+    except HTTPException:
+        raise
     except Exception as e:
         await db.rollback()  # Rollback in case of an error
         raise HTTPException(status_code=500, detail="Error updating notification: " + str(e))
+    await response_cache.invalidate(current_user.user_id)
 
     return notification
 
 # Delete notification by notification_id (DELETE)
+@app.delete("/notifications/{notification_id}", response_model=NotificationDeleteResponse)
 async def delete_notification(notification_id: int, db: AsyncSession = Depends(get_db), current_user: User = Depends(get_current_user)):
-    # Query the notification by notification_id
-    result = await db.execute(select(Notification).filter(Notification.notification_id == notification_id))
-    notification = result.scalars().first()
-
-    if not notification:
-        raise HTTPException(status_code=404, detail="Notification not found")
-     # Check if the notification belongs to the current user
-    if notification.user_id != current_user.user_id:
-        raise HTTPException(
-            status_code=status.HTTP_403_FORBIDDEN,
-            detail="You are not authorized to delete this notification"
-        )
-
     try:
-        await db.delete(notification)  # Delete the notification instance
+        await data_access_operations.execute_owned(
+            db,
+            delete(Notification).where(Notification.notification_id == notification_id, Notification.user_id == current_user.user_id),
+            owner_query=select(Notification.user_id).filter(Notification.notification_id == notification_id),
+            user_id=current_user.user_id,
+            not_found_detail="Notification not found",
+            forbidden_detail="You are not authorized to delete this notification"
+        )
+        await record_deletes(db, current_user.user_id, "notification", [notification_id])
         await db.commit()  # Commit the transaction
+    except HTTPException:
+        raise
     except Exception as e:
         await db.rollback()  # Rollback in case of an error
         raise HTTPException(status_code=500, detail="Error deleting notification: " + str(e))
+    await response_cache.invalidate(current_user.user_id)
 
     return {"msg": "Notification deleted successfully", "notification_id": notification_id}
 
@@ -417,158 +584,158 @@ async def create_prescription(prescription: PrescriptionCreate, db: AsyncSession
         prescription_status=prescription.prescription_status,
     )
       # Add the new prescription to the database
-    db.add(new_prescription)
     try:
+        new_prescription.change_seq = await next_change_seq(db, current_user.user_id)
+        db.add(new_prescription)
         await db.commit()
         await db.refresh(new_prescription)  # Refresh the instance with data from the DB
     except Exception as e:
         await db.rollback()  # Rollback in case of an error
         raise HTTPException(status_code=500, detail=f"Error creating prescription: {str(e)}")
+    dose_calendar.invalidate(current_user.user_id)
+    await response_cache.invalidate(current_user.user_id)
 
     return new_prescription
 
 # read prescription by prescription id 
+# fast read path: one joined query, rows go straight to JSON bytes (see prescription_reads.py), cached per user
 @app.get("/prescriptions/{prescription_id}", response_model=PrescriptionRead)
-async def get_prescription(prescription_id: int, db: AsyncSession = Depends(get_db), current_user: User = Depends(get_current_user)):
+async def get_prescription(prescription_id: int, request: Request, db: AsyncSession = Depends(get_user_read_db), user_id: str = Depends(get_current_user_id)):
+    cache_key = await response_cache.key(request, user_id)
+    cached = await response_cache.get(cache_key)
+    if cached is not None:
+        return cached
+
     result = await db.execute(
-        select(Prescription)
-        .options(
-            selectinload(Prescription.prescription_details)
-            .selectinload(PrescriptionDetail.medication)  # Eager load medication
-        )
-        .filter(Prescription.prescription_id == prescription_id)
+        prescription_rows_query().filter(Prescription.prescription_id == prescription_id)
     )
-    prescription = result.scalars().first()
+    prescriptions = group_prescription_rows(result.all())
 
-    if not prescription:
+    if not prescriptions:
         raise HTTPException(status_code=404, detail="Prescription not found")
     
      # Check if the prescription belongs to the current user
-    if prescription.user_id != current_user.user_id:
+    if prescriptions[0]["user_id"] != user_id:
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
             detail="You are not authorized to access this prescription"
         )
 
-    # Convert the Prescription model to the PrescriptionRead Pydantic model
-    prescription_data = []
-    for detail in prescription.prescription_details:
-        # Create PrescriptionDetailRead and include medication_name
-        prescription_data.append(PrescriptionDetailRead(
-            prescription_id=detail.prescription_id,
-            medication_id=detail.medication_id,
-            medication_name=detail.medication.medication_name,  # Fetch medication_name
-            presc_dose=detail.presc_dose,
-            presc_qty=detail.presc_qty,
-            presc_type=detail.presc_type,
-            presc_frequency=detail.presc_frequency
-        ))
+    # Return PrescriptionRead (as JSON) including details and medication name
+    return await response_cache.put(cache_key, dump_json(prescriptions[0]))
 
-    # Return PrescriptionRead including details and medication name
-    return PrescriptionRead(
-        prescription_id=prescription.prescription_id,
-        prescription_date_start=prescription.prescription_date_start,
-        prescription_date_end=prescription.prescription_date_end,
-        prescription_status=prescription.prescription_status,
-        user_id=prescription.user_id,
-        prescription_details=prescription_data
-    )
-# read full list of prescriptions associated with user_id (user_id from token)
+# read full list of prescriptions associated with user_id (user_id from token) -- one page at a time, ordered by prescription_id
+# optional filters: prescription_status, prescription_date_start range (date_from / date_to)
+# pass the X-Next-Cursor response header back as cursor to get the next page
+# fast read path: the page of prescriptions and their details come back in one joined query, cached per user
 @app.get("/prescriptions/", response_model=List[PrescriptionRead])
-async def get_prescriptions_by_user(db: AsyncSession = Depends(get_db), current_user: User = Depends(get_current_user)):
-    result = await db.execute(
-        select(Prescription)
-        .options(
-            selectinload(Prescription.prescription_details)
-            .selectinload(PrescriptionDetail.medication)  # Eager load medication
-        )
-        .filter(Prescription.user_id == current_user.user_id)  # Filter by user_id
-    )
-    prescriptions = result.scalars().all()  # Get all prescriptions for the user
-
-    if not prescriptions:
+async def get_prescriptions_by_user(
+    request: Request,
+    prescription_status: Optional[int] = Query(None, ge=0, le=1),
+    date_from: Optional[date] = None,
+    date_to: Optional[date] = None,
+    cursor: Optional[str] = None,
+    limit: int = Query(DEFAULT_PAGE_LIMIT, ge=1, le=MAX_PAGE_LIMIT),
+    db: AsyncSession = Depends(get_user_read_db),
+    user_id: str = Depends(get_current_user_id)
+):
+    cache_key = await response_cache.key(request, user_id)
+    cached = await response_cache.get(cache_key)
+    if cached is not None:
+        return cached
+
+    page = select(Prescription).filter(Prescription.user_id == user_id)  # Filter by user_id
+    if prescription_status is not None:
+        page = page.filter(Prescription.prescription_status == prescription_status)
+    if date_from is not None:
+        page = page.filter(Prescription.prescription_date_start >= date_from)
+    if date_to is not None:
+        page = page.filter(Prescription.prescription_date_start <= date_to)
+
+    cursor_values = decode_cursor(cursor, int) if cursor else None
+    page = paginate(page, (Prescription.prescription_id,), cursor_values, limit).subquery()
+    result = await db.execute(prescription_rows_query(page))
+    prescriptions, next_cursor = split_page(group_prescription_rows(result.all()), limit, lambda p: (p["prescription_id"],))  # Get one page of prescriptions for the user
+
+    if not prescriptions and cursor is None:
         raise HTTPException(status_code=404, detail="No prescriptions found for this user")
 
-    # Convert the list of Prescription models to PrescriptionRead Pydantic models
-    prescriptions_data = []
-    for prescription in prescriptions:
-        prescription_data = []
-        for detail in prescription.prescription_details:
-            prescription_data.append(PrescriptionDetailRead(
-                prescription_id=detail.prescription_id,
-                medication_id=detail.medication_id,
-                medication_name=detail.medication.medication_name,  # Medication name
-                presc_dose=detail.presc_dose,
-                presc_qty=detail.presc_qty,
-                presc_type=detail.presc_type,
-                presc_frequency=detail.presc_frequency
-            ))
-
-        prescriptions_data.append(PrescriptionRead(
-            prescription_id=prescription.prescription_id,
-            prescription_date_start=prescription.prescription_date_start,
-            prescription_date_end=prescription.prescription_date_end,
-            prescription_status=prescription.prescription_status,
-            user_id=prescription.user_id,
-            prescription_details=prescription_data
-        ))
-
-    # Return the list of PrescriptionRead models for the user
-    return prescriptions_data
+    # Return the list of PrescriptionRead (as JSON) for the user
+    return await response_cache.put(cache_key, dump_json(prescriptions), next_cursor)
 
 
 # update precription by prescription_id 
+# one conditional UPDATE (id + user_id), then the updated prescription is read back in the same transaction
 @app.put("/prescriptions/{prescription_id}", response_model=PrescriptionRead)
 async def update_prescription(prescription_id: int, prescription_update: PrescriptionUpdate, db: AsyncSession = Depends(get_db), current_user: User = Depends(get_current_user)):
-    # Query the prescription by prescription_id
-    result = await db.execute(select(Prescription).filter(Prescription.prescription_id == prescription_id))
-    prescription = result.scalars().first()
+    values = prescription_update.model_dump(exclude_unset=True)
+
+    try:
+        if values:
+            values["change_seq"] = await next_change_seq(db, current_user.user_id)
+            await data_access_operations.execute_owned(
+                db,
+                update(Prescription)
+                .where(Prescription.prescription_id == prescription_id, Prescription.user_id == current_user.user_id)
+                .values(**values),
+                owner_query=select(Prescription.user_id).filter(Prescription.prescription_id == prescription_id),
+                user_id=current_user.user_id,
+                not_found_detail="Prescription not found",
+                forbidden_detail="You are not authorized to access this prescription"
+            )
+        result = await db.execute(select(Prescription).filter(Prescription.prescription_id == prescription_id))
+        prescription = result.scalars().first()
+        await db.commit()
+    except HTTPException:
+        raise
+    except Exception as e:
+        await db.rollback()
+        raise HTTPException(status_code=500, detail=f"Error updating prescription: {str(e)}")
 
+    # Nothing to update -- the read above is the existence / ownership check
     if not prescription:
         raise HTTPException(status_code=404, detail="Prescription not found")
-    
-     # Check if the prescription belongs to the current user
     if prescription.user_id != current_user.user_id:
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
             detail="You are not authorized to access this prescription"
         )
-
-
-    # Update the prescription fields using the provided data
-    for field, value in prescription_update.model_dump(exclude_unset=True).items():
-        setattr(prescription, field, value)
-
-    try:
-        await db.commit()
-        await db.refresh(prescription)  # Refresh the instance with updated data
-    except Exception as e:
-        await db.rollback()
-        raise HTTPException(status_code=500, detail=f"Error updating prescription: {str(e)}")
+    if values:  # the UPDATE ran
+        dose_calendar.invalidate(current_user.user_id)
+        await response_cache.invalidate(current_user.user_id)
 
     return prescription
 
 # delete percription by prescription_id 
+# the details are deleted first (only if the prescription is the user's), then the prescription itself
 @app.delete("/prescriptions/{prescription_id}", response_model=PrescriptionDeleteResponse)
 async def delete_prescription(prescription_id: int, db: AsyncSession = Depends(get_db), current_user: User = Depends(get_current_user)):
-    # Fetch the prescription from the database using the prescription_id
-    result = await db.execute(select(Prescription).filter(Prescription.prescription_id == prescription_id))
-    prescription = result.scalars().first()
-
-    if not prescription:
-        raise HTTPException(status_code=404, detail="Prescription not found")
-    
-    
-    # Check if the prescription belongs to the current user
-    if prescription.user_id != current_user.user_id:
-        raise HTTPException(status_code=403, detail="You do not have permission to delete this prescription")
-
+    owned_prescription = select(Prescription.prescription_id).where(
+        Prescription.prescription_id == prescription_id, Prescription.user_id == current_user.user_id
+    )
     try:
-        await db.delete(prescription)
+        await db.execute(
+            delete(PrescriptionDetail)
+            .where(PrescriptionDetail.prescription_id.in_(owned_prescription))
+            .execution_options(synchronize_session=False)
+        )
+        await data_access_operations.execute_owned(
+            db,
+            delete(Prescription).where(Prescription.prescription_id == prescription_id, Prescription.user_id == current_user.user_id),
+            owner_query=select(Prescription.user_id).filter(Prescription.prescription_id == prescription_id),
+            user_id=current_user.user_id,
+            not_found_detail="Prescription not found",
+            forbidden_detail="You do not have permission to delete this prescription"
+        )
+        await record_deletes(db, current_user.user_id, "prescription", [prescription_id])  # its details go with it
         await db.commit()  # Commit the transaction
+    except HTTPException:
+        raise
     except Exception as e:
         await db.rollback()
         raise HTTPException(status_code=500, detail=f"Error deleting prescription: {str(e)}")
+    dose_calendar.invalidate(current_user.user_id)
+    await response_cache.invalidate(current_user.user_id)
 
     return {"msg": "Prescription deleted successfully", "prescription_id": prescription_id}
 
@@ -577,7 +744,8 @@ async def delete_prescription(prescription_id: int, db: AsyncSession = Depends(g
 # ================================ PrescriptionDetail API calls ================================================
 
 # create PrescriptionDetail 
-@app.post("/prescriptions/{prescription_id}/details/", response_model=PrescriptionDetailRead)
+# the medication is checked against the user's other active medications -- interactions come back as interaction_warnings
+@app.post("/prescriptions/{prescription_id}/details/", response_model=PrescriptionDetailCreateResponse)
 async def create_prescription_detail(
     prescription_id: int, 
     detail: PrescriptionDetailCreate, 
@@ -599,9 +767,8 @@ async def create_prescription_detail(
             detail="You are not authorized to access this prescription"
         )
 
-    # Check if the medication exists in the database
-    medication = await db.execute(select(Medication).filter(Medication.medication_id == detail.medication_id))
-    medication = medication.scalars().first()
+    # Check if the medication exists (medication catalog)
+    medication = await medication_catalog.get_medication(db, detail.medication_id)
     if not medication:
         raise HTTPException(
             status_code=404,
@@ -615,24 +782,113 @@ async def create_prescription_detail(
         presc_dose=detail.presc_dose,
         presc_qty=detail.presc_qty,
         presc_type=detail.presc_type,
-        presc_frequency=detail.presc_frequency
+        presc_frequency=detail.presc_frequency,
+        **schedule_columns(detail.presc_frequency, detail.presc_dose, detail.presc_type)  # parsed dose schedule
     )
 
+    # Check for drug interactions with the user's active medications (warnings only, the detail is still added)
+    warnings = await interaction_warnings(db, current_user.user_id, [detail.medication_id])
+
     # Add the new detail to the database
-    db.add(new_detail)
     try:
+        new_detail.change_seq = await next_change_seq(db, current_user.user_id)
+        db.add(new_detail)
         await db.commit()
         await db.refresh(new_detail)  # Refresh the instance with data from the DB
     except Exception as e:
         await db.rollback()  # Rollback in case of an error
         raise HTTPException(status_code=500, detail=f"Error creating prescription detail: {str(e)}")
+    dose_calendar.invalidate(current_user.user_id)
+    await response_cache.invalidate(current_user.user_id)
 
-    return new_detail
+    response = PrescriptionDetailCreateResponse.model_validate(new_detail)
+    response.medication_name = medication.medication_name
+    response.interaction_warnings = warnings.get(detail.medication_id, [])
+    return response
+
+# create many PrescriptionDetails for one prescription in one call
+# medications are checked together and all rows go in with one multi-row INSERT inside one transaction
+# each medication is checked for interactions with the user's active medications and the rest of the batch
+@app.post("/prescriptions/{prescription_id}/details/batch", response_model=List[PrescriptionDetailCreateResponse])
+async def create_prescription_details_batch(
+    prescription_id: int,
+    details: List[PrescriptionDetailCreate],
+    db: AsyncSession = Depends(get_db),
+    current_user: User = Depends(get_current_user)
+):
+    check_batch_size(details)
+
+    # Check if the prescription exists in the database
+    prescription = await db.execute(select(Prescription).filter(Prescription.prescription_id == prescription_id))
+    prescription = prescription.scalars().first()
+    if not prescription:
+        raise HTTPException(
+            status_code=404,
+            detail=f"Prescription with id {prescription_id} not found."
+        )
+     # Check if the prescription belongs to the current user
+    if prescription.user_id != current_user.user_id:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="You are not authorized to access this prescription"
+        )
+
+    medication_ids = [detail.medication_id for detail in details]
+    if len(set(medication_ids)) != len(medication_ids):
+        raise HTTPException(status_code=422, detail="Each medication can only be added once per prescription")
+
+    # Check all the medications exist (medication catalog + one IN query for unknown ids)
+    medications = await medication_catalog.get_medications(db, medication_ids)
+    missing = [medication_id for medication_id in medication_ids if medication_id not in medications]
+    if missing:
+        raise HTTPException(
+            status_code=404,
+            detail=f"Medications with ids {missing} not found."
+        )
+
+    rows = [
+        {
+            "prescription_id": prescription_id,
+            "medication_id": detail.medication_id,
+            "presc_dose": detail.presc_dose,
+            "presc_qty": detail.presc_qty,
+            "presc_type": detail.presc_type,
+            "presc_frequency": detail.presc_frequency,
+            **schedule_columns(detail.presc_frequency, detail.presc_dose, detail.presc_type),  # parsed dose schedule
+        }
+        for detail in details
+    ]
+
+    # Check for drug interactions (warnings only, the details are still added)
+    warnings = await interaction_warnings(db, current_user.user_id, medication_ids)
+
+    try:
+        change_seq = await next_change_seq(db, current_user.user_id)
+        await db.execute(insert(PrescriptionDetail).values([{**row, "change_seq": change_seq} for row in rows]))
+        await db.commit()
+    except IntegrityError:
+        await db.rollback()
+        raise HTTPException(status_code=409, detail="One or more of these medications are already on the prescription")
+    except Exception as e:
+        await db.rollback()  # Rollback in case of an error
+        raise HTTPException(status_code=500, detail=f"Error creating prescription details: {str(e)}")
+    dose_calendar.invalidate(current_user.user_id)
+    await response_cache.invalidate(current_user.user_id)
+
+    # Every column was provided, so the response is built without reading the rows back
+    return [
+        PrescriptionDetailCreateResponse(
+            **row,
+            medication_name=medications[row["medication_id"]].medication_name,
+            interaction_warnings=warnings.get(row["medication_id"], [])
+        )
+        for row in rows
+    ]
 
 
 # Get all Prescription Details by Prescription ID 
 @app.get("/prescriptions/{prescription_id}/details/", response_model=List[PrescriptionDetailRead])
-async def get_prescription_details(prescription_id: int, db: AsyncSession = Depends(get_db),  current_user: User = Depends(get_current_user)):
+async def get_prescription_details(prescription_id: int, db: AsyncSession = Depends(get_user_read_db), user_id: str = Depends(get_current_user_id)):
     # Query to fetch the prescription by prescription_id
     result = await db.execute(
         select(Prescription)
@@ -644,7 +900,7 @@ async def get_prescription_details(prescription_id: int, db: AsyncSession = Depe
         raise HTTPException(status_code=404, detail="Prescription not found")
 
     # Check if the prescription belongs to the current user
-    if prescription.user_id != current_user.user_id:
+    if prescription.user_id != user_id:
         raise HTTPException(status_code=403, detail="You do not have permission to view this prescription")
 
     # Query to fetch prescription details along with medication name
@@ -677,6 +933,7 @@ async def get_prescription_details(prescription_id: int, db: AsyncSession = Depe
     return prescription_details
 
 # update the details of an existing prescription detail
+# one conditional UPDATE (only matches if the prescription is the user's), then the row is read back in the same transaction
 @app.put("/prescriptions/{prescription_id}/details/{medication_id}", response_model=PrescriptionDetailRead)
 async def update_prescription_detail(
     prescription_id: int,
@@ -685,92 +942,112 @@ async def update_prescription_detail(
     db: AsyncSession = Depends(get_db),
     current_user: UserRead = Depends(get_current_user) 
 ):
-    # Check if the prescription exists in the database
-    prescription = await db.execute(select(Prescription).filter(Prescription.prescription_id == prescription_id))
-    prescription = prescription.scalars().first()
-    if not prescription:
-        raise HTTPException(
-            status_code=404,
-            detail=f"Prescription with id {prescription_id} not found."
-        )
-    
-     # Check if the prescription belongs to the current user
-    if prescription.user_id != current_user.user_id:
-        raise HTTPException(status_code=403, detail="You do not have permission to update this prescription")
-
-    # Check if the medication exists in the database
-    medication = await db.execute(select(Medication).filter(Medication.medication_id == medication_id))
-    medication = medication.scalars().first()
+    # Check if the medication exists (medication catalog)
+    medication = await medication_catalog.get_medication(db, medication_id)
     if not medication:
         raise HTTPException(
             status_code=404,
             detail=f"Medication with id {medication_id} not found."
         )
 
-    # Query the existing prescription detail by prescription_id and medication_id
-    result = await db.execute(select(PrescriptionDetail).filter(
+    detail_filter = (
         PrescriptionDetail.prescription_id == prescription_id,
-        PrescriptionDetail.medication_id == medication_id
-    ))
-    detail = result.scalars().first()
+        PrescriptionDetail.medication_id == medication_id,
+    )
+    values = detail_update.model_dump(exclude_unset=True)
+
+    try:
+        if values:
+            values["change_seq"] = await next_change_seq(db, current_user.user_id)
+            result = await data_access_operations.execute_owned(
+                db,
+                update(PrescriptionDetail)
+                .where(*detail_filter, PrescriptionDetail.prescription_id.in_(
+                    select(Prescription.prescription_id).where(
+                        Prescription.prescription_id == prescription_id, Prescription.user_id == current_user.user_id
+                    )
+                ))
+                .values(**values),
+                owner_query=select(Prescription.user_id).filter(Prescription.prescription_id == prescription_id),
+                user_id=current_user.user_id,
+                not_found_detail=f"Prescription with id {prescription_id} not found.",
+                forbidden_detail="You do not have permission to update this prescription"
+            )
+            if result.rowcount == 0:
+                raise HTTPException(status_code=404, detail="Prescription detail not found")
+        else:
+            # Nothing to update -- still check the prescription is the user's before returning the detail
+            await data_access_operations.check_owner(
+                db,
+                owner_query=select(Prescription.user_id).filter(Prescription.prescription_id == prescription_id),
+                user_id=current_user.user_id,
+                not_found_detail=f"Prescription with id {prescription_id} not found.",
+                forbidden_detail="You do not have permission to update this prescription"
+            )
+
+        result = await db.execute(select(PrescriptionDetail).filter(*detail_filter))
+        detail = result.scalars().first()
+        # Dose / frequency changed -- parse the schedule again from the updated row (saved by the commit)
+        if detail is not None and SCHEDULE_SOURCE_FIELDS & values.keys():
+            for field, value in schedule_columns(detail.presc_frequency, detail.presc_dose, detail.presc_type).items():
+                setattr(detail, field, value)
+        await db.commit()
+    except HTTPException:
+        raise
+    except Exception as e:
+        await db.rollback()
+        raise HTTPException(status_code=500, detail=f"Error updating prescription detail: {str(e)}")
 
     if not detail:
         raise HTTPException(status_code=404, detail="Prescription detail not found")
-
-    # Update the detail fields using the provided data
-    for field, value in detail_update.model_dump(exclude_unset=True).items():
-        setattr(detail, field, value)
+    if values:  # the UPDATE ran
+        dose_calendar.invalidate(current_user.user_id)
+        await response_cache.invalidate(current_user.user_id)
 
     # Convert SQLAlchemy model to Pydantic model using model_validate
-    # The 'medication_name' will be set manually below
     detail_pydantic = PrescriptionDetailRead.model_validate(detail)  # This replaces from_orm
 
     # Set medication_name explicitly
     detail_pydantic.medication_name = medication.medication_name
 
-    try:
-        await db.commit()
-        await db.refresh(detail)  # Refresh the instance with updated data
-    except Exception as e:
-        await db.rollback()
-        raise HTTPException(status_code=500, detail=f"Error updating prescription detail: {str(e)}")
-
     # Return the updated detail with medication_name
     return detail_pydantic  # Return the Pydantic model with medication_name field included
 
 
 
 # deletes a prescription detail based on both prescription_id and medication_id
+# one conditional DELETE (only matches if the prescription is the user's)
 @app.delete("/prescriptions/{prescription_id}/details/{medication_id}", response_model=PrescriptionDetailDeleteResponse)
 async def delete_prescription_detail(prescription_id: int, medication_id: int, db: AsyncSession = Depends(get_db), current_user: UserRead = Depends(get_current_user)):
-    # Fetch the prescription from the database using prescription_id
-    result = await db.execute(select(Prescription).filter(Prescription.prescription_id == prescription_id))
-    prescription = result.scalars().first()
-
-    #check is prescription exists 
-    if not prescription:
-        raise HTTPException(status_code=404, detail="Prescription not found")
-
-    # Check if the prescription belongs to the current user
-    if prescription.user_id != current_user.user_id:
-        raise HTTPException(status_code=403, detail="You do not have permission to delete this prescription")
-
-    # Fetch the prescription detail using prescription_id and medication_id
-    result = await db.execute(select(PrescriptionDetail).filter(
-        PrescriptionDetail.prescription_id == prescription_id,
-        PrescriptionDetail.medication_id == medication_id
-    ))
-    detail = result.scalars().first()
-
-    if not detail:
-        raise HTTPException(status_code=404, detail="Prescription detail not found")
-
     try:
-        await db.delete(detail)
+        result = await data_access_operations.execute_owned(
+            db,
+            delete(PrescriptionDetail).where(
+                PrescriptionDetail.prescription_id == prescription_id,
+                PrescriptionDetail.medication_id == medication_id,
+                PrescriptionDetail.prescription_id.in_(
+                    select(Prescription.prescription_id).where(
+                        Prescription.prescription_id == prescription_id, Prescription.user_id == current_user.user_id
+                    )
+                )
+            ),
+            owner_query=select(Prescription.user_id).filter(Prescription.prescription_id == prescription_id),
+            user_id=current_user.user_id,
+            not_found_detail="Prescription not found",
+            forbidden_detail="You do not have permission to delete this prescription"
+        )
+        # The prescription is the user's but it has no detail for this medication
+        if result.rowcount == 0:
+            raise HTTPException(status_code=404, detail="Prescription detail not found")
+        await record_deletes(db, current_user.user_id, "prescription_detail", [(prescription_id, medication_id)])
         await db.commit()  # Commit the transaction
+    except HTTPException:
+        raise
     except Exception as e:
         await db.rollback()
         raise HTTPException(status_code=500, detail=f"Error deleting prescription detail: {str(e)}")
+    dose_calendar.invalidate(current_user.user_id)
+    await response_cache.invalidate(current_user.user_id)
 
     return {"msg": "Prescription detail deleted successfully", "prescription_id": prescription_id, "medication_id": medication_id}
 
@@ -794,9 +1071,8 @@ class DataAccessOperations:
                 detail=f"User with user_id {incoming_side_effect.user_id} not found."
             )"""
 
-        # Check if the medication exists
-        medication = await db.execute(select(Medication).filter_by(medication_id=incoming_side_effect.medication_id))
-        medication = medication.scalar_one_or_none()
+        # Check if the medication exists (medication catalog)
+        medication = await medication_catalog.get_medication(db, incoming_side_effect.medication_id)
 
         if not medication:
             raise HTTPException(
@@ -809,8 +1085,10 @@ class DataAccessOperations:
         current_time = datetime.now(timezone.utc)
         data_to_insert = SideEffect(**incoming_side_effect.model_dump(), created_at=current_time, updated_at=current_time, user_id=user_id)
 
-        # Insert the side effect into the database
+        # Insert the side effect into the database (and count it in the rollup, same transaction)
+        data_to_insert.change_seq = await next_change_seq(db, user_id)
         db.add(data_to_insert)
+        await apply_rollup(db, rollup_deltas([(incoming_side_effect.medication_id, current_time, incoming_side_effect.side_effect_desc)]))
         await db.commit()
         await db.refresh(data_to_insert)  # Refresh to get the inserted data
 
@@ -846,19 +1124,86 @@ class DataAccessOperations:
 
 
 
-    async def read_side_effects_for_user(self, db: AsyncSession, user_id: str):
+    # Inserts many side effects for one user -- medications are checked together,
+    # then one multi-row INSERT and one read back (instead of 5 round trips per side effect)
+    async def insert_side_effects(self, db: AsyncSession, incoming_side_effects: List[SideEffectCreate], user_id: str):
+        medication_ids = {side_effect.medication_id for side_effect in incoming_side_effects}
+        medications = await medication_catalog.get_medications(db, medication_ids)
+        missing = sorted(medication_ids - medications.keys())
+        if missing:
+            raise HTTPException(
+                status_code=404,
+                detail=f"Medications with medication_ids {missing} not found."
+            )
+
+        # Set created_at and updated_at to the current UTC time
+        current_time = datetime.now(timezone.utc)
+        rows = [
+            {**side_effect.model_dump(), "created_at": current_time, "updated_at": current_time, "user_id": user_id}
+            for side_effect in incoming_side_effects
+        ]
+        try:
+            change_seq = await next_change_seq(db, user_id)
+            side_effects = await self.bulk_insert(db, SideEffect, SideEffect.side_effects_id, user_id, [{**row, "change_seq": change_seq} for row in rows])
+            await apply_rollup(db, rollup_deltas((row["medication_id"], row["created_at"], row["side_effect_desc"]) for row in rows))
+            await db.commit()
+        except SQLAlchemyError as e:
+            await db.rollback()  # Rollback in case of an error
+            raise HTTPException(
+                status_code=500,
+                detail="An error occurred while inserting the side effects."
+            )
+
+        return DataAccessOperations.DataAccessResult(success=True, result_data=[SideEffectRead.model_validate(s) for s in side_effects])
+
+    # Inserts rows for one user with a single multi-row INSERT and returns the new ORM objects (ordered like rows)
+    # does not commit -- the caller owns the transaction
+    async def bulk_insert(self, db: AsyncSession, model, id_column, user_id: str, rows: List[dict]):
+        dialect = db.get_bind().dialect
+        if dialect.insert_returning:
+            # Database can send the new rows straight back (SQLite, MariaDB, Postgres)
+            result = await db.scalars(insert(model).values(rows).returning(model))
+            return list(result.all())
+
+        # MySQL has no RETURNING -- lastrowid is the id of the first inserted row and the rest usually follow it,
+        # but the ids are not guaranteed to be consecutive (innodb_autoinc_lock_mode=2, the MySQL 8 default, lets
+        # concurrent inserts interleave), so the rows read back by id range are checked against what was inserted
+        result = await db.execute(insert(model).values(rows))
+        first_id = result.lastrowid
+        query = select(model).where(id_column >= first_id, id_column < first_id + len(rows), model.user_id == user_id)
+        if "change_seq" in rows[0]:
+            query = query.where(model.change_seq == rows[0]["change_seq"])  # not a concurrent batch of the same user
+        created = list((await db.scalars(query.order_by(id_column))).all())
+        if len(created) != len(rows):
+            # Ids were not consecutive -- the caller rolls back and nothing is half inserted
+            raise SQLAlchemyError(f"Bulk insert into {model.__tablename__} got non-consecutive ids, read back {len(created)} of {len(rows)} rows")
+        return created
+
+    # Reads one page of side effects for a user (keyset pagination on created_at, side_effects_id)
+    async def read_side_effects_for_user(self, db: AsyncSession, user_id: str, medication_id: Optional[int] = None,
+                                         date_from: Optional[datetime] = None, date_to: Optional[datetime] = None,
+                                         cursor: Optional[str] = None, limit: int = DEFAULT_PAGE_LIMIT):
+        cursor_values = decode_cursor(cursor, parse_datetime, int) if cursor else None
         try:
             # Join the SideEffect table with Medication to fetch medication_name
             query = select(SideEffect, Medication.medication_name).join(
             Medication, Medication.medication_id == SideEffect.medication_id
             ).where(SideEffect.user_id == user_id)
+            if medication_id is not None:
+                query = query.where(SideEffect.medication_id == medication_id)
+            if date_from is not None:
+                query = query.where(SideEffect.created_at >= date_from)
+            if date_to is not None:
+                query = query.where(SideEffect.created_at <= date_to)
+            query = paginate(query, (SideEffect.created_at, SideEffect.side_effects_id), cursor_values, limit)
 
             # Execute the query
             result = await db.execute(query)
+            rows, next_cursor = split_page(result.all(), limit, lambda row: (row[0].created_at, row[0].side_effects_id))
 
             # Collect the results
             side_effects_with_med_name = []
-            for side_effect, medication_name in result.all():
+            for side_effect, medication_name in rows:
                 side_effect_data = SideEffectRead(
                     side_effects_id=side_effect.side_effects_id,
                     user_id=side_effect.user_id,
@@ -870,7 +1215,7 @@ class DataAccessOperations:
                 )
                 side_effects_with_med_name.append(side_effect_data)
 
-            return DataAccessOperations.DataAccessResult(success=True, result_data=side_effects_with_med_name)
+            return DataAccessOperations.DataAccessResult(success=True, result_data=side_effects_with_med_name, next_cursor=next_cursor)
 
         except SQLAlchemyError as e:
             raise HTTPException(
@@ -914,8 +1259,64 @@ class DataAccessOperations:
                 detail="An error occurred while querying the database for side effects."
             )
 
-    async def delete_side_effect(self, db: AsyncSession, side_effects_id: int):
-        return await self.delete_from_db(db, delete(SideEffect).where(SideEffect.side_effects_id == side_effects_id))
+    # Deletes a side effect only if it belongs to the user (404 / 403 otherwise)
+    # the row is read (and locked) first so its count can be taken off the rollup
+    async def delete_side_effect(self, db: AsyncSession, side_effects_id: int, user_id: str):
+        try:
+            old = await self.read_owned_side_effect(db, side_effects_id, user_id)
+            await self.execute_owned(
+                db,
+                delete(SideEffect).where(SideEffect.side_effects_id == side_effects_id, SideEffect.user_id == user_id),
+                owner_query=select(SideEffect.user_id).filter(SideEffect.side_effects_id == side_effects_id),
+                user_id=user_id,
+                not_found_detail="Side effect not found",
+                forbidden_detail="You do not have permission to delete this side effect"
+            )
+            if old is not None:
+                await apply_rollup(db, rollup_deltas([old], sign=-1))
+            await record_deletes(db, user_id, "side_effect", [side_effects_id])
+            await db.commit()
+            return DataAccessOperations.DataAccessResult(success=True, result_data=None)
+        except SQLAlchemyError as e:
+            await db.rollback()  # Rollback in case of an error
+            raise HTTPException(
+                status_code=500,
+                detail="An error occurred while deleting the side effect."
+            )
+
+    # (medication_id, created_at, side_effect_desc) of a side effect of the user, locked until the transaction ends
+    # None if there is no such side effect (or it is not the user's) -- execute_owned then raises the 404 / 403
+    async def read_owned_side_effect(self, db: AsyncSession, side_effects_id: int, user_id: str):
+        result = await db.execute(
+            select(SideEffect.medication_id, SideEffect.created_at, SideEffect.side_effect_desc)
+            .where(SideEffect.side_effects_id == side_effects_id, SideEffect.user_id == user_id)
+            .with_for_update()
+        )
+        return result.first()
+
+    # Runs an UPDATE / DELETE whose WHERE clause already limits it to rows owned by user_id,
+    # so the normal case is a single round trip with no SELECT first.
+    # Only when nothing matched do we look up the owner (owner_query selects the owning user_id)
+    # to tell "does not exist" (404) apart from "not yours" (403).
+    # Returns the result -- rowcount can still be 0 if the owner matched but the row itself is missing
+    # (e.g. a prescription detail on the user's own prescription). Does not commit.
+    async def execute_owned(self, db: AsyncSession, statement, owner_query, user_id: str, not_found_detail: str, forbidden_detail: str):
+        result = await db.execute(statement.execution_options(synchronize_session=False))
+        if result.rowcount > 0:
+            return result
+        await self.check_owner(db, owner_query, user_id, not_found_detail, forbidden_detail)
+        return result
+
+    # Raises 404 if owner_query finds nothing and 403 if the row belongs to someone else
+    async def check_owner(self, db: AsyncSession, owner_query, user_id: str, not_found_detail: str, forbidden_detail: str):
+        owner = await db.execute(owner_query)
+        owner = owner.scalars().first()
+        if owner is None:
+            await db.rollback()
+            raise HTTPException(status_code=404, detail=not_found_detail)
+        if owner != user_id:
+            await db.rollback()
+            raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail=forbidden_detail)
 
     async def query_db(self, db: AsyncSession, query: any):
         try:
@@ -944,9 +1345,10 @@ class DataAccessOperations:
 
     # POPO representing the result of data access operations
     class DataAccessResult:
-        def __init__(self, success: bool, result_data: List = None):
+        def __init__(self, success: bool, result_data: List = None, next_cursor: Optional[str] = None):
             self.success = success
             self.result_data = result_data or []
+            self.next_cursor = next_cursor  # cursor for the next page when the result is paginated
 
 
 data_access_operations = DataAccessOperations()
@@ -966,30 +1368,65 @@ async def create_side_effect(data_to_insert: SideEffectCreate, db: AsyncSession
             status_code=400,
             detail=f"Unable to insert side effect for user: {current_user.user_id}"
         )
+    await response_cache.invalidate(current_user.user_id)
 
     return result.result_data[0]
 
-#read all side Effects for current user
+# Create many Side Effects in one call -- for clients syncing offline logs
+@app.post("/side_effects/batch", response_model=List[SideEffectRead])
+async def create_side_effects_batch(data_to_insert: List[SideEffectCreate], db: AsyncSession = Depends(get_db), current_user: UserRead = Depends(get_current_user)):
+    check_batch_size(data_to_insert)
+
+    result = await data_access_operations.insert_side_effects(db=db, incoming_side_effects=data_to_insert, user_id=current_user.user_id)
+
+    if not result.success:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Unable to insert side effects for user: {current_user.user_id}"
+        )
+    await response_cache.invalidate(current_user.user_id)
+
+    return result.result_data
+
+#read all side Effects for current user -- one page at a time, ordered by created_at
+# optional filters: medication_id, created_at range (date_from / date_to)
+# pass the X-Next-Cursor response header back as cursor to get the next page
+# pages are cached per user until the user's side effects change (see response_cache.py)
 @app.get("/side_effects/", response_model=List[SideEffectRead])
-async def read_side_effect_for_user(db: AsyncSession = Depends(get_db), current_user: UserRead = Depends(get_current_user)):
+async def read_side_effect_for_user(
+    request: Request,
+    medication_id: Optional[int] = None,
+    date_from: Optional[datetime] = None,
+    date_to: Optional[datetime] = None,
+    cursor: Optional[str] = None,
+    limit: int = Query(DEFAULT_PAGE_LIMIT, ge=1, le=MAX_PAGE_LIMIT),
+    db: AsyncSession = Depends(get_user_read_db),
+    user_id: str = Depends(get_current_user_id)
+):
+    cache_key = await response_cache.key(request, user_id)
+    cached = await response_cache.get(cache_key)
+    if cached is not None:
+        return cached
 
     # Query the side effects for the user, now including the medication name
-    result = await data_access_operations.read_side_effects_for_user(db=db, user_id=current_user.user_id)
+    result = await data_access_operations.read_side_effects_for_user(
+        db=db, user_id=user_id, medication_id=medication_id, date_from=date_from, date_to=date_to, cursor=cursor, limit=limit
+    )
 
     # If the result is not successful, raise an error
     if not result.success:
         raise HTTPException(
             status_code=400,
-            detail=f"Unable to retrieve side effects for user: {current_user.user_id}"
+            detail=f"Unable to retrieve side effects for user: {user_id}"
         )
 
     # Return the list of side effects, which now includes medication names
-    return result.result_data
+    return await response_cache.put(cache_key, dump_json(result.result_data), result.next_cursor)
 
 
 # Read all Side Effects for a Medication for current User with Medication Name
 @app.get("/side_effects/medication/{medication_id}/user/", response_model=List[SideEffectRead])
-async def read_side_effect_for_medication_and_user(medication_id: str, db: AsyncSession = Depends(get_db), current_user: UserRead = Depends(get_current_user)):
+async def read_side_effect_for_medication_and_user(medication_id: str, db: AsyncSession = Depends(get_user_read_db), user_id: str = Depends(get_current_user_id)):
     # Validate the medication_id and user_id inputs
     if not medication_id or not medication_id.strip():
         raise HTTPException(
@@ -998,70 +1435,114 @@ async def read_side_effect_for_medication_and_user(medication_id: str, db: Async
         )
 
     # Query the side effects for the specified medication and user along with the medication name
-    result = await data_access_operations.read_side_effects_for_medication_and_user(db=db, medication_id=medication_id, user_id=current_user.user_id)
+    result = await data_access_operations.read_side_effects_for_medication_and_user(db=db, medication_id=medication_id, user_id=user_id)
 
     # If the result is not successful, raise an error
     if not result.success:
         raise HTTPException(
             status_code=400,
-            detail=f"Unable to retrieve side effects for medication id: {medication_id} and user id: {current_user.user_id}"
+            detail=f"Unable to retrieve side effects for medication id: {medication_id} and user id: {user_id}"
         )
 
     # Return the list of side effects
     return result.result_data
 
-# Delete Side Effect
-# Delete Side Effect
-@app.delete("/side_effects/{side_effects_id}", response_model=SideEffectDeleteResponse)
-async def delete_side_effect(side_effects_id: int, db: AsyncSession = Depends(get_db), current_user: UserRead = Depends(get_current_user)):
-    # Fetch the side effect from the database
-    result = await db.execute(select(SideEffect).filter(SideEffect.side_effects_id == side_effects_id))
-    side_effect = result.scalars().first()
+# Side effect counts per medication over all users, most reported first (GET)
+# read from the side effect rollup (see side_effect_rollup.py) -- optional day range date_from / date_to
+@app.get("/side_effects/stats", response_model=List[SideEffectMedicationCount])
+async def read_side_effect_stats(
+    date_from: Optional[date] = None,
+    date_to: Optional[date] = None,
+    limit: int = Query(DEFAULT_PAGE_LIMIT, ge=1, le=MAX_PAGE_LIMIT),
+    db: AsyncSession = Depends(get_read_db),
+    user_id: str = Depends(get_current_user_id)
+):
+    totals = await medication_totals(db, date_from=date_from, date_to=date_to, limit=limit)
+    medications = await medication_catalog.get_medications(db, [medication_id for medication_id, _ in totals])
+    return [
+        SideEffectMedicationCount(
+            medication_id=medication_id,
+            medication_name=medications[medication_id].medication_name if medication_id in medications else None,
+            side_effect_count=count
+        )
+        for medication_id, count in totals
+    ]
 
-    if not side_effect:
-        raise HTTPException(status_code=404, detail="Side effect not found")
+# Side effect counts for one medication over all users -- per day and the most reported descriptions (GET)
+@app.get("/side_effects/stats/{medication_id}", response_model=SideEffectMedicationStats)
+async def read_side_effect_stats_for_medication(
+    medication_id: int,
+    date_from: Optional[date] = None,
+    date_to: Optional[date] = None,
+    top: int = Query(20, ge=1, le=MAX_PAGE_LIMIT),
+    db: AsyncSession = Depends(get_read_db),
+    user_id: str = Depends(get_current_user_id)
+):
+    # Check if the medication exists (medication catalog)
+    medication = await medication_catalog.get_medication(db, medication_id)
+    if not medication:
+        raise HTTPException(
+            status_code=404,
+            detail=f"Medication with id {medication_id} not found."
+        )
 
-    # Check if the side effect belongs to the current user
-    if side_effect.user_id != current_user.user_id:
-        raise HTTPException(status_code=403, detail="You do not have permission to delete this side effect")
+    by_day, top_descriptions = await medication_breakdown(db, medication_id, date_from=date_from, date_to=date_to, top=top)
+    return SideEffectMedicationStats(
+        medication_id=medication_id,
+        medication_name=medication.medication_name,
+        side_effect_count=sum(count for _, count in by_day),
+        by_day=[SideEffectDayCount(rollup_day=day, side_effect_count=count) for day, count in by_day],
+        top_descriptions=[SideEffectDescCount(side_effect_desc=desc, side_effect_count=count) for desc, count in top_descriptions]
+    )
 
-    result = await data_access_operations.delete_side_effect(db=db, side_effects_id=side_effects_id)
+# Delete Side Effect
+# one conditional DELETE (id + user_id) -- see DataAccessOperations.execute_owned
+@app.delete("/side_effects/{side_effects_id}", response_model=SideEffectDeleteResponse)
+async def delete_side_effect(side_effects_id: int, db: AsyncSession = Depends(get_db), current_user: UserRead = Depends(get_current_user)):
+    result = await data_access_operations.delete_side_effect(db=db, side_effects_id=side_effects_id, user_id=current_user.user_id)
 
     if result.success:
+        await response_cache.invalidate(current_user.user_id)
         return SideEffectDeleteResponse(msg="Side effect successfully deleted.", side_effects_id=side_effects_id)
     else:
         return SideEffectDeleteResponse(msg="Failed to delete side effect.", side_effects_id=None)
 
 
 # Update Side Effect
+# one conditional UPDATE (id + user_id), then the updated row is read back in the same transaction
 @app.put("/side_effects/{side_effects_id}", response_model=SideEffectRead)
 async def side_effects_update(side_effects_id: int, update_data: SideEffectUpdate, db: AsyncSession = Depends(get_db), current_user: UserRead = Depends(get_current_user)):
-    # Fetch the side effect from the database
-    side_effect = await db.execute(select(SideEffect).where(SideEffect.side_effects_id == side_effects_id))
-    side_effect = side_effect.scalar_one_or_none()
-    # check if side effect exists 
-    if not side_effect:
-        raise HTTPException(
-            status_code=404,
-            detail=f"Side effect with id {side_effects_id} not found."
-        )
-    
-    # Check if the side effect belongs to the current user
-    if side_effect.user_id != current_user.user_id:
-        raise HTTPException(status_code=403, detail="You do not have permission to update this side effect")
-
-
+    # Update the updated_at field to current UTC time
+    values = {"updated_at": datetime.now(timezone.utc)}
     # Update the side effect description if provided
     if update_data.side_effect_desc:
-        side_effect.side_effect_desc = update_data.side_effect_desc
-
-    # Update the updated_at field to current UTC time
-    side_effect.updated_at = datetime.now(timezone.utc)
+        values["side_effect_desc"] = update_data.side_effect_desc
 
     try:
+        old = await data_access_operations.read_owned_side_effect(db, side_effects_id, current_user.user_id)
+        values["change_seq"] = await next_change_seq(db, current_user.user_id)
+        await data_access_operations.execute_owned(
+            db,
+            update(SideEffect)
+            .where(SideEffect.side_effects_id == side_effects_id, SideEffect.user_id == current_user.user_id)
+            .values(**values),
+            owner_query=select(SideEffect.user_id).filter(SideEffect.side_effects_id == side_effects_id),
+            user_id=current_user.user_id,
+            not_found_detail=f"Side effect with id {side_effects_id} not found.",
+            forbidden_detail="You do not have permission to update this side effect"
+        )
+        # New description -- move the count to its rollup bucket (nothing to do if it normalizes to the same one)
+        if old is not None and "side_effect_desc" in values:
+            medication_id, created_at, _ = old
+            deltas = rollup_deltas([old], sign=-1)
+            deltas.update(rollup_deltas([(medication_id, created_at, values["side_effect_desc"])]))
+            await apply_rollup(db, deltas)
+        side_effect = await db.execute(select(SideEffect).where(SideEffect.side_effects_id == side_effects_id))
+        side_effect = side_effect.scalar_one_or_none()
+
         # Commit the changes
         await db.commit()
-        await db.refresh(side_effect)  # Refresh to get updated data from database
+        await response_cache.invalidate(current_user.user_id)
 
         # Return the updated side effect
         return side_effect  # This will be serialized via the SideEffectRead model
@@ -1073,7 +1554,6 @@ async def side_effects_update(side_effects_id: int, update_data: SideEffectUpdat
             status_code=500,
             detail="An error occurred while updating the side effect."
         )
-    
 
 
 
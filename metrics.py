@@ -0,0 +1,333 @@
+# this is the file for the Prometheus metrics (GET /metrics)
+# What is recorded:
+#   - per route (the route template, eg. /prescriptions/{prescription_id}, so ids don't make new series):
+#     request count by status, latency histogram, DB statements per request histogram, DB time, pool wait / hold time
+#   - per engine (primary / read): statements and statement time, pool checkout wait / hold histograms, and the
+#     connections in use / pool size read straight from the pool when /metrics is scraped
+#   - the metrics() / stats() dicts the app already keeps (password hasher, caches, dispatcher ...) as gauges
+# The middleware keeps one small RequestStats per request in a contextvar, the SQLAlchemy hooks add to it.
+# Everything else is a handful of counters updated in place -- nothing is allocated per request apart from that.
+# Each uvicorn worker has its own numbers (scrape every worker, or run one worker per container).
+import bisect
+import time
+from contextvars import ContextVar
+from typing import Callable, Dict, List, Optional, Tuple
+from sqlalchemy import event
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)   # seconds
+STATEMENT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)                                # DB statements per request
+POOL_WAIT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 30.0)            # seconds waiting for a connection
+POOL_HOLD_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 5.0)     # seconds a connection was checked out
+
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+UNMATCHED_ROUTE = "unmatched"  # requests that matched no route (404s) share one series
+
+
+class Histogram:
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets: tuple):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # last slot is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+# What one request did -- kept in request_stats while the request runs
+class RequestStats:
+    __slots__ = ("scope", "statements", "db_seconds", "pool_wait_seconds", "pool_hold_seconds")
+
+    def __init__(self, scope: dict):
+        self.scope = scope  # the ASGI scope -- scope["route"] is the matched route once routing is done
+        self.statements = 0
+        self.db_seconds = 0.0
+        self.pool_wait_seconds = 0.0
+        self.pool_hold_seconds = 0.0
+
+
+request_stats: ContextVar[Optional[RequestStats]] = ContextVar("request_stats", default=None)
+
+
+class RouteMetrics:
+    __slots__ = ("latency", "statements", "db_seconds", "pool_wait_seconds", "pool_hold_seconds", "status_counts")
+
+    def __init__(self):
+        self.latency = Histogram(LATENCY_BUCKETS)
+        self.statements = Histogram(STATEMENT_BUCKETS)
+        self.db_seconds = 0.0
+        self.pool_wait_seconds = 0.0
+        self.pool_hold_seconds = 0.0
+        self.status_counts: Dict[int, int] = {}
+
+
+class EngineMetrics:
+    __slots__ = ("engine", "statements", "statement_seconds", "pool_wait", "pool_hold")
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.statements = 0
+        self.statement_seconds = 0.0
+        self.pool_wait = Histogram(POOL_WAIT_BUCKETS)
+        self.pool_hold = Histogram(POOL_HOLD_BUCKETS)
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.routes: Dict[Tuple[str, str], RouteMetrics] = {}   # (method, route template) -> metrics
+        self.engines: Dict[str, EngineMetrics] = {}              # "primary" / "read" -> metrics
+        self.collectors: Dict[str, Callable[[], dict]] = {}      # component -> its metrics() / stats()
+
+    def observe_request(self, method: str, route: str, status_code: int, seconds: float, stats: RequestStats):
+        metrics = self.routes.get((method, route))
+        if metrics is None:
+            metrics = self.routes[(method, route)] = RouteMetrics()
+        metrics.latency.observe(seconds)
+        metrics.statements.observe(stats.statements)
+        metrics.db_seconds += stats.db_seconds
+        metrics.pool_wait_seconds += stats.pool_wait_seconds
+        metrics.pool_hold_seconds += stats.pool_hold_seconds
+        metrics.status_counts[status_code] = metrics.status_counts.get(status_code, 0) + 1
+
+    # Add a component whose metrics() dict is exported as gauges (numbers only, nested dicts are flattened)
+    def register_collector(self, component: str, collect: Callable[[], dict]):
+        self.collectors[component] = collect
+
+    def render(self) -> str:
+        lines: List[str] = []
+        _render_routes(lines, self.routes)
+        _render_engines(lines, self.engines)
+        _render_collectors(lines, self.collectors)
+        return "\n".join(lines) + "\n"
+
+
+# Shared registry used by the API
+registry = MetricsRegistry()
+
+
+# ---- ASGI middleware ----
+
+class MetricsMiddleware:
+    """
+    Times every HTTP request and files it under its route template once the route is known.
+    Plain ASGI (not BaseHTTPMiddleware) so responses are not buffered or copied.
+    """
+
+    def __init__(self, app, registry: MetricsRegistry = registry):
+        self.app = app
+        self.registry = registry
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        stats = RequestStats(scope)
+        token = request_stats.set(stats)
+        status_code = 500  # an exception before the response starts ends up as a 500
+        started = time.perf_counter()
+
+        async def send_with_status(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            seconds = time.perf_counter() - started
+            request_stats.reset(token)
+            route = scope.get("route")  # set by FastAPI when a route matched
+            self.registry.observe_request(scope["method"], route.path if route is not None else UNMATCHED_ROUTE,
+                                          status_code, seconds, stats)
+
+
+# ---- SQLAlchemy hooks ----
+
+class InstrumentedQueuePool(AsyncAdaptedQueuePool):
+    """AsyncAdaptedQueuePool that times how long each checkout waits for a connection (incl. opening a new one)."""
+
+    metrics_name = "primary"
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            waited = time.perf_counter() - started
+            engine_metrics = registry.engines.get(self.metrics_name)
+            if engine_metrics is not None:
+                engine_metrics.pool_wait.observe(waited)
+            stats = request_stats.get()
+            if stats is not None:
+                stats.pool_wait_seconds += waited
+
+    # engine.dispose() swaps in a new pool made by recreate() -- keep the name
+    def recreate(self):
+        pool = super().recreate()
+        pool.metrics_name = self.metrics_name
+        return pool
+
+
+# Count statements and statement time for an engine (database.py calls this for the primary and the read engine)
+def instrument_engine(engine, name: str):
+    engine_metrics = registry.engines[name] = EngineMetrics(engine)
+    if isinstance(engine.pool, InstrumentedQueuePool):
+        engine.pool.metrics_name = name
+
+    @event.listens_for(engine.sync_engine, "before_cursor_execute")
+    def start_timer(conn, cursor, statement, parameters, context, executemany):
+        if context is not None:
+            context._metrics_started = time.perf_counter()
+
+    # How long each connection stays checked out (first statement of a session until commit / rollback / close)
+    @event.listens_for(engine.sync_engine.pool, "checkout")
+    def checked_out(dbapi_connection, connection_record, connection_proxy):
+        connection_record.info["checked_out_at"] = time.perf_counter()
+
+    @event.listens_for(engine.sync_engine.pool, "checkin")
+    def checked_in(dbapi_connection, connection_record):
+        started = connection_record.info.pop("checked_out_at", None)
+        if started is None:
+            return
+        held = time.perf_counter() - started
+        engine_metrics.pool_hold.observe(held)
+        stats = request_stats.get()
+        if stats is not None:
+            stats.pool_hold_seconds += held
+
+    @event.listens_for(engine.sync_engine, "after_cursor_execute")
+    def stop_timer(conn, cursor, statement, parameters, context, executemany):
+        started = getattr(context, "_metrics_started", None)
+        if started is None:
+            return
+        seconds = time.perf_counter() - started
+        engine_metrics.statements += 1
+        engine_metrics.statement_seconds += seconds
+        stats = request_stats.get()
+        if stats is not None:
+            stats.statements += 1
+            stats.db_seconds += seconds
+
+
+# ---- Prometheus text format ----
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(**labels) -> str:
+    return ",".join(f'{name}="{_escape(value)}"' for name, value in labels.items())
+
+
+def _format_number(value: float) -> str:
+    if isinstance(value, float):
+        return repr(round(value, 6))
+    return str(value)
+
+
+def _histogram_lines(lines: List[str], name: str, labels: str, histogram: Histogram):
+    cumulative = 0
+    prefix = labels + "," if labels else ""
+    for bound, count in zip(histogram.buckets, histogram.counts):
+        cumulative += count
+        lines.append(f'{name}_bucket{{{prefix}le="{bound}"}} {cumulative}')
+    lines.append(f'{name}_bucket{{{prefix}le="+Inf"}} {histogram.count}')
+    lines.append(f"{name}_sum{{{labels}}} {_format_number(histogram.sum)}")
+    lines.append(f"{name}_count{{{labels}}} {histogram.count}")
+
+
+def _render_routes(lines: List[str], routes: Dict[Tuple[str, str], RouteMetrics]):
+    items = sorted(routes.items())
+    lines.append("# HELP http_requests_total HTTP requests by route and status code")
+    lines.append("# TYPE http_requests_total counter")
+    for (method, route), metrics in items:
+        for status_code, count in sorted(metrics.status_counts.items()):
+            lines.append(f"http_requests_total{{{_labels(method=method, route=route, status=status_code)}}} {count}")
+
+    lines.append("# HELP http_request_duration_seconds Time to handle a request, by route")
+    lines.append("# TYPE http_request_duration_seconds histogram")
+    for (method, route), metrics in items:
+        _histogram_lines(lines, "http_request_duration_seconds", _labels(method=method, route=route), metrics.latency)
+
+    lines.append("# HELP http_request_db_statements DB statements run by one request, by route")
+    lines.append("# TYPE http_request_db_statements histogram")
+    for (method, route), metrics in items:
+        _histogram_lines(lines, "http_request_db_statements", _labels(method=method, route=route), metrics.statements)
+
+    lines.append("# HELP http_request_db_seconds_total Time spent in DB statements, by route")
+    lines.append("# TYPE http_request_db_seconds_total counter")
+    for (method, route), metrics in items:
+        lines.append(f"http_request_db_seconds_total{{{_labels(method=method, route=route)}}} {_format_number(metrics.db_seconds)}")
+
+    lines.append("# HELP http_request_pool_hold_seconds_total Time DB connections were checked out, by route")
+    lines.append("# TYPE http_request_pool_hold_seconds_total counter")
+    for (method, route), metrics in items:
+        lines.append(f"http_request_pool_hold_seconds_total{{{_labels(method=method, route=route)}}} {_format_number(metrics.pool_hold_seconds)}")
+
+    lines.append("# HELP http_request_pool_wait_seconds_total Time spent waiting for a DB connection, by route")
+    lines.append("# TYPE http_request_pool_wait_seconds_total counter")
+    for (method, route), metrics in items:
+        lines.append(f"http_request_pool_wait_seconds_total{{{_labels(method=method, route=route)}}} {_format_number(metrics.pool_wait_seconds)}")
+
+
+def _render_engines(lines: List[str], engines: Dict[str, EngineMetrics]):
+    items = sorted(engines.items())
+    lines.append("# HELP db_statements_total DB statements run (requests and background work)")
+    lines.append("# TYPE db_statements_total counter")
+    for name, metrics in items:
+        lines.append(f"db_statements_total{{{_labels(engine=name)}}} {metrics.statements}")
+    lines.append("# HELP db_statement_seconds_total Time spent in DB statements")
+    lines.append("# TYPE db_statement_seconds_total counter")
+    for name, metrics in items:
+        lines.append(f"db_statement_seconds_total{{{_labels(engine=name)}}} {_format_number(metrics.statement_seconds)}")
+
+    lines.append("# HELP db_pool_checkout_wait_seconds Time a checkout waited for a pooled connection")
+    lines.append("# TYPE db_pool_checkout_wait_seconds histogram")
+    for name, metrics in items:
+        _histogram_lines(lines, "db_pool_checkout_wait_seconds", _labels(engine=name), metrics.pool_wait)
+
+    lines.append("# HELP db_pool_hold_seconds Time a connection was checked out before it went back to the pool")
+    lines.append("# TYPE db_pool_hold_seconds histogram")
+    for name, metrics in items:
+        _histogram_lines(lines, "db_pool_hold_seconds", _labels(engine=name), metrics.pool_hold)
+
+    gauges = (
+        ("db_pool_connections_in_use", "Connections checked out of the pool right now", "checkedout"),
+        ("db_pool_connections_idle", "Connections open and waiting in the pool", "checkedin"),
+        ("db_pool_size", "Configured pool size", "size"),
+        ("db_pool_overflow", "Connections open beyond the pool size (negative = pool not full yet)", "overflow"),
+    )
+    for metric, help_text, method in gauges:
+        lines.append(f"# HELP {metric} {help_text}")
+        lines.append(f"# TYPE {metric} gauge")
+        for name, metrics in items:
+            read = getattr(metrics.engine.pool, method, None)
+            if read is not None:
+                lines.append(f"{metric}{{{_labels(engine=name)}}} {read()}")
+
+
+# {"a": 1, "b": {"c": 2}} -> [("a", 1), ("b_c", 2)], leaving out anything that isn't a number
+def _flatten(values: dict, prefix: str = ""):
+    for key, value in values.items():
+        name = f"{prefix}{key}"
+        if isinstance(value, dict):
+            yield from _flatten(value, name + "_")
+        elif isinstance(value, bool):
+            yield name, int(value)
+        elif isinstance(value, (int, float)):
+            yield name, value
+
+
+def _render_collectors(lines: List[str], collectors: Dict[str, Callable[[], dict]]):
+    lines.append("# HELP app_component_value Numbers from the app's own metrics() / stats() (hasher, caches, dispatcher ...)")
+    lines.append("# TYPE app_component_value gauge")
+    for component, collect in sorted(collectors.items()):
+        for name, value in _flatten(collect()):
+            lines.append(f"app_component_value{{{_labels(component=component, metric=name)}}} {_format_number(value)}")
@@ -2,7 +2,7 @@
 # This is the file for creating the SQL aclchemy schema and tables -- reflects the tables and relationships in the database
 
 from sqlalchemy import (
-    create_engine, Integer, String, DateTime, ForeignKey, Text, Date
+    create_engine, Integer, BigInteger, String, DateTime, ForeignKey, Text, Date, Index, Float
 )
 from sqlalchemy.orm import declarative_base, relationship, Mapped, mapped_column
 from typing import Optional, List
@@ -62,14 +62,24 @@ class Notification(Base):
     notification_message: Mapped[Optional[str]] = mapped_column(String(150), nullable=True)
     notification_date: Mapped[Optional[DateTime]] = mapped_column(DateTime, nullable=True)
     notification_status: Mapped[Optional[int]] = mapped_column(Integer, nullable=True, comment='0 = sent, 1 = read')
+    claimed_at: Mapped[Optional[DateTime]] = mapped_column(DateTime, nullable=True, comment='Set while a dispatcher is sending it (see notification_dispatcher.py)')
 
      # Timestamps to track when the user is created or updated
     created_at: Mapped[DateTime] = mapped_column(DateTime, default=func.now(), comment="Creation timestamp")
     updated_at: Mapped[DateTime] = mapped_column(DateTime, default=func.now(), onupdate=func.now(), comment="Last update timestamp")
+    change_seq: Mapped[Optional[int]] = mapped_column(BigInteger, nullable=True, comment='Change counter of the user when last written, for GET /sync (see sync.py)')
 
     #relationships 
     user: Mapped[User] = relationship('User', back_populates='notifications')
 
+    # Indexes for the paginated list (GET /notifications), the due query of the
+    # notification dispatcher and GET /sync -- also in schema_updates.sql
+    __table_args__ = (
+        Index('ix_notification_user_created', 'user_id', 'created_at', 'notification_id'),
+        Index('ix_notification_status_date', 'notification_status', 'notification_date'),
+        Index('ix_notification_user_change', 'user_id', 'change_seq'),
+    )
+
 
 class Prescription(Base):
     __tablename__ = 'prescription'
@@ -79,10 +89,19 @@ class Prescription(Base):
     prescription_date_end: Mapped[Optional[Date]] = mapped_column(Date, nullable=True)
     prescription_status: Mapped[Optional[int]] = mapped_column(Integer, nullable=True, comment='0 = active, 1 = archive')
     user_id: Mapped[str] = mapped_column(String(25), ForeignKey('user.user_id'))
+    # Last change, for GET /sync (see sync.py)
+    updated_at: Mapped[DateTime] = mapped_column(DateTime, default=func.now(), onupdate=func.now(), comment="Last update timestamp")
+    change_seq: Mapped[Optional[int]] = mapped_column(BigInteger, nullable=True, comment='Change counter of the user when last written, for GET /sync (see sync.py)')
 
     user: Mapped[User] = relationship('User', back_populates='prescriptions')
     prescription_details: Mapped[List['PrescriptionDetail']] = relationship('PrescriptionDetail', back_populates='prescription', cascade='all, delete-orphan', lazy="selectin")
 
+    # Indexes for the paginated list (GET /prescriptions/) and GET /sync -- also in schema_updates.sql
+    __table_args__ = (
+        Index('ix_prescription_user_status', 'user_id', 'prescription_status', 'prescription_id'),
+        Index('ix_prescription_user_change', 'user_id', 'change_seq'),
+    )
+
 
 class PrescriptionDetail(Base):
     __tablename__ = 'prescription_detail'
@@ -93,10 +112,22 @@ class PrescriptionDetail(Base):
     presc_qty: Mapped[Optional[int]] = mapped_column(Integer, nullable=True)
     presc_type: Mapped[Optional[str]] = mapped_column(String(15), nullable=True, comment='Grams, Milligrams, Drops')
     presc_frequency: Mapped[Optional[str]] = mapped_column(String(45), nullable=True)
+    # Parsed from presc_frequency / presc_dose / presc_type when the detail is written (see dosing.py)
+    presc_doses_per_day: Mapped[Optional[float]] = mapped_column(Float, nullable=True, comment='Doses per day parsed from presc_frequency')
+    presc_schedule: Mapped[Optional[str]] = mapped_column(String(160), nullable=True, comment='Encoded dose schedule: doses/day|interval hours|times of day (minutes)|amount|unit')
+    # Last change, for GET /sync (see sync.py)
+    updated_at: Mapped[DateTime] = mapped_column(DateTime, default=func.now(), onupdate=func.now(), comment="Last update timestamp")
+    change_seq: Mapped[Optional[int]] = mapped_column(BigInteger, nullable=True, comment="Change counter of the prescription's user when last written, for GET /sync (see sync.py)")
 
     medication: Mapped[Medication] = relationship('Medication', back_populates='prescription_details')
     prescription: Mapped[Prescription] = relationship('Prescription', back_populates='prescription_details')
 
+    # Index for GET /sync -- details have no user_id, they are found through the user's prescriptions
+    # also in schema_updates.sql
+    __table_args__ = (
+        Index('ix_prescription_detail_change', 'prescription_id', 'change_seq'),
+    )
+
 
 class SideEffect(Base):
     __tablename__ = 'side_effect'
@@ -114,5 +145,50 @@ class SideEffect(Base):
     # Timestamps to track when the user is created or updated
     created_at: Mapped[DateTime] = mapped_column(DateTime, default=func.now(), comment="Creation timestamp")
     updated_at: Mapped[DateTime] = mapped_column(DateTime, default=func.now(), onupdate=func.now(), comment="Last update timestamp")
+    change_seq: Mapped[Optional[int]] = mapped_column(BigInteger, nullable=True, comment='Change counter of the user when last written, for GET /sync (see sync.py)')
+
+    # Indexes for the paginated list (GET /side_effects/) and GET /sync -- also in schema_updates.sql
+    __table_args__ = (
+        Index('ix_side_effect_user_created', 'user_id', 'created_at', 'side_effects_id'),
+        Index('ix_side_effect_user_med_created', 'user_id', 'medication_id', 'created_at', 'side_effects_id'),
+        Index('ix_side_effect_user_change', 'user_id', 'change_seq'),
+    )
+
+
+# Side effects counted per medication, day (created_at) and normalized description
+# kept current by every write to side_effect (see side_effect_rollup.py) -- also in schema_updates.sql
+class SideEffectRollup(Base):
+    __tablename__ = 'side_effect_rollup'
 
+    medication_id: Mapped[int] = mapped_column(Integer, ForeignKey('medication.medication_id'), primary_key=True)
+    rollup_day: Mapped[Date] = mapped_column(Date, primary_key=True, comment='Day the side effects were logged (created_at)')
+    side_effect_desc_norm: Mapped[str] = mapped_column(String(255), primary_key=True, comment='side_effect_desc lower case, trimmed, single spaced')
+    side_effect_count: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+
+
+# One row per deleted prescription / prescription detail / notification / side effect, so GET /sync can tell a
+# client what to remove (see sync.py) -- also in schema_updates.sql
+# no foreign key to user: the rows are removed together with the user, and pruned after SYNC_TOMBSTONE_DAYS
+class SyncTombstone(Base):
+    __tablename__ = 'sync_tombstone'
+
+    tombstone_id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
+    user_id: Mapped[str] = mapped_column(String(25), nullable=False)
+    table_name: Mapped[str] = mapped_column(String(30), nullable=False, comment='prescription, prescription_detail, notification or side_effect')
+    row_key: Mapped[str] = mapped_column(String(45), nullable=False, comment='Primary key of the deleted row, prescription_detail: prescription_id:medication_id')
+    deleted_at: Mapped[DateTime] = mapped_column(DateTime, nullable=False, default=func.now())
+    change_seq: Mapped[int] = mapped_column(BigInteger, nullable=False, comment='Change counter of the user when deleted')
 
+    __table_args__ = (
+        Index('ix_sync_tombstone_user_change', 'user_id', 'change_seq'),
+        Index('ix_sync_tombstone_deleted', 'deleted_at'),
+    )
+
+
+# Change counter per user for GET /sync -- bumped (and locked until commit) by every transaction that changes the
+# user's synced rows, see sync.py -- also in schema_updates.sql
+class SyncCounter(Base):
+    __tablename__ = 'sync_counter'
+
+    user_id: Mapped[str] = mapped_column(String(25), primary_key=True)
+    change_seq: Mapped[int] = mapped_column(BigInteger, nullable=False, default=0)
@@ -0,0 +1,259 @@
+# this is the file for firing notifications when their notification_date comes around
+# a background task (started in the app lifespan when settings.notification_sender names a sender, see
+# tokens.py -- with no sender it does not run, the rows stay unsent) keeps pulling notifications that are
+# due (notification_status is NULL and notification_date <= now) in batches, hands each batch to the
+# sender and marks the whole batch sent (notification_status = 0) with one UPDATE.
+# Notifications more than DISPATCH_MAX_LATENESS_SECONDS past their date are never sent -- a reminder to take
+# a dose hours late does more harm than good, and the rows written before the dispatcher existed all have
+# a NULL status (they must not all go out on the first deploy).
+# The due query walks the (notification_status, notification_date) index, so it stays cheap no matter
+# how many rows are in the table. Every uvicorn worker runs its own dispatcher: a batch is claimed (claimed_at
+# set, with SELECT ... FOR UPDATE SKIP LOCKED on MySQL) and committed before it is sent, so two workers never
+# send the same notification and no row locks are held while the sender talks to the push provider.
+# A claim older than DISPATCH_CLAIM_TIMEOUT_SECONDS (a worker that died mid-send) can be claimed again --
+# delivery is at least once.
+import asyncio
+import importlib
+import logging
+import time
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from typing import Awaitable, Callable, Iterable, List, Optional
+from sqlalchemy import case, func, or_, update
+from sqlalchemy.future import select
+from .database import AsyncSessionLocal
+from .models import Notification
+from .response_cache import response_cache
+from .sync import next_change_seqs
+
+logger = logging.getLogger(__name__)
+
+DISPATCH_BATCH_SIZE = 500                # Notifications claimed and marked sent per batch
+DISPATCH_IDLE_SECONDS = 5                # Wait between polls when nothing (or less than a full batch) was due
+DISPATCH_ERROR_BACKOFF_SECONDS = 30      # Wait after a failed batch before trying again
+DISPATCH_MAX_LATENESS_SECONDS = 3600     # Notifications further past their notification_date are skipped
+DISPATCH_CLAIM_TIMEOUT_SECONDS = 300     # A claimed batch not marked sent by then is claimed again
+
+NOTIFICATION_STATUS_SENT = 0             # notification_status values -- NULL = not sent yet, 0 = sent, 1 = read
+
+
+@dataclass
+class DueNotification:
+    notification_id: int
+    user_id: str
+    notification_type: int
+    notification_message: Optional[str]
+    notification_date: datetime
+
+
+# A sender gets one batch of due notifications and returns the notification_ids it could not send (None = all
+# sent) -- those are retried on the next poll. Raising means nothing was sent and the whole batch is retried.
+NotificationSender = Callable[[List[DueNotification]], Awaitable[Optional[Iterable[int]]]]
+
+
+# Sender that only logs -- for local development (NOTIFICATION_SENDER=.notification_dispatcher:log_sender),
+# it marks notifications sent without delivering them
+async def log_sender(notifications: List[DueNotification]) -> None:
+    for notification in notifications:
+        logger.info(
+            "Notification %s for user %s (type %s): %s",
+            notification.notification_id, notification.user_id,
+            notification.notification_type, notification.notification_message,
+        )
+
+
+# settings.notification_sender -> the sender function, eg. "myapp.push:send_batch"
+# a module starting with "." is looked up in this package
+def load_sender(path: str) -> NotificationSender:
+    module_name, _, function_name = path.partition(":")
+    if not module_name or not function_name:
+        raise ValueError(f"Bad notification sender {path!r}, expected module:function")
+    return getattr(importlib.import_module(module_name, package=__package__), function_name)
+
+
+# notification_date is stored as a naive UTC datetime
+def _utcnow() -> datetime:
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+class NotificationDispatcher:
+    def __init__(self, sender: NotificationSender = log_sender, batch_size: int = DISPATCH_BATCH_SIZE,
+                 idle_seconds: float = DISPATCH_IDLE_SECONDS, session_factory=AsyncSessionLocal,
+                 max_lateness_seconds: float = DISPATCH_MAX_LATENESS_SECONDS,
+                 claim_timeout_seconds: float = DISPATCH_CLAIM_TIMEOUT_SECONDS):
+        self.sender = sender
+        self.batch_size = batch_size
+        self.idle_seconds = idle_seconds
+        self.max_lateness = timedelta(seconds=max_lateness_seconds)
+        self.claim_timeout = timedelta(seconds=claim_timeout_seconds)
+        self.session_factory = session_factory
+        self._task: Optional[asyncio.Task] = None
+        self._stopping: Optional[asyncio.Event] = None
+        # Metrics
+        self.batches = 0
+        self.sent = 0
+        self.failed = 0                # notifications the sender returned as not sent
+        self.failed_batches = 0
+        self.busy_seconds = 0.0        # time spent claiming, sending and marking batches
+        self.total_lag_seconds = 0.0   # sum of (sent at - notification_date) over every sent notification
+        self.max_lag_seconds = 0.0
+        self.last_lag_seconds = 0.0    # lag of the oldest notification in the last batch
+        self.last_batch_size = 0
+        self.last_run_at: Optional[datetime] = None
+
+    # Claim one batch of due notifications, send it and mark it sent -- returns the batch size
+    async def dispatch_batch(self) -> int:
+        start = time.perf_counter()
+        due = await self._claim()
+        if not due:
+            return 0
+
+        try:
+            failed = set(await self.sender(due) or ())
+        except Exception:
+            await self._release([n.notification_id for n in due])  # nothing was sent -- retry the whole batch
+            raise
+        sent = [n for n in due if n.notification_id not in failed]
+        await self._mark_sent(sent, failed)
+        for user_id in {n.user_id for n in sent}:
+            await response_cache.invalidate(user_id)  # their cached GET /notifications pages show the old status
+
+        sent_at = _utcnow()
+        lags = [(sent_at - n.notification_date).total_seconds() for n in sent]
+        self.batches += 1
+        self.sent += len(sent)
+        self.failed += len(failed)
+        self.busy_seconds += time.perf_counter() - start
+        self.total_lag_seconds += sum(lags)
+        self.max_lag_seconds = max([self.max_lag_seconds] + lags)
+        self.last_lag_seconds = lags[0] if lags else 0.0
+        self.last_batch_size = len(due)
+        return len(due)
+
+    # Pick a batch of due notifications and set their claimed_at -- committed right away, so the row locks
+    # are only held for the claim and not while the batch is sent
+    async def _claim(self) -> List[DueNotification]:
+        now = _utcnow()
+        async with self.session_factory() as session:
+            try:
+                result = await session.execute(
+                    select(
+                        Notification.notification_id,
+                        Notification.user_id,
+                        Notification.notification_type,
+                        Notification.notification_message,
+                        Notification.notification_date,
+                    )
+                    .where(
+                        Notification.notification_status.is_(None),
+                        Notification.notification_date <= now,
+                        Notification.notification_date >= now - self.max_lateness,
+                        or_(Notification.claimed_at.is_(None), Notification.claimed_at < now - self.claim_timeout),
+                    )
+                    .order_by(Notification.notification_date, Notification.notification_id)
+                    .limit(self.batch_size)
+                    .with_for_update(skip_locked=True)  # Rows another worker is claiming right now are skipped
+                )
+                due = [DueNotification(*row) for row in result.all()]
+                if due:
+                    await session.execute(
+                        update(Notification)
+                        .where(Notification.notification_id.in_([n.notification_id for n in due]))
+                        .values(claimed_at=now)
+                        .execution_options(synchronize_session=False)
+                    )
+                await session.commit()
+            except Exception:
+                await session.rollback()
+                raise
+        return due
+
+    # Sent -> notification_status = 0, failed -> claim dropped so the next poll retries them
+    # sent rows get the next change_seq of their user (GET /sync) and updated_at from the database clock
+    async def _mark_sent(self, sent: List[DueNotification], failed_ids: Iterable[int]):
+        async with self.session_factory() as session:
+            try:
+                if sent:
+                    change_seqs = await next_change_seqs(session, {n.user_id for n in sent})
+                    await session.execute(
+                        update(Notification)
+                        .where(Notification.notification_id.in_([n.notification_id for n in sent]))
+                        .values(
+                            notification_status=NOTIFICATION_STATUS_SENT,
+                            claimed_at=None,
+                            updated_at=func.now(),
+                            change_seq=case(change_seqs, value=Notification.user_id),
+                        )
+                        .execution_options(synchronize_session=False)
+                    )
+                await self._clear_claims(session, list(failed_ids))
+                await session.commit()
+            except Exception:
+                await session.rollback()
+                raise
+
+    async def _release(self, notification_ids: List[int]):
+        async with self.session_factory() as session:
+            await self._clear_claims(session, notification_ids)
+            await session.commit()
+
+    @staticmethod
+    async def _clear_claims(session, notification_ids: List[int]):
+        if notification_ids:
+            await session.execute(
+                update(Notification)
+                .where(Notification.notification_id.in_(notification_ids))
+                .values(claimed_at=None)
+                .execution_options(synchronize_session=False)
+            )
+
+    async def _run(self):
+        logger.info("Notification dispatcher started (batch size %s)", self.batch_size)
+        while not self._stopping.is_set():
+            try:
+                claimed = await self.dispatch_batch()
+                wait = 0 if claimed == self.batch_size else self.idle_seconds  # Full batch -- there may be more due right now
+            except Exception:
+                self.failed_batches += 1
+                logger.exception("Notification dispatch failed, retrying in %ss", DISPATCH_ERROR_BACKOFF_SECONDS)
+                wait = DISPATCH_ERROR_BACKOFF_SECONDS
+            self.last_run_at = _utcnow()
+            if wait:
+                try:
+                    await asyncio.wait_for(self._stopping.wait(), timeout=wait)
+                except asyncio.TimeoutError:
+                    pass
+        logger.info("Notification dispatcher stopped")
+
+    # Called on app startup
+    def start(self):
+        if self._task is None:
+            self._stopping = asyncio.Event()
+            self._task = asyncio.create_task(self._run(), name="notification-dispatcher")
+
+    # Called on app shutdown -- lets the batch in progress finish
+    async def stop(self):
+        if self._task is not None:
+            self._stopping.set()
+            await self._task
+            self._task = None
+
+    def metrics(self) -> dict:
+        return {
+            "running": self._task is not None and not self._task.done(),
+            "batch_size": self.batch_size,
+            "batches": self.batches,
+            "sent": self.sent,
+            "failed": self.failed,
+            "failed_batches": self.failed_batches,
+            "throughput_per_second": round(self.sent / self.busy_seconds, 2) if self.busy_seconds else 0.0,
+            "avg_lag_seconds": round(self.total_lag_seconds / self.sent, 3) if self.sent else 0.0,
+            "max_lag_seconds": round(self.max_lag_seconds, 3),
+            "last_lag_seconds": round(self.last_lag_seconds, 3),
+            "last_batch_size": self.last_batch_size,
+            "last_run_at": self.last_run_at.isoformat() if self.last_run_at else None,
+        }
+
+
+# Shared dispatcher used by the API
+notification_dispatcher = NotificationDispatcher()
@@ -0,0 +1,68 @@
+# this is the file for keyset (cursor) pagination used by the list endpoints
+# instead of OFFSET (which gets slower the further you page) each page remembers the sort key
+# of its last row and the next page starts right after it, so every page is one index range scan.
+# The cursor handed to the client is opaque: base64 of the last row's sort key values.
+import base64
+import json
+from datetime import datetime, date
+from typing import Any, List, Optional, Sequence
+from fastapi import HTTPException
+from sqlalchemy import and_, or_
+
+DEFAULT_PAGE_LIMIT = 100  # Rows per page when the client does not pass limit
+MAX_PAGE_LIMIT = 500      # Largest page a client can ask for
+
+NEXT_CURSOR_HEADER = "X-Next-Cursor"  # Response header holding the cursor for the next page (missing on the last page)
+
+
+def _to_json(value: Any) -> Any:
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    return value
+
+# Build the cursor for the row after the given sort key values
+def encode_cursor(values: Sequence[Any]) -> str:
+    raw = json.dumps([_to_json(v) for v in values], separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+# Read a cursor back into sort key values -- parsers convert each value to the column's python type
+def decode_cursor(cursor: str, *parsers) -> List[Any]:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        values = json.loads(raw)
+        if not isinstance(values, list) or len(values) != len(parsers):
+            raise ValueError("wrong number of values")
+        return [parse(v) if v is not None else None for parse, v in zip(parsers, values)]
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+# WHERE clause for "rows after this sort key" -- written out as
+# (a > x) OR (a = x AND b > y) so MySQL can use it as a range on the (a, b) index
+def keyset_after(columns: Sequence[Any], values: Sequence[Any]):
+    clauses = []
+    for i, (column, value) in enumerate(zip(columns, values)):
+        comparison = column > value
+        equal_before = [c == v for c, v in zip(columns[:i], values[:i])]
+        clauses.append(and_(*equal_before, comparison) if equal_before else comparison)
+    return or_(*clauses)
+
+
+# Add keyset paging to a select
+# fetches one row more than the limit so we know if there is another page
+def paginate(query, columns: Sequence[Any], cursor_values: Optional[Sequence[Any]], limit: int):
+    if cursor_values is not None:
+        query = query.where(keyset_after(columns, cursor_values))
+    return query.order_by(*columns).limit(limit + 1)
+
+# Cut the extra row off a page and work out the next cursor
+# key is a function returning the sort key values of a row
+def split_page(rows: List[Any], limit: int, key) -> tuple:
+    if len(rows) > limit:
+        rows = rows[:limit]
+        return rows, encode_cursor(key(rows[-1]))
+    return rows, None
+
+
+def parse_datetime(value: str) -> datetime:
+    return datetime.fromisoformat(value)
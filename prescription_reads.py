@@ -0,0 +1,72 @@
+# this is the file for the fast read path of prescriptions
+# GET /prescriptions/ and GET /prescriptions/{id} used to load full ORM objects (selectinload of
+# details and medications = 3 queries), copy them into PrescriptionDetailRead / PrescriptionRead
+# pydantic models and then FastAPI validated the models again for the response_model.
+# Here one query selects just the columns the response needs (prescription LEFT JOIN details
+# LEFT JOIN medication), the rows are grouped into plain dicts and turned into JSON bytes
+# in one go by pydantic-core, and the endpoint returns those bytes as-is.
+from typing import Any, Dict, List, Optional, Sequence
+from pydantic_core import to_json
+from sqlalchemy.future import select
+from .models import Prescription, PrescriptionDetail, Medication
+
+
+# Select the columns of PrescriptionRead + PrescriptionDetailRead in one query
+# page is an optional subquery of Prescription (e.g. one page of a user's prescriptions) to join from
+def prescription_rows_query(page=None):
+    source = Prescription if page is None else page
+    columns = Prescription if page is None else page.c
+    return (
+        select(
+            columns.prescription_id,
+            columns.user_id,
+            columns.prescription_date_start,
+            columns.prescription_date_end,
+            columns.prescription_status,
+            PrescriptionDetail.medication_id,
+            Medication.medication_name,
+            PrescriptionDetail.presc_dose,
+            PrescriptionDetail.presc_qty,
+            PrescriptionDetail.presc_type,
+            PrescriptionDetail.presc_frequency,
+        )
+        .select_from(source)
+        .outerjoin(PrescriptionDetail, PrescriptionDetail.prescription_id == columns.prescription_id)
+        .outerjoin(Medication, Medication.medication_id == PrescriptionDetail.medication_id)
+        .order_by(columns.prescription_id, PrescriptionDetail.medication_id)
+    )
+
+
+# Group joined rows (ordered by prescription_id) into PrescriptionRead shaped dicts
+# keys are in the same order as the fields of PrescriptionRead / PrescriptionDetailRead
+def group_prescription_rows(rows: Sequence[Any]) -> List[Dict[str, Any]]:
+    prescriptions = []
+    current: Optional[Dict[str, Any]] = None
+    for row in rows:
+        if current is None or current["prescription_id"] != row.prescription_id:
+            current = {
+                "prescription_id": row.prescription_id,
+                "user_id": row.user_id,
+                "prescription_date_start": row.prescription_date_start,
+                "prescription_date_end": row.prescription_date_end,
+                "prescription_status": row.prescription_status,
+                "prescription_details": [],
+            }
+            prescriptions.append(current)
+        # Outer join -- a prescription without details has one row with NULL detail columns
+        if row.medication_id is not None:
+            current["prescription_details"].append({
+                "prescription_id": row.prescription_id,
+                "medication_id": row.medication_id,
+                "medication_name": row.medication_name,
+                "presc_dose": row.presc_dose,
+                "presc_qty": row.presc_qty,
+                "presc_type": row.presc_type,
+                "presc_frequency": row.presc_frequency,
+            })
+    return prescriptions
+
+
+# Serialize dicts / lists straight to JSON bytes (dates come out as YYYY-MM-DD like PrescriptionRead)
+def dump_json(data: Any) -> bytes:
+    return to_json(data)
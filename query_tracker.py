@@ -0,0 +1,225 @@
+# this is the file for finding hidden database round trips (N+1 queries) while developing and in tests
+# Every statement run on the engines (database.py attaches track_queries to them) is added to the QueryLog of
+# whatever is being tracked right now -- kept in a contextvar, so nothing is recorded outside of that:
+#   - a request, when QueryTrackerMiddleware is on (settings.track_queries, on in the dev profile).
+#     Each request's count goes into query_tracker; requests over QUERY_BUDGET_DEFAULT statements or with a
+#     repeated statement are logged as warnings, and query_tracker.format_report() lists the worst routes.
+#   - a block wrapped in query_budget(), for tests:
+#         with query_budget(2):
+#             response = await client.get("/prescriptions/", headers=headers)
+#     raises QueryBudgetExceeded when the block ran more than 2 statements or the same statement again and
+#     again with different parameters (the N+1 pattern -- one query per row of an earlier query).
+# Logs nest, so a query_budget() around a request sees the request's statements too.
+import logging
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, List, Optional, Tuple
+from sqlalchemy import event
+
+logger = logging.getLogger(__name__)
+
+N_PLUS_ONE_THRESHOLD = 3      # The same statement this many times in one request / block is flagged
+QUERY_BUDGET_DEFAULT = 10     # Requests running more statements than this are logged by the middleware
+REPORT_TOP = 10               # Routes / statements listed by format_report()
+STATEMENT_PREVIEW_LENGTH = 200  # SQL shown in warnings and reports is cut to this length
+
+
+def _preview(statement: str) -> str:
+    statement = " ".join(statement.split())
+    return statement if len(statement) <= STATEMENT_PREVIEW_LENGTH else statement[:STATEMENT_PREVIEW_LENGTH] + "..."
+
+
+class RepeatedStatement:
+    __slots__ = ("statement", "count", "distinct_parameters")
+
+    def __init__(self, statement: str, count: int, distinct_parameters: int):
+        self.statement = statement
+        self.count = count
+        self.distinct_parameters = distinct_parameters
+
+    @property
+    def kind(self) -> str:
+        # different parameters every time = a query per row (N+1), the same parameters = the same query again
+        return "n+1" if self.distinct_parameters > 1 else "duplicate"
+
+    def __repr__(self) -> str:
+        return f"{self.count}x {self.kind} ({self.distinct_parameters} parameter sets): {_preview(self.statement)}"
+
+
+class QueryLog:
+    __slots__ = ("label", "parent", "count", "statements")
+
+    def __init__(self, label: str, parent: Optional["QueryLog"] = None):
+        self.label = label
+        self.parent = parent
+        self.count = 0
+        self.statements: Dict[str, list] = {}  # SQL -> [times run, {hash of the parameters}]
+
+    def add(self, statement: str, parameters):
+        parameters_hash = hash(repr(parameters))
+        log = self
+        while log is not None:
+            log.count += 1
+            seen = log.statements.get(statement)
+            if seen is None:
+                log.statements[statement] = [1, {parameters_hash}]
+            else:
+                seen[0] += 1
+                seen[1].add(parameters_hash)
+            log = log.parent
+
+    # Statements run threshold times or more, most repeated first
+    def repeated(self, threshold: int = N_PLUS_ONE_THRESHOLD) -> List[RepeatedStatement]:
+        repeats = [
+            RepeatedStatement(statement, count, len(parameter_hashes))
+            for statement, (count, parameter_hashes) in self.statements.items()
+            if count >= threshold
+        ]
+        repeats.sort(key=lambda r: -r.count)
+        return repeats
+
+
+current_query_log: ContextVar[Optional[QueryLog]] = ContextVar("current_query_log", default=None)
+
+
+# Record the statements of an engine into the current QueryLog (called from database.py for every engine)
+# costs one contextvar lookup per statement while nothing is being tracked
+def track_queries(engine):
+    @event.listens_for(engine.sync_engine, "before_cursor_execute")
+    def record_statement(conn, cursor, statement, parameters, context, executemany):
+        log = current_query_log.get()
+        if log is not None:
+            log.add(statement, parameters)
+
+
+class QueryBudgetExceeded(AssertionError):
+    pass
+
+
+# Fail (QueryBudgetExceeded) when the block runs more than max_statements statements,
+# or repeats a statement N_PLUS_ONE_THRESHOLD times unless allow_repeats is set
+@contextmanager
+def query_budget(max_statements: int, allow_repeats: bool = False, label: str = "query_budget"):
+    log = QueryLog(label, parent=current_query_log.get())
+    token = current_query_log.set(log)
+    try:
+        yield log
+    finally:
+        current_query_log.reset(token)
+
+    problems = []
+    if log.count > max_statements:
+        problems.append(f"{log.count} statements, budget is {max_statements}")
+    repeats = [] if allow_repeats else log.repeated()
+    if repeats:
+        problems.append(f"{len(repeats)} repeated statement(s)")
+    if problems:
+        statements = "\n".join(f"  {count}x {_preview(statement)}" for statement, (count, _) in
+                               sorted(log.statements.items(), key=lambda item: -item[1][0]))
+        raise QueryBudgetExceeded(f"{label}: {', '.join(problems)}\n{statements}")
+
+
+class RouteQueries:
+    __slots__ = ("requests", "statements", "max_statements", "over_budget", "repeats")
+
+    def __init__(self):
+        self.requests = 0
+        self.statements = 0
+        self.max_statements = 0
+        self.over_budget = 0
+        self.repeats: Dict[str, list] = {}  # SQL -> [requests it was repeated in, most times in one request, kind]
+
+
+class QueryTracker:
+    def __init__(self, budget: int = QUERY_BUDGET_DEFAULT):
+        self.budget = budget
+        self.routes: Dict[Tuple[str, str], RouteQueries] = {}  # (method, route template) -> counts
+
+    def record(self, method: str, route: str, log: QueryLog):
+        queries = self.routes.get((method, route))
+        if queries is None:
+            queries = self.routes[(method, route)] = RouteQueries()
+        queries.requests += 1
+        queries.statements += log.count
+        queries.max_statements = max(queries.max_statements, log.count)
+        if log.count > self.budget:
+            queries.over_budget += 1
+            logger.warning("%s %s ran %s statements (budget %s)", method, route, log.count, self.budget)
+        for repeat in log.repeated():
+            seen = queries.repeats.get(repeat.statement)
+            if seen is None:
+                queries.repeats[repeat.statement] = [1, repeat.count, repeat.kind]
+            else:
+                seen[0] += 1
+                seen[1] = max(seen[1], repeat.count)
+            logger.warning("%s %s: %r", method, route, repeat)
+
+    # Worst routes (most statements per request) and the statements repeated inside a request
+    def report(self, top: int = REPORT_TOP) -> dict:
+        routes = sorted(self.routes.items(), key=lambda item: -item[1].statements / item[1].requests)
+        repeats = sorted(
+            ((method, route, statement, seen) for (method, route), queries in self.routes.items()
+             for statement, seen in queries.repeats.items()),
+            key=lambda item: (-item[3][1], -item[3][0]),
+        )
+        return {
+            "budget": self.budget,
+            "routes": [
+                {
+                    "route": f"{method} {route}",
+                    "requests": queries.requests,
+                    "avg_statements": round(queries.statements / queries.requests, 2),
+                    "max_statements": queries.max_statements,
+                    "over_budget": queries.over_budget,
+                }
+                for (method, route), queries in routes[:top]
+            ],
+            "repeated_statements": [
+                {
+                    "route": f"{method} {route}",
+                    "kind": kind,
+                    "requests": requests,
+                    "max_times_per_request": max_times,
+                    "statement": _preview(statement),
+                }
+                for method, route, statement, (requests, max_times, kind) in repeats[:top]
+            ],
+        }
+
+    def format_report(self, top: int = REPORT_TOP) -> str:
+        report = self.report(top)
+        lines = [f"Statements per request (budget {report['budget']}), worst first:"]
+        for row in report["routes"]:
+            lines.append(f"  {row['avg_statements']:>7} avg {row['max_statements']:>5} max {row['over_budget']:>5} over  "
+                         f"{row['route']} ({row['requests']} requests)")
+        if report["repeated_statements"]:
+            lines.append("Repeated statements:")
+            for row in report["repeated_statements"]:
+                lines.append(f"  {row['max_times_per_request']:>5}x {row['kind']:<9} {row['route']} "
+                             f"({row['requests']} requests): {row['statement']}")
+        return "\n".join(lines)
+
+
+# Shared tracker filled by QueryTrackerMiddleware
+query_tracker = QueryTracker()
+
+
+class QueryTrackerMiddleware:
+    """Gives every HTTP request its own QueryLog and adds it to the tracker when the request is done."""
+
+    def __init__(self, app, tracker: QueryTracker = query_tracker):
+        self.app = app
+        self.tracker = tracker
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        log = QueryLog(scope["path"], parent=current_query_log.get())
+        token = current_query_log.set(log)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            current_query_log.reset(token)
+            route = scope.get("route")  # set by FastAPI when a route matched
+            self.tracker.record(scope["method"], route.path if route is not None else "unmatched", log)
@@ -0,0 +1,216 @@
+# this is the file for forecasting refills and creating the refill notifications (notification_type = 1)
+# meant to run once a night: python -m <package>.refill_forecast
+# The active prescription details are read in chunks (keyset on prescription_id, medication_id) and each
+# chunk is worked out with NumPy arrays instead of row by row:
+#   days of supply = presc_qty / doses per day (presc_doses_per_day, parsed from presc_frequency -- see dosing.py)
+#   run out date   = prescription_date_start + days of supply
+#   notify date    = run out date - REFILL_LEAD_DAYS
+# A refill notification is inserted (one executemany per chunk) for every detail whose notify date falls
+# inside the forecast window, unless the same reminder already exists. The notification dispatcher
+# (notification_dispatcher.py) sends them when their notification_date comes around.
+import asyncio
+import logging
+import time
+from dataclasses import dataclass
+from datetime import date, datetime, timedelta, timezone
+from functools import lru_cache
+from typing import List, Optional, Set, Tuple
+import numpy as np
+from sqlalchemy import insert
+from sqlalchemy.future import select
+from .database import AsyncSessionLocal
+from .models import Prescription, PrescriptionDetail, Medication, Notification
+from .pagination import keyset_after
+from .dosing import parse_frequency
+from .response_cache import response_cache
+from .sync import next_change_seqs
+
+logger = logging.getLogger(__name__)
+
+FORECAST_CHUNK_SIZE = 50000     # Prescription detail rows read and forecast at a time
+REFILL_LEAD_DAYS = 3            # Remind the user this many days before the medication runs out
+FORECAST_WINDOW_DAYS = 1        # Create the reminders whose notify date is within this many days from today
+REFILL_NOTIFY_HOUR = 9          # Reminders go out at this hour (UTC) on the notify date
+
+REFILL_NOTIFICATION_TYPE = 1    # notification_type: 1 = refill, 2 = reminder
+PRESCRIPTION_STATUS_ACTIVE = 0  # prescription_status: 0 = active, 1 = archive
+
+# Doses per day for a presc_frequency string, nan when it can't be worked out
+# only used for details saved before presc_doses_per_day existed -- run python -m <package>.dosing to fill them in
+@lru_cache(maxsize=4096)
+def doses_per_day(frequency: Optional[str]) -> float:
+    value = parse_frequency(frequency)[0]
+    return np.nan if value is None else value
+
+
+@dataclass
+class ForecastResult:
+    details_read: int = 0
+    chunks: int = 0
+    unparsed_frequency: int = 0   # details skipped because presc_frequency could not be read
+    notifications_created: int = 0
+    duplicates_skipped: int = 0
+    seconds: float = 0.0
+
+
+# The message also identifies the reminder -- a prescription detail gets one reminder per run out date
+def _refill_message(medication_name: Optional[str], prescription_id: int, run_out: date) -> str:
+    name = medication_name or "your medication"
+    return f"Time to refill {name} (prescription {prescription_id}) -- it runs out on {run_out.isoformat()}"[:150]
+
+
+_EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+_NAT = np.iinfo(np.int64).min  # NaT when viewed as datetime64
+
+
+# date objects -> datetime64[D] array (None -> NaT)
+# going through toordinal() is ~15x faster than np.array(values, dtype="datetime64[D]")
+def _to_days(values) -> np.ndarray:
+    days = np.fromiter(
+        (d.toordinal() - _EPOCH_ORDINAL if d is not None else _NAT for d in values),
+        dtype=np.int64, count=len(values),
+    )
+    return days.view("datetime64[D]")
+
+
+# Work out the refill reminders for one chunk of rows, given column by column
+# returns ([(index into the chunk, run_out_date, notify_date)] for the rows that need a reminder in the window, rows with an unreadable frequency)
+def forecast_chunk(starts, ends, quantities, doses, frequencies, today: date, window_days: int = FORECAST_WINDOW_DAYS,
+                   lead_days: int = REFILL_LEAD_DAYS) -> Tuple[List[tuple], int]:
+    if not starts:
+        return [], 0
+
+    per_day = np.array(doses, dtype=np.float64)  # presc_doses_per_day, None -> nan
+    missing = np.flatnonzero(np.isnan(per_day))
+    if missing.size:
+        # Not parsed yet -- parse each distinct frequency once and spread the result over those rows
+        unique_frequencies, inverse = np.unique(np.array([frequencies[i] or "" for i in missing], dtype=str), return_inverse=True)
+        per_day[missing] = np.array([doses_per_day(f) for f in unique_frequencies], dtype=np.float64)[inverse]
+
+    start = _to_days(starts)
+    end = _to_days(ends)
+    qty = np.array(quantities, dtype=np.float64)  # None -> nan
+
+    valid = ~np.isnan(per_day) & (per_day > 0) & ~np.isnan(qty) & (qty > 0) & ~np.isnat(start)
+    days_supply = np.floor(np.where(valid, qty / np.where(valid, per_day, 1), 0)).astype(np.int64)
+    run_out = start + days_supply.astype("timedelta64[D]")
+    notify = run_out - np.timedelta64(lead_days, "D")
+
+    window_start = np.datetime64(today, "D")
+    window_end = window_start + np.timedelta64(window_days, "D")
+    due = valid & (notify >= window_start) & (notify < window_end)
+    # No reminder when the prescription ends before the medication runs out
+    due &= np.isnat(end) | (run_out <= end)
+
+    unparsed = int(np.count_nonzero(np.isnan(per_day)))
+    indexes = np.flatnonzero(due)
+    run_out_dates = run_out[indexes].astype(object)
+    notify_dates = notify[indexes].astype(object)
+    return list(zip(indexes.tolist(), run_out_dates, notify_dates)), unparsed
+
+
+# Reminders that already exist for these users in the window -- {(user_id, message)}
+async def _existing_reminders(session, user_ids: Set[str], window_start: datetime, window_end: datetime) -> Set[tuple]:
+    result = await session.execute(
+        select(Notification.user_id, Notification.notification_message)
+        .where(
+            Notification.user_id.in_(user_ids),
+            Notification.notification_type == REFILL_NOTIFICATION_TYPE,
+            Notification.notification_date >= window_start,
+            Notification.notification_date < window_end,
+        )
+    )
+    return set(result.all())
+
+
+# One pass over every active prescription detail
+async def run_refill_forecast(today: Optional[date] = None, chunk_size: int = FORECAST_CHUNK_SIZE,
+                              window_days: int = FORECAST_WINDOW_DAYS, session_factory=AsyncSessionLocal) -> ForecastResult:
+    today = today or datetime.now(timezone.utc).date()
+    window_start = datetime.combine(today, datetime.min.time())
+    window_end = window_start + timedelta(days=window_days)
+    result = ForecastResult()
+    started = time.perf_counter()
+
+    query = (
+        select(
+            PrescriptionDetail.prescription_id,
+            PrescriptionDetail.medication_id,
+            Prescription.user_id,
+            Medication.medication_name,
+            Prescription.prescription_date_start,
+            Prescription.prescription_date_end,
+            PrescriptionDetail.presc_qty,
+            PrescriptionDetail.presc_doses_per_day,
+            PrescriptionDetail.presc_frequency,
+        )
+        .join(Prescription, Prescription.prescription_id == PrescriptionDetail.prescription_id)
+        .outerjoin(Medication, Medication.medication_id == PrescriptionDetail.medication_id)
+        .where(Prescription.prescription_status == PRESCRIPTION_STATUS_ACTIVE)
+    )
+    sort_key = (PrescriptionDetail.prescription_id, PrescriptionDetail.medication_id)
+
+    after = None
+    async with session_factory() as session:
+        while True:
+            chunk_query = query if after is None else query.where(keyset_after(sort_key, after))
+            rows = (await session.execute(chunk_query.order_by(*sort_key).limit(chunk_size))).all()
+            if not rows:
+                break
+            after = (rows[-1].prescription_id, rows[-1].medication_id)
+            result.chunks += 1
+            result.details_read += len(rows)
+
+            # columns in the order of the select above
+            prescription_ids, _, user_ids, medication_names, starts, ends, quantities, doses, frequencies = zip(*rows)
+            reminders, unparsed = forecast_chunk(starts, ends, quantities, doses, frequencies, today, window_days)
+            result.unparsed_frequency += unparsed
+            if reminders:
+                existing = await _existing_reminders(session, {user_ids[i] for i, _, _ in reminders}, window_start, window_end)
+                now = datetime.now(timezone.utc)
+                new_rows = []
+                for i, run_out, notify_on in reminders:
+                    user_id = user_ids[i]
+                    message = _refill_message(medication_names[i], prescription_ids[i], run_out)
+                    if (user_id, message) in existing:
+                        result.duplicates_skipped += 1
+                        continue
+                    existing.add((user_id, message))
+                    new_rows.append({
+                        "user_id": user_id,
+                        "notification_type": REFILL_NOTIFICATION_TYPE,
+                        "notification_message": message,
+                        "notification_date": datetime.combine(notify_on, datetime.min.time()) + timedelta(hours=REFILL_NOTIFY_HOUR),
+                        "notification_status": None,  # not sent yet -- picked up by the dispatcher
+                        "created_at": now,
+                        "updated_at": now,
+                    })
+                if new_rows:
+                    change_seqs = await next_change_seqs(session, {row["user_id"] for row in new_rows})  # GET /sync
+                    for row in new_rows:
+                        row["change_seq"] = change_seqs[row["user_id"]]
+                    await session.execute(insert(Notification), new_rows)  # executemany
+                    await session.commit()
+                    result.notifications_created += len(new_rows)
+                    for user_id in {row["user_id"] for row in new_rows}:
+                        await response_cache.invalidate(user_id)  # reaches the API workers with the redis backend
+            if len(rows) < chunk_size:
+                break
+
+    result.seconds = round(time.perf_counter() - started, 3)
+    logger.info("Refill forecast for %s: %s", today, result)
+    return result
+
+
+async def main():
+    from .database import close_connections
+    try:
+        result = await run_refill_forecast()
+        print(result)
+    finally:
+        await close_connections()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(main())
@@ -0,0 +1,303 @@
+# this is the file for caching a user's own list / detail responses (GET /prescriptions/, /prescriptions/{id},
+# /notifications, /side_effects/) -- a user reads these far more often than they change them
+# A response is stored as JSON bytes under (route, user_id, generation, path + query parameters).
+# Every user has a generation number: each endpoint that changes a user's rows calls invalidate(user_id), which
+# bumps it, so the user's older responses are never looked up again (they drop out by LRU / ttl).
+# Only 200 responses are cached, a 404 / 403 always goes to the database.
+# Backends (RESPONSE_CACHE_BACKEND in the environment):
+#   memory      -- this worker only: an LRU capped at RESPONSE_CACHE_MAX_BYTES of response bodies (default)
+#   local-redis -- LocalRedis below, an in-process stand-in with the few Redis commands used here -- to try the
+#                  Redis code path without a server
+#   redis       -- a Redis server at RESPONSE_CACHE_REDIS_URL (needs the redis package), shared by all workers so
+#                  a write in one worker is seen by all of them
+#   off         -- no caching
+# With memory / local-redis a write only invalidates the worker that handled it, the others can serve the older
+# response for up to RESPONSE_CACHE_TTL_SECONDS (like the other caches in cache.py).
+# With redis a bump also sets rc:wrote:<user_id> for READ_YOUR_WRITES_SECONDS. A worker that finds it while
+# building a key marks the user as a recent writer (database.recent_writers), so the miss is read from the primary:
+# only the worker that wrote knows about the write otherwise, and the others would read the lagging replica and
+# cache its older rows under the new generation.
+import itertools
+import logging
+import os
+import time
+from typing import Dict, NamedTuple, Optional, Tuple
+from urllib.parse import urlencode
+from fastapi import Request, Response
+from .cache import LRUCache
+from .database import READ_YOUR_WRITES_SECONDS, recent_writers
+from .pagination import NEXT_CURSOR_HEADER
+
+try:
+    import redis.asyncio as redis_asyncio
+except ImportError:  # only needed for RESPONSE_CACHE_BACKEND=redis
+    redis_asyncio = None
+
+logger = logging.getLogger(__name__)
+
+RESPONSE_CACHE_BACKEND = os.environ.get("RESPONSE_CACHE_BACKEND", "memory").strip().lower()
+RESPONSE_CACHE_REDIS_URL = os.environ.get("RESPONSE_CACHE_REDIS_URL", "redis://localhost:6379/0")
+RESPONSE_CACHE_TTL_SECONDS = 60              # A cached response is served for at most this long
+RESPONSE_CACHE_MAX_BYTES = 64 * 1024 * 1024  # Response bodies kept per worker (memory / local-redis)
+RESPONSE_CACHE_MAX_ENTRIES = 50000           # Responses kept per worker (memory / local-redis)
+GENERATION_CACHE_SIZE = 100000               # Users whose generation is kept (memory)
+REDIS_KEY_PREFIX = "rc:"
+
+
+class CacheKey(NamedTuple):
+    route: str    # route template, eg. "/prescriptions/{prescription_id}" -- metrics are kept per route
+    user_id: str
+    key: str      # full key with the generation and the parameters
+
+
+# Stored value: the X-Next-Cursor header (may be empty), a newline, then the JSON body
+def _encode(body: bytes, next_cursor: Optional[str]) -> bytes:
+    return (next_cursor or "").encode() + b"\n" + body
+
+
+def _decode(value: bytes) -> Response:
+    next_cursor, _, body = value.partition(b"\n")
+    headers = {NEXT_CURSOR_HEADER: next_cursor.decode()} if next_cursor else None
+    return Response(content=body, media_type="application/json", headers=headers)
+
+
+class MemoryBackend:
+    """Responses and generations in LRU caches of this worker."""
+
+    def __init__(self, max_bytes: int = RESPONSE_CACHE_MAX_BYTES, max_entries: int = RESPONSE_CACHE_MAX_ENTRIES,
+                 ttl: float = RESPONSE_CACHE_TTL_SECONDS):
+        self.ttl = ttl
+        self.entries = LRUCache(maxsize=max_entries, ttl=ttl, maxbytes=max_bytes)
+        self.generations = LRUCache(maxsize=GENERATION_CACHE_SIZE)  # user_id -> generation
+        # one counter for all users -- a user whose generation was dropped from the LRU gets a number that was
+        # never used before, so it can't match any response still in the cache
+        self._counter = itertools.count(1)
+
+    async def get(self, key: str) -> Optional[bytes]:
+        return self.entries.get(key)
+
+    async def set(self, key: str, value: bytes):
+        self.entries.set(key, value)
+
+    # (generation, written recently) -- only this worker's writes bump it, and it already knows about those
+    async def generation(self, user_id: str) -> Tuple[int, bool]:
+        generation = self.generations.get(user_id)
+        if generation is None:
+            generation = next(self._counter)
+            self.generations.set(user_id, generation)
+        return generation, False
+
+    async def bump(self, user_id: str):
+        self.generations.set(user_id, next(self._counter))
+
+    def stats(self) -> dict:
+        return {"entries": self.entries.stats(), "generations": len(self.generations)}
+
+
+class LocalRedis:
+    """
+    In-process stand-in for redis.asyncio.Redis with the commands RedisBackend uses (GET, MGET, SET with PX / NX, INCR)
+    evicts least recently used keys past max_bytes like a server with maxmemory-policy allkeys-lru.
+    """
+
+    def __init__(self, max_bytes: int = RESPONSE_CACHE_MAX_BYTES, max_keys: int = RESPONSE_CACHE_MAX_ENTRIES):
+        self._data = LRUCache(maxsize=max_keys, maxbytes=max_bytes)
+
+    async def get(self, name: str) -> Optional[bytes]:
+        return self._data.get(name)
+
+    async def mget(self, *names: str) -> list:
+        return [self._data.get(name) for name in names]
+
+    async def set(self, name: str, value, px: Optional[int] = None, nx: bool = False) -> Optional[bool]:
+        if nx and self._data.get(name) is not None:
+            return None
+        value = value if isinstance(value, bytes) else str(value).encode()
+        self._data.set(name, value, expires_at=time.time() + px / 1000 if px is not None else None)
+        return True
+
+    async def incr(self, name: str) -> int:
+        value = int(self._data.get(name, b"0")) + 1
+        self._data.set(name, str(value).encode())
+        return value
+
+    async def aclose(self):
+        self._data.clear()
+
+    def stats(self) -> dict:
+        return self._data.stats()
+
+
+class RedisBackend:
+    """
+    Responses and generations in Redis (or LocalRedis) -- generations are counters under rc:gen:<user_id>,
+    rc:wrote:<user_id> is set for READ_YOUR_WRITES_SECONDS after each bump.
+    """
+
+    def __init__(self, client, ttl: float = RESPONSE_CACHE_TTL_SECONDS):
+        self.client = client
+        self.ttl = ttl
+        self.errors = 0
+
+    async def get(self, key: str) -> Optional[bytes]:
+        try:
+            return await self.client.get(REDIS_KEY_PREFIX + key)
+        except Exception as e:  # a cache that is down must not fail the request
+            self.errors += 1
+            logger.warning("Response cache get failed: %s", e)
+            return None
+
+    async def set(self, key: str, value: bytes):
+        try:
+            await self.client.set(REDIS_KEY_PREFIX + key, value, px=int(self.ttl * 1000))
+        except Exception as e:
+            self.errors += 1
+            logger.warning("Response cache set failed: %s", e)
+
+    # A generation key that is missing (new user, or evicted by the server) starts at the current time in ms,
+    # above any number the counter reached before
+    async def _seed(self, name: str):
+        await self.client.set(name, time.time_ns() // 1_000_000, nx=True)
+
+    # (generation, written recently) in one round trip, None when Redis can't be reached
+    async def generation(self, user_id: str) -> Optional[Tuple[int, bool]]:
+        name = f"{REDIS_KEY_PREFIX}gen:{user_id}"
+        try:
+            generation, wrote = await self.client.mget(name, f"{REDIS_KEY_PREFIX}wrote:{user_id}")
+            if generation is None:
+                await self._seed(name)
+                generation = await self.client.get(name)
+            return int(generation), wrote is not None
+        except Exception as e:
+            self.errors += 1
+            logger.warning("Response cache generation lookup failed: %s", e)
+            return None
+
+    async def bump(self, user_id: str):
+        name = f"{REDIS_KEY_PREFIX}gen:{user_id}"
+        try:
+            # set before the new generation exists, so a key built with it always sees the write
+            await self.client.set(f"{REDIS_KEY_PREFIX}wrote:{user_id}", 1, px=READ_YOUR_WRITES_SECONDS * 1000)
+            await self._seed(name)
+            await self.client.incr(name)
+        except Exception as e:
+            self.errors += 1
+            logger.warning("Could not invalidate the cached responses of user %s: %s", user_id, e)
+
+    def stats(self) -> dict:
+        stats = {"errors": self.errors}
+        if isinstance(self.client, LocalRedis):
+            stats["entries"] = self.client.stats()
+        return stats
+
+
+def create_backend(name: str = RESPONSE_CACHE_BACKEND):
+    if name == "off":
+        return None
+    if name == "local-redis":
+        return RedisBackend(LocalRedis())
+    if name == "redis":
+        if redis_asyncio is not None:
+            return RedisBackend(redis_asyncio.from_url(RESPONSE_CACHE_REDIS_URL))
+        logger.warning("RESPONSE_CACHE_BACKEND=redis but the redis package is not installed -- using the in-process cache")
+    elif name != "memory":
+        raise ValueError(f"Unknown RESPONSE_CACHE_BACKEND {name!r}, expected memory, local-redis, redis or off")
+    return MemoryBackend()
+
+
+class RouteCounts:
+    __slots__ = ("hits", "misses")
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+
+
+class ResponseCache:
+    def __init__(self, backend=None):
+        self.backend = backend
+        self.routes: Dict[str, RouteCounts] = {}  # route template -> hits / misses
+        # Metrics
+        self.stores = 0
+        self.stored_bytes = 0
+        self.invalidations = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.backend is not None
+
+    # Key of this request for this user -- None when caching is off (or the backend can't be reached)
+    # call before the handler's first query: a user another worker just wrote for is read from the primary
+    async def key(self, request: Request, user_id: str) -> Optional[CacheKey]:
+        if self.backend is None:
+            return None
+        found = await self.backend.generation(user_id)
+        if found is None:
+            return None
+        generation, written_recently = found
+        if written_recently:
+            recent_writers.set(user_id, True)  # read_sessionmaker() picks the primary (see get_user_read_db)
+        route = request.scope["route"].path  # set by FastAPI when a route matched
+        path_params = urlencode(sorted(request.path_params.items()))
+        query = urlencode(sorted(request.query_params.multi_items()))
+        return CacheKey(route, user_id, f"{route}|{user_id}|{generation}|{path_params}|{query}")
+
+    def _counts(self, route: str) -> RouteCounts:
+        counts = self.routes.get(route)
+        if counts is None:
+            counts = self.routes[route] = RouteCounts()
+        return counts
+
+    # The cached response, or None (counted as a miss)
+    async def get(self, key: Optional[CacheKey]) -> Optional[Response]:
+        if key is None:
+            return None
+        value = await self.backend.get(key.key)
+        counts = self._counts(key.route)
+        if value is None:
+            counts.misses += 1
+            return None
+        counts.hits += 1
+        return _decode(value)
+
+    # Store a JSON body (and the next page cursor) and return it as the response
+    async def put(self, key: Optional[CacheKey], body: bytes, next_cursor: Optional[str] = None) -> Response:
+        if key is not None:
+            value = _encode(body, next_cursor)
+            await self.backend.set(key.key, value)
+            self.stores += 1
+            self.stored_bytes += len(value)
+        headers = {NEXT_CURSOR_HEADER: next_cursor} if next_cursor else None
+        return Response(content=body, media_type="application/json", headers=headers)
+
+    # Forget every cached response of a user -- call after any change to the user's rows
+    async def invalidate(self, user_id: str):
+        if self.backend is not None:
+            await self.backend.bump(user_id)
+            self.invalidations += 1
+
+    def metrics(self) -> dict:
+        hits = sum(counts.hits for counts in self.routes.values())
+        misses = sum(counts.misses for counts in self.routes.values())
+        return {
+            "enabled": self.enabled,
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": round(hits / (hits + misses), 4) if hits + misses else 0.0,
+            "stores": self.stores,
+            "stored_bytes": self.stored_bytes,
+            "invalidations": self.invalidations,
+            "routes": {
+                route: {
+                    "hits": counts.hits,
+                    "misses": counts.misses,
+                    "hit_rate": round(counts.hits / (counts.hits + counts.misses), 4) if counts.hits + counts.misses else 0.0,
+                }
+                for route, counts in self.routes.items()
+            },
+            "backend": self.backend.stats() if self.backend is not None else {},
+        }
+
+
+# Shared response cache used by the API
+response_cache = ResponseCache(create_backend())
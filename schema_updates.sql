@@ -0,0 +1,66 @@
+-- Schema changes made after Newest_db_dump.sql was taken
+-- run these against app_db (MySQL 8) in order; models.py already has all of them
+-- for a fresh database create_tables() in database.py builds everything from models.py instead
+
+-- Indexes for keyset pagination on the list endpoints
+CREATE INDEX `ix_notification_user_created` ON `notification` (`user_id`, `created_at`, `notification_id`);
+CREATE INDEX `ix_prescription_user_status` ON `prescription` (`user_id`, `prescription_status`, `prescription_id`);
+CREATE INDEX `ix_side_effect_user_created` ON `side_effect` (`user_id`, `created_at`, `side_effects_id`);
+CREATE INDEX `ix_side_effect_user_med_created` ON `side_effect` (`user_id`, `medication_id`, `created_at`, `side_effects_id`);
+
+-- Index for the notification dispatcher's due query (notification_status IS NULL AND notification_date <= now)
+CREATE INDEX `ix_notification_status_date` ON `notification` (`notification_status`, `notification_date`);
+
+-- Parsed dose schedule stored with each prescription detail (see dosing.py)
+-- fill it in for existing rows afterwards with: python -m <package>.dosing
+ALTER TABLE `prescription_detail`
+  ADD COLUMN `presc_doses_per_day` float DEFAULT NULL COMMENT 'Doses per day parsed from presc_frequency',
+  ADD COLUMN `presc_schedule` varchar(160) DEFAULT NULL COMMENT 'Encoded dose schedule: doses/day|interval hours|times of day (minutes)|amount|unit';
+
+-- Side effect counts per medication / day / normalized description (see side_effect_rollup.py)
+-- fill it in for existing rows afterwards with: python -m <package>.side_effect_rollup
+CREATE TABLE `side_effect_rollup` (
+  `medication_id` int NOT NULL,
+  `rollup_day` date NOT NULL COMMENT 'Day the side effects were logged (created_at)',
+  `side_effect_desc_norm` varchar(255) NOT NULL COMMENT 'side_effect_desc lower case, trimmed, single spaced',
+  `side_effect_count` int NOT NULL DEFAULT '0',
+  PRIMARY KEY (`medication_id`, `rollup_day`, `side_effect_desc_norm`),
+  CONSTRAINT `fk_side_effect_rollup_medication` FOREIGN KEY (`medication_id`) REFERENCES `medication` (`medication_id`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci;
+
+-- Delta sync (GET /sync, see sync.py): a change counter per user, the counter value on every synced row (and
+-- tombstone) with indexes to find a user's changes after a value, and tombstones for deleted rows
+ALTER TABLE `prescription`
+  ADD COLUMN `updated_at` datetime DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP COMMENT 'Last update timestamp',
+  ADD COLUMN `change_seq` bigint DEFAULT NULL COMMENT 'Change counter of the user when last written, for GET /sync (see sync.py)';
+ALTER TABLE `prescription_detail`
+  ADD COLUMN `updated_at` datetime DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP COMMENT 'Last update timestamp',
+  ADD COLUMN `change_seq` bigint DEFAULT NULL COMMENT 'Change counter of the prescription''s user when last written, for GET /sync (see sync.py)';
+ALTER TABLE `notification`
+  ADD COLUMN `change_seq` bigint DEFAULT NULL COMMENT 'Change counter of the user when last written, for GET /sync (see sync.py)';
+ALTER TABLE `side_effect`
+  ADD COLUMN `change_seq` bigint DEFAULT NULL COMMENT 'Change counter of the user when last written, for GET /sync (see sync.py)';
+CREATE INDEX `ix_prescription_user_change` ON `prescription` (`user_id`, `change_seq`);
+CREATE INDEX `ix_prescription_detail_change` ON `prescription_detail` (`prescription_id`, `change_seq`);
+CREATE INDEX `ix_notification_user_change` ON `notification` (`user_id`, `change_seq`);
+CREATE INDEX `ix_side_effect_user_change` ON `side_effect` (`user_id`, `change_seq`);
+CREATE TABLE `sync_counter` (
+  `user_id` varchar(25) NOT NULL,
+  `change_seq` bigint NOT NULL DEFAULT '0',
+  PRIMARY KEY (`user_id`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci;
+CREATE TABLE `sync_tombstone` (
+  `tombstone_id` int NOT NULL AUTO_INCREMENT,
+  `user_id` varchar(25) NOT NULL,
+  `table_name` varchar(30) NOT NULL COMMENT 'prescription, prescription_detail, notification or side_effect',
+  `row_key` varchar(45) NOT NULL COMMENT 'Primary key of the deleted row, prescription_detail: prescription_id:medication_id',
+  `deleted_at` datetime NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  `change_seq` bigint NOT NULL COMMENT 'Change counter of the user when deleted',
+  PRIMARY KEY (`tombstone_id`),
+  KEY `ix_sync_tombstone_user_change` (`user_id`, `change_seq`),
+  KEY `ix_sync_tombstone_deleted` (`deleted_at`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci;
+
+-- Batch claim of the notification dispatcher -- set (and committed) before a batch is sent, cleared when it is marked sent
+ALTER TABLE `notification`
+  ADD COLUMN `claimed_at` datetime DEFAULT NULL COMMENT 'Set while a dispatcher is sending it (see notification_dispatcher.py)';
@@ -478,6 +478,18 @@ class PrescriptionDetailRead(BaseORMModel):
 
 
 
+# Drug-drug interaction found when a medication is added to a prescription (see interactions.py)
+class InteractionWarning(BaseORMModel):
+    medication_id: int
+    interacting_medication_id: int  # a medication on one of the user's active prescriptions
+    interacting_medication_name: Optional[str] = None
+    severity: str  # minor, moderate or major
+    description: Optional[str] = None
+
+# A new prescription detail together with the interactions it has with the user's other medications
+class PrescriptionDetailCreateResponse(PrescriptionDetailRead):
+    interaction_warnings: List[InteractionWarning] = []
+
 class PrescriptionDetailDelete(BaseORMModel):
     prescription_id: int
     medication_id: int
@@ -486,6 +498,18 @@ class PrescriptionDetailDeleteResponse(BaseORMModel):
     prescription_id: int
     medication_id: int
 
+# ===================== Dose calendar =====================
+
+# One dose in the calendar (GET /users/me/calendar), see dose_calendar.py
+class DoseEventRead(BaseORMModel):
+    dose_time: datetime
+    prescription_id: int
+    medication_id: int
+    medication_name: Optional[str] = None
+    presc_dose: Optional[str] = None
+    amount: Optional[float] = None   # per dose, in unit (parsed from presc_dose)
+    unit: Optional[str] = None       # mg, ml or a count unit (tablet, drop ...)
+
 # ===================== SideEffect =====================
 
 class SideEffectCreate(BaseORMModel):
@@ -527,6 +551,56 @@ class SideEffectDeleteResponse(BaseORMModel):
     msg:str
     side_effects_id: int
 
+# Side effect stats (GET /side_effects/stats), read from the side effect rollup
+class SideEffectMedicationCount(BaseORMModel):
+    medication_id: int
+    medication_name: Optional[str] = None
+    side_effect_count: int
+
+class SideEffectDayCount(BaseORMModel):
+    rollup_day: date
+    side_effect_count: int
 
+class SideEffectDescCount(BaseORMModel):
+    side_effect_desc: str  # normalized: lower case, trimmed, single spaced
+    side_effect_count: int
 
+class SideEffectMedicationStats(BaseORMModel):
+    medication_id: int
+    medication_name: Optional[str] = None
+    side_effect_count: int
+    by_day: List[SideEffectDayCount] = []
+    top_descriptions: List[SideEffectDescCount] = []
+
+
+# ===================== Delta sync =====================
+
+# Rows changed since the client's cursor (GET /sync), see sync.py -- the rows carry updated_at,
+# prescriptions come without their details (those are synced as their own rows)
+class SyncPrescriptionRead(BaseORMModel):
+    prescription_id: int
+    user_id: str
+    prescription_date_start: Optional[date] = None
+    prescription_date_end: Optional[date] = None
+    prescription_status: Optional[int] = None
+    updated_at: Optional[datetime] = None
+
+class SyncPrescriptionDetailRead(PrescriptionDetailRead):
+    updated_at: Optional[datetime] = None
+
+# A deleted row -- key is the primary key, prescription_detail: "prescription_id:medication_id"
+# a deleted prescription takes its details with it
+class SyncDeletedRow(BaseORMModel):
+    table: str
+    key: str
+    deleted_at: datetime
+
+class SyncResponse(BaseORMModel):
+    cursor: str            # pass back as since on the next sync
+    full: bool             # True = everything the user has (no / expired cursor), replace the local copy
+    prescriptions: List[SyncPrescriptionRead] = []
+    prescription_details: List[SyncPrescriptionDetailRead] = []
+    notifications: List[NotificationRead] = []
+    side_effects: List[SideEffectRead] = []
+    deleted: List[SyncDeletedRow] = []
 
@@ -0,0 +1,183 @@
+# this is the file for medication search (GET /medications/search?q=)
+# an in-memory index built from the medication catalog snapshot (catalog.py), so a search never goes to the database:
+#   - every medication_name, sorted            -> names starting with the query (bisect)
+#   - every word of medication_name, sorted    -> names with a word starting with a query word (bisect)
+#   - every word of medication_use, sorted     -> same for the use text (ranks below name matches)
+#   - trigrams of medication_name -> postings  -> typo tolerant matches ("amoxicilin" still finds amoxicillin)
+# A query adds up the weights of everything it hits into one NumPy score array (one slot per medication),
+# the top-k of that is the result. Name prefixes are always scored; the trigrams and then the use text are only
+# looked at while fewer than k names match every query word, so a typical autocomplete query touches just a few
+# small slices. The index is rebuilt (in a thread, so requests keep being served) whenever the catalog snapshot
+# changes -- its etag is the version of the index.
+# Results are pre-serialized MedicationRead bytes taken from the snapshot, and recent queries are cached.
+import asyncio
+import bisect
+import logging
+import re
+import time
+from collections import defaultdict
+from typing import Dict, List, Optional, Tuple
+import numpy as np
+from sqlalchemy.ext.asyncio import AsyncSession
+from .cache import LRUCache
+from .catalog import CatalogSnapshot, medication_catalog
+
+logger = logging.getLogger(__name__)
+
+SEARCH_DEFAULT_LIMIT = 10         # Results returned when the client does not ask for a number
+SEARCH_MAX_LIMIT = 50             # Most results one search can return
+SEARCH_CACHE_SIZE = 5000          # Recent (query, limit) results kept per worker
+
+NAME_PREFIX_WEIGHT = 4.0          # The whole name starts with the query
+NAME_WORD_PREFIX_WEIGHT = 2.0     # A word of the name starts with a query word (per query word)
+TRIGRAM_WEIGHT = 1.5              # Times the share of the query's trigrams found in the name
+USE_WORD_PREFIX_WEIGHT = 0.5      # A word of medication_use starts with a query word (per query word)
+MIN_TRIGRAM_SIMILARITY = 0.4      # Trigram matches below this share of the query's trigrams are ignored
+
+_WORD = re.compile(r"\w+")
+_PREFIX_END = chr(0x10FFFF)       # sorts after every other character -- prefix ranges are [prefix, prefix + _PREFIX_END)
+
+
+def _words(text: Optional[str]) -> List[str]:
+    return _WORD.findall(text.casefold()) if text else []
+
+
+# Trigrams of words padded with spaces ("  ab", " abc", "abc ", ...) -- the last query word may still be being typed,
+# so it gets no end padding and a half typed word only has to match the start of a name word
+def _trigrams(words: List[str], last_is_prefix: bool = False) -> set:
+    grams = set()
+    for position, word in enumerate(words):
+        padded = "  " + word if last_is_prefix and position == len(words) - 1 else "  " + word + " "
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return grams
+
+
+def _prefix_range(sorted_values: List[str], prefix: str) -> Tuple[int, int]:
+    return bisect.bisect_left(sorted_values, prefix), bisect.bisect_left(sorted_values, prefix + _PREFIX_END)
+
+
+# Sorted (word, medication position) pairs -> (sorted words, positions as an array)
+def _word_list(words_per_medication: List[List[str]]) -> Tuple[List[str], np.ndarray]:
+    pairs = sorted((word, position) for position, words in enumerate(words_per_medication) for word in set(words))
+    return [word for word, _ in pairs], np.fromiter((position for _, position in pairs), dtype=np.int32, count=len(pairs))
+
+
+class SearchIndex:
+    def __init__(self, snapshot: CatalogSnapshot):
+        started = time.perf_counter()
+        self.etag = snapshot.etag
+        self.item_bodies = snapshot.item_bodies  # MedicationRead JSON, same order as the positions below
+        self.size = len(snapshot.medications)
+
+        name_words = [_words(m.medication_name) for m in snapshot.medications]
+        full_names = [" ".join(words) for words in name_words]
+        order = sorted(range(self.size), key=full_names.__getitem__)
+        self._full_names = [full_names[i] for i in order]
+        self._full_name_positions = np.array(order, dtype=np.int32)
+        self._name_lengths = np.array([len(name) for name in full_names], dtype=np.int32)  # shorter names rank first on a tie
+
+        self._name_words, self._name_word_positions = _word_list(name_words)
+        self._use_words, self._use_word_positions = _word_list([_words(m.medication_use) for m in snapshot.medications])
+
+        postings: Dict[str, list] = defaultdict(list)
+        for position, words in enumerate(name_words):
+            for gram in _trigrams(words):
+                postings[gram].append(position)
+        self._name_trigrams = {gram: np.array(positions, dtype=np.int32) for gram, positions in postings.items()}
+        self.build_seconds = time.perf_counter() - started
+
+    # Positions of the best matches for the query, best first
+    def search(self, query: str, limit: int = SEARCH_DEFAULT_LIMIT) -> List[int]:
+        words = _words(query)
+        if not words or not self.size:
+            return []
+        score = np.zeros(self.size, dtype=np.float32)
+        words_matched = np.zeros(self.size, dtype=np.int16)  # query words a name word starts with
+
+        lo, hi = _prefix_range(self._full_names, " ".join(words))
+        score[self._full_name_positions[lo:hi]] += NAME_PREFIX_WEIGHT
+        for word in words:
+            # a medication with two words starting with the query word still gets it once (fancy += does not add twice)
+            lo, hi = _prefix_range(self._name_words, word)
+            positions = self._name_word_positions[lo:hi]
+            score[positions] += NAME_WORD_PREFIX_WEIGHT
+            words_matched[positions] += 1
+
+        if np.count_nonzero(words_matched == len(words)) < limit:
+            # Not enough names start with the query -- look for names that are close to it (typos)
+            grams = _trigrams(words, last_is_prefix=True)
+            postings = [self._name_trigrams[gram] for gram in grams if gram in self._name_trigrams]
+            if postings:
+                grams_found = np.bincount(np.concatenate(postings), minlength=self.size)
+                close = np.flatnonzero(grams_found >= MIN_TRIGRAM_SIMILARITY * len(grams))
+                score[close] += TRIGRAM_WEIGHT * grams_found[close] / len(grams)
+
+        if np.count_nonzero(score) < limit:
+            # Still not enough -- fill up with medications whose use text matches
+            for word in words:
+                lo, hi = _prefix_range(self._use_words, word)
+                score[self._use_word_positions[lo:hi]] += USE_WORD_PREFIX_WEIGHT
+
+        candidates = np.flatnonzero(score)
+        if candidates.size > limit:
+            candidates = candidates[np.argpartition(-score[candidates], limit - 1)[:limit]]
+        # best score first, then the shorter name, then catalog (medication_id) order
+        ranked = candidates[np.lexsort((candidates, self._name_lengths[candidates], -score[candidates]))]
+        return ranked.tolist()
+
+    # JSON list of MedicationRead for the best matches
+    def search_json(self, query: str, limit: int = SEARCH_DEFAULT_LIMIT) -> bytes:
+        return b"[" + b",".join(self.item_bodies[position] for position in self.search(query, limit)) + b"]"
+
+
+class MedicationSearch:
+    def __init__(self, catalog=medication_catalog):
+        self.catalog = catalog
+        self._index: Optional[SearchIndex] = None
+        self._lock = asyncio.Lock()
+        self.results = LRUCache(maxsize=SEARCH_CACHE_SIZE)  # (etag, normalized query, limit) -> JSON bytes
+        # Metrics
+        self.builds = 0
+        self.searches = 0
+        self.search_seconds = 0.0
+
+    # Index for the current catalog snapshot, rebuilt (off the event loop) when the catalog changed
+    async def get_index(self, db: AsyncSession) -> SearchIndex:
+        snapshot = await self.catalog.get(db)
+        index = self._index
+        if index is not None and index.etag == snapshot.etag:
+            return index
+        async with self._lock:
+            # Another request may have rebuilt it while we were waiting on the lock
+            if self._index is None or self._index.etag != snapshot.etag:
+                self._index = await asyncio.to_thread(SearchIndex, snapshot)
+                self.builds += 1
+                logger.info("Medication search index built: %s medications in %.3fs", self._index.size, self._index.build_seconds)
+        return self._index
+
+    async def search_json(self, db: AsyncSession, query: str, limit: int = SEARCH_DEFAULT_LIMIT) -> bytes:
+        index = await self.get_index(db)
+        key = (index.etag, " ".join(_words(query)), limit)
+        body = self.results.get(key)
+        if body is None:
+            started = time.perf_counter()
+            body = index.search_json(query, limit)
+            self.search_seconds += time.perf_counter() - started
+            self.searches += 1
+            self.results.set(key, body)
+        return body
+
+    def metrics(self) -> dict:
+        index = self._index
+        return {
+            "medications": index.size if index else 0,
+            "builds": self.builds,
+            "last_build_seconds": round(index.build_seconds, 3) if index else 0.0,
+            "searches": self.searches,
+            "avg_search_ms": round(1000 * self.search_seconds / self.searches, 3) if self.searches else 0.0,
+            "results_cache": self.results.stats(),
+        }
+
+
+# Shared search used by the API
+medication_search = MedicationSearch()
@@ -0,0 +1,144 @@
+# this is the file for the database / connection pool settings
+# everything that used to be hard-coded on create_async_engine in database.py is read from here, in this order
+# (later ones win):
+#   1. the profile picked with APP_ENV -- dev / bench / prod (prod when APP_ENV is not set)
+#   2. a JSON file named by SETTINGS_FILE, eg. {"pool_size": 5, "max_overflow": 5, "echo": false}
+#   3. environment variables, eg. DB_POOL_SIZE=5 (names in ENV_VARS below)
+# Sizing the pool per worker: every uvicorn worker has its own pool, so the connections the app can open are
+# workers * (pool_size + max_overflow) per engine. Set DB_MAX_CONNECTIONS to the connections this app may use
+# on the server and WEB_CONCURRENCY to the number of workers, and each worker's pool is cut down to fit.
+import json
+import os
+from dataclasses import dataclass, replace
+from typing import Optional
+
+
+@dataclass(frozen=True)
+class DatabaseSettings:
+    profile: str = "prod"
+    url: Optional[str] = None              # full SQLAlchemy URL -- built from host / port / name + secret_secrets.py when not set
+    read_url: Optional[str] = None         # read replica (see database.py), None = reads use the primary
+    host: str = "app-db.clsm00w6ehfa.us-east-1.rds.amazonaws.com"
+    port: int = 3306
+    name: str = "app_db"
+    pool_size: int = 10                    # Connections each worker keeps open
+    max_overflow: int = 20                 # Extra connections a worker may open when the pool is busy
+    pool_timeout: float = 30.0             # Seconds a request waits for a free connection before failing
+    pool_recycle: int = -1                 # Replace connections older than this many seconds (-1 = never)
+    pool_pre_ping: bool = False            # Check a connection is alive before handing it out
+    echo: bool = False                     # Log every SQL statement
+    statement_timeout_ms: Optional[int] = None  # Server side limit per statement (MySQL: SELECTs only), None = no limit
+    max_connections: Optional[int] = None  # Connections this app may use on the server, over all workers (per engine)
+    workers: int = 1                       # uvicorn workers sharing max_connections
+    track_queries: bool = False            # Count statements per request and warn about N+1 queries (query_tracker.py)
+    slow_query_ms: Optional[int] = None    # Statements slower than this go to the slow query log (slow_query_log.py), None = off
+    slow_query_log_file: str = "slow_queries.jsonl"  # each worker writes <name>.<pid>.jsonl
+    slow_query_explain_rate: float = 0.1   # Share of the slow SELECTs that also get an EXPLAIN plan
+    # Delivers due notifications, "module:function" (see notification_dispatcher.py) -- None = the dispatcher
+    # does not run, so nothing is ever marked sent that was not delivered
+    notification_sender: Optional[str] = None
+
+    # Pool size / overflow for one worker -- cut down to this worker's share of max_connections when it is set
+    def pool_limits(self) -> tuple:
+        if not self.max_connections:
+            return self.pool_size, self.max_overflow
+        per_worker = max(1, self.max_connections // max(1, self.workers))
+        pool_size = min(self.pool_size, per_worker)
+        return pool_size, min(self.max_overflow, per_worker - pool_size)
+
+
+PROFILES = {
+    # local development: notice a dead connection right away, small pool, statement counts and every slowish query explained
+    "dev": DatabaseSettings(profile="dev", pool_size=5, max_overflow=10, pool_pre_ping=True, track_queries=True,
+                            slow_query_ms=100, slow_query_explain_rate=1.0),
+    # bench_endpoints.py: nothing that adds time per request
+    "bench": DatabaseSettings(profile="bench"),
+    # RDS: MySQL drops idle connections after wait_timeout, so recycle well before that and ping before use
+    "prod": DatabaseSettings(profile="prod", pool_recycle=1800, pool_pre_ping=True, statement_timeout_ms=30000, slow_query_ms=500),
+}
+
+# setting name -> environment variable
+ENV_VARS = {
+    "url": "DATABASE_URL",
+    "read_url": "DATABASE_READ_URL",
+    "host": "DB_HOST",
+    "port": "DB_PORT",
+    "name": "DB_NAME",
+    "pool_size": "DB_POOL_SIZE",
+    "max_overflow": "DB_MAX_OVERFLOW",
+    "pool_timeout": "DB_POOL_TIMEOUT",
+    "pool_recycle": "DB_POOL_RECYCLE",
+    "pool_pre_ping": "DB_POOL_PRE_PING",
+    "echo": "DB_ECHO",
+    "statement_timeout_ms": "DB_STATEMENT_TIMEOUT_MS",
+    "max_connections": "DB_MAX_CONNECTIONS",
+    "workers": "WEB_CONCURRENCY",
+    "track_queries": "DB_TRACK_QUERIES",
+    "slow_query_ms": "DB_SLOW_QUERY_MS",
+    "slow_query_log_file": "DB_SLOW_QUERY_LOG",
+    "slow_query_explain_rate": "DB_SLOW_QUERY_EXPLAIN_RATE",
+    "notification_sender": "NOTIFICATION_SENDER",
+}
+
+_FIELD_TYPES = {
+    "url": str, "read_url": str, "host": str, "port": int, "name": str, "pool_size": int, "max_overflow": int,
+    "pool_timeout": float, "pool_recycle": int, "pool_pre_ping": bool, "echo": bool, "statement_timeout_ms": int,
+    "max_connections": int, "workers": int, "track_queries": bool, "slow_query_ms": int, "slow_query_log_file": str,
+    "slow_query_explain_rate": float, "notification_sender": str,
+}
+
+
+# "true" / "1" / "yes" -> True, "false" / "0" / "no" -> False
+def _parse_bool(value) -> bool:
+    if isinstance(value, bool):
+        return value
+    text = str(value).strip().lower()
+    if text in ("1", "true", "yes", "on"):
+        return True
+    if text in ("0", "false", "no", "off"):
+        return False
+    raise ValueError(f"not a true / false value: {value!r}")
+
+
+_OPTIONAL = {"url", "read_url", "statement_timeout_ms", "max_connections", "slow_query_ms", "notification_sender"}  # may be set to null / "" (= not set)
+
+
+def _convert(name: str, value):
+    if value is None or value == "":
+        if name not in _OPTIONAL:
+            raise ValueError(f"Bad database setting {name}: a value is required")
+        return None
+    kind = _FIELD_TYPES[name]
+    try:
+        return _parse_bool(value) if kind is bool else kind(value)
+    except (TypeError, ValueError) as e:
+        raise ValueError(f"Bad database setting {name}={value!r}: {e}") from None
+
+
+def load_settings(environ=None) -> DatabaseSettings:
+    environ = os.environ if environ is None else environ
+    profile = environ.get("APP_ENV", "prod").strip().lower()
+    if profile not in PROFILES:
+        raise ValueError(f"Unknown APP_ENV {profile!r}, expected one of {', '.join(PROFILES)}")
+    settings = PROFILES[profile]
+
+    overrides = {}
+    settings_file = environ.get("SETTINGS_FILE")
+    if settings_file:
+        with open(settings_file, encoding="utf-8") as file:
+            for name, value in json.load(file).items():
+                if name not in _FIELD_TYPES:
+                    raise ValueError(f"Unknown database setting {name!r} in {settings_file}")
+                overrides[name] = _convert(name, value)
+    for name, variable in ENV_VARS.items():
+        if environ.get(variable) is not None:
+            overrides[name] = _convert(name, environ[variable])
+
+    settings = replace(settings, **overrides)
+    if settings.pool_size < 1 or settings.max_overflow < 0 or settings.workers < 1:
+        raise ValueError(f"Bad pool settings: pool_size={settings.pool_size} max_overflow={settings.max_overflow} workers={settings.workers}")
+    return settings
+
+
+# Settings for this process
+settings = load_settings()
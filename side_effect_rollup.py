@@ -0,0 +1,168 @@
+# this is the file for the side effect rollup (table side_effect_rollup)
+# side effects are counted per medication, day (created_at) and normalized description, so stats like
+# "how often is X reported for medication Y" read a handful of buckets instead of every side effect row.
+# Every write to side_effect adds its +1 / -1 to the buckets in the same transaction (see main.py):
+#   insert -> +1 for the new row       delete -> -1 for the old row
+#   update -> -1 old description, +1 new description (only when the normalized description changed)
+# The counts are applied with one upsert (INSERT ... ON DUPLICATE KEY UPDATE count = count + delta on MySQL,
+# ON CONFLICT DO UPDATE on SQLite / Postgres), so concurrent writers never lose an increment.
+# Buckets that drop to 0 are left in place (reads skip them, a rebuild clears them out).
+# rebuild_side_effect_rollup() recounts everything from side_effect -- run it once after creating the
+# table: python -m <package>.side_effect_rollup
+import asyncio
+import logging
+from collections import Counter
+from datetime import date, datetime
+from typing import Iterable, List, Optional, Tuple
+from sqlalchemy import delete, func
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.future import select
+from .models import SideEffect, SideEffectRollup
+from .pagination import keyset_after
+
+logger = logging.getLogger(__name__)
+
+REBUILD_CHUNK_SIZE = 50000      # side effect rows read at a time by rebuild_side_effect_rollup()
+DESC_NORM_MAX_LENGTH = 255      # size of the side_effect_desc_norm column
+
+RollupKey = Tuple[int, date, str]  # (medication_id, rollup_day, side_effect_desc_norm)
+
+
+# "  Mild HEADACHE. " -> "mild headache" -- reports that only differ in case / spacing / end punctuation count together
+def normalize_desc(desc: Optional[str]) -> str:
+    if not desc:
+        return ""
+    return " ".join(desc.lower().split()).strip(" .,;:!?")[:DESC_NORM_MAX_LENGTH]
+
+
+def rollup_key(medication_id: int, created_at: datetime, desc: Optional[str]) -> RollupKey:
+    return medication_id, created_at.date(), normalize_desc(desc)
+
+
+# Count changes for side effect rows given as (medication_id, created_at, side_effect_desc) -- sign +1 added, -1 removed
+def rollup_deltas(rows: Iterable[tuple], sign: int = 1) -> Counter:
+    deltas = Counter()
+    for medication_id, created_at, desc in rows:
+        deltas[rollup_key(medication_id, created_at, desc)] += sign
+    return deltas
+
+
+def _upsert_statement(dialect_name: str):
+    count = SideEffectRollup.side_effect_count
+    if dialect_name in ("mysql", "mariadb"):
+        from sqlalchemy.dialects.mysql import insert as mysql_insert
+        statement = mysql_insert(SideEffectRollup)
+        return statement.on_duplicate_key_update(side_effect_count=count + statement.inserted.side_effect_count)
+    if dialect_name == "sqlite":
+        from sqlalchemy.dialects.sqlite import insert as dialect_insert
+    elif dialect_name == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert as dialect_insert
+    else:
+        raise ValueError(f"No side effect rollup upsert for the {dialect_name} dialect (supported: mysql, mariadb, sqlite, postgresql)")
+    statement = dialect_insert(SideEffectRollup)
+    return statement.on_conflict_do_update(
+        index_elements=[SideEffectRollup.medication_id, SideEffectRollup.rollup_day, SideEffectRollup.side_effect_desc_norm],
+        set_={"side_effect_count": count + statement.excluded.side_effect_count},
+    )
+
+
+# Add the count changes to the rollup with one upsert (executemany) -- does not commit, the caller owns the transaction
+async def apply_rollup(db: AsyncSession, deltas: Counter) -> None:
+    params = [
+        {"medication_id": medication_id, "rollup_day": day, "side_effect_desc_norm": desc, "side_effect_count": delta}
+        for (medication_id, day, desc), delta in sorted(deltas.items())  # same bucket order in every transaction -- no deadlocks
+        if delta
+    ]
+    if params:
+        await db.execute(_upsert_statement(db.get_bind().dialect.name), params)
+
+
+# -1 for every side effect of a user (before the user and their side effects are deleted)
+async def user_rollup_deltas(db: AsyncSession, user_id: str) -> Counter:
+    result = await db.execute(
+        select(SideEffect.medication_id, SideEffect.created_at, SideEffect.side_effect_desc)
+        .where(SideEffect.user_id == user_id)
+    )
+    return rollup_deltas(result.all(), sign=-1)
+
+
+def _window(query, date_from: Optional[date], date_to: Optional[date]):
+    if date_from is not None:
+        query = query.where(SideEffectRollup.rollup_day >= date_from)
+    if date_to is not None:
+        query = query.where(SideEffectRollup.rollup_day <= date_to)
+    return query
+
+
+# [(medication_id, count)] most reported medications first
+async def medication_totals(db: AsyncSession, date_from: Optional[date] = None, date_to: Optional[date] = None,
+                            limit: int = 100) -> List[tuple]:
+    total = func.sum(SideEffectRollup.side_effect_count).label("side_effect_count")
+    query = _window(select(SideEffectRollup.medication_id, total), date_from, date_to)
+    result = await db.execute(
+        query.group_by(SideEffectRollup.medication_id)
+        .having(total > 0)
+        .order_by(total.desc(), SideEffectRollup.medication_id)
+        .limit(limit)
+    )
+    return [tuple(row) for row in result.all()]
+
+
+# ([(day, count)] by day, [(description, count)] most reported descriptions first) for one medication
+async def medication_breakdown(db: AsyncSession, medication_id: int, date_from: Optional[date] = None,
+                               date_to: Optional[date] = None, top: int = 20) -> Tuple[List[tuple], List[tuple]]:
+    total = func.sum(SideEffectRollup.side_effect_count).label("side_effect_count")
+    buckets = _window(select(SideEffectRollup.rollup_day, total), date_from, date_to).where(SideEffectRollup.medication_id == medication_id)
+    by_day = await db.execute(
+        buckets.group_by(SideEffectRollup.rollup_day).having(total > 0).order_by(SideEffectRollup.rollup_day)
+    )
+    descriptions = _window(select(SideEffectRollup.side_effect_desc_norm, total), date_from, date_to).where(SideEffectRollup.medication_id == medication_id)
+    by_desc = await db.execute(
+        descriptions.group_by(SideEffectRollup.side_effect_desc_norm)
+        .having(total > 0)
+        .order_by(total.desc(), SideEffectRollup.side_effect_desc_norm)
+        .limit(top)
+    )
+    return [tuple(row) for row in by_day.all()], [tuple(row) for row in by_desc.all()]
+
+
+# Recount the whole rollup from side_effect (after creating the table, or if it ever drifts)
+# side effects written while this runs may be counted twice or not at all -- run it when the app is quiet
+async def rebuild_side_effect_rollup(session_factory=None, chunk_size: int = REBUILD_CHUNK_SIZE) -> int:
+    from .database import AsyncSessionLocal
+    session_factory = session_factory or AsyncSessionLocal
+    query = select(SideEffect.side_effects_id, SideEffect.medication_id, SideEffect.created_at, SideEffect.side_effect_desc)
+    sort_key = (SideEffect.side_effects_id,)
+
+    counts = Counter()
+    after = None
+    async with session_factory() as session:
+        while True:
+            chunk_query = query if after is None else query.where(keyset_after(sort_key, after))
+            rows = (await session.execute(chunk_query.order_by(*sort_key).limit(chunk_size))).all()
+            if not rows:
+                break
+            after = (rows[-1].side_effects_id,)
+            counts.update(rollup_deltas((row.medication_id, row.created_at, row.side_effect_desc) for row in rows))
+            if len(rows) < chunk_size:
+                break
+
+        # Swap the old counts for the new ones in one transaction
+        await session.execute(delete(SideEffectRollup))
+        await apply_rollup(session, counts)
+        await session.commit()
+    logger.info("Side effect rollup rebuilt: %s buckets from %s side effects", len(counts), sum(counts.values()))
+    return len(counts)
+
+
+async def main():
+    from .database import close_connections
+    try:
+        print(f"Rebuilt {await rebuild_side_effect_rollup()} side effect rollup buckets")
+    finally:
+        await close_connections()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(main())
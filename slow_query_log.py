@@ -0,0 +1,201 @@
+# this is the file for the slow query log
+# Every statement is timed with engine events (database.py attaches this to each engine). Statements that take
+# longer than settings.slow_query_ms are written as one JSON object per line to settings.slow_query_log_file
+# with the process id added to the name (slow_queries.<pid>.jsonl) -- every uvicorn worker writes and rotates
+# its own file, RotatingFileHandler can't share one between processes (rotated at SLOW_LOG_MAX_BYTES,
+# SLOW_LOG_BACKUPS old files kept):
+#   {"at": ..., "engine": "primary", "route": "GET /prescriptions/", "ms": 812.4, "statement": "SELECT ...",
+#    "parameters": ["str", "int"], "executemany": false, "plan": [...]}
+# Only the shape of the parameters (their types) is written -- never the values, they are patients' data.
+# A share of the slow SELECTs (settings.slow_query_explain_rate) also get an EXPLAIN of the same statement.
+# That runs in a background task (started in the app lifespan, see tokens.py) on its own connection, after the
+# request has moved on, and a statement that was explained recently reuses its plan.
+# Without the background task (eg. the nightly scripts) slow statements are still written, just without a plan.
+import asyncio
+import json
+import logging
+import os
+import random
+import time
+from datetime import datetime, timezone
+from logging.handlers import RotatingFileHandler
+from typing import Any, Dict, Optional
+from sqlalchemy import event
+from .cache import LRUCache
+from .metrics import request_stats
+from .settings import settings
+
+logger = logging.getLogger(__name__)
+
+SLOW_LOG_MAX_BYTES = 10 * 1024 * 1024   # Rotate the slow query file at 10 MB
+SLOW_LOG_BACKUPS = 5                    # Rotated files kept per worker (slow_queries.<pid>.jsonl.1 ... .5)
+SLOW_LOG_QUEUE_SIZE = 1000              # Slow statements waiting for the background task, more are dropped
+STATEMENT_MAX_LENGTH = 4000             # SQL written to the file is cut to this length
+PLAN_CACHE_SIZE = 1000                  # Statements whose plan is kept for reuse
+PLAN_CACHE_TTL_SECONDS = 600            # A statement is explained again after this long
+
+_EXPLAIN_PREFIX = {"sqlite": "EXPLAIN QUERY PLAN ", "mysql": "EXPLAIN ", "mariadb": "EXPLAIN ", "postgresql": "EXPLAIN "}
+
+
+# Types of the bound parameters, eg. {"user_id": "str"} or ["str", "int"] -- executemany uses the first row
+def parameter_shape(parameters) -> Any:
+    if isinstance(parameters, dict):
+        return {str(name): type(value).__name__ for name, value in parameters.items()}
+    if isinstance(parameters, (list, tuple)):
+        return [type(value).__name__ for value in parameters]
+    return type(parameters).__name__
+
+
+# slow_queries.jsonl -> slow_queries.<pid>.jsonl
+def worker_log_path(path: str, pid: Optional[int] = None) -> str:
+    root, extension = os.path.splitext(path)
+    return f"{root}.{pid if pid is not None else os.getpid()}{extension}"
+
+
+def _explainable(statement: str) -> bool:
+    start = statement.lstrip()[:6].upper()
+    return start == "SELECT" or start.startswith("WITH")
+
+
+class SlowQueryLog:
+    def __init__(self, threshold_ms: Optional[int] = settings.slow_query_ms, path: str = settings.slow_query_log_file,
+                 explain_rate: float = settings.slow_query_explain_rate):
+        self.threshold_ms = threshold_ms
+        self.path = path
+        self.explain_rate = explain_rate
+        self.engines: Dict[str, Any] = {}  # name -> AsyncEngine the EXPLAIN runs on
+        self.plans = LRUCache(maxsize=PLAN_CACHE_SIZE, ttl=PLAN_CACHE_TTL_SECONDS)  # (engine, statement) -> plan
+        self._writer: Optional[logging.Logger] = None
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        # Metrics
+        self.logged = 0
+        self.dropped = 0
+        self.explained = 0
+        self.explain_failed = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.threshold_ms is not None
+
+    # Time the statements of an engine (called from database.py for every engine)
+    def instrument_engine(self, engine, name: str):
+        if not self.enabled:
+            return
+        self.engines[name] = engine
+        threshold = self.threshold_ms / 1000
+
+        @event.listens_for(engine.sync_engine, "before_cursor_execute")
+        def start_timer(conn, cursor, statement, parameters, context, executemany):
+            if context is not None:
+                context._slow_query_started = time.perf_counter()
+
+        @event.listens_for(engine.sync_engine, "after_cursor_execute")
+        def check_time(conn, cursor, statement, parameters, context, executemany):
+            started = getattr(context, "_slow_query_started", None)
+            if started is None:
+                return
+            seconds = time.perf_counter() - started
+            if seconds >= threshold and not statement.lstrip().upper().startswith("EXPLAIN"):
+                self._record(name, statement, parameters, executemany, seconds)
+
+    def _record(self, engine_name: str, statement: str, parameters, executemany: bool, seconds: float):
+        stats = request_stats.get()
+        route = stats.scope.get("route") if stats is not None else None
+        record = {
+            "at": datetime.now(timezone.utc).isoformat(),
+            "engine": engine_name,
+            "route": f"{stats.scope['method']} {route.path if route is not None else stats.scope['path']}" if stats is not None else None,
+            "ms": round(seconds * 1000, 1),
+            "statement": statement[:STATEMENT_MAX_LENGTH],
+            "parameters": parameter_shape(parameters[0] if executemany and parameters else parameters),
+            "executemany": executemany,
+            "plan": None,
+        }
+        explain = (not executemany and _explainable(statement) and random.random() < self.explain_rate)
+        if self._queue is None:
+            self._write(record)  # no background task -- write it now without a plan
+            return
+        try:
+            self._queue.put_nowait((record, (statement, parameters) if explain else None))
+        except asyncio.QueueFull:
+            self.dropped += 1
+
+    def _write(self, record: dict):
+        if self._writer is None:
+            writer = logging.getLogger(f"{__name__}.file")
+            writer.propagate = False
+            writer.setLevel(logging.INFO)
+            # opened on the first write, in the worker process (after uvicorn forked it)
+            handler = RotatingFileHandler(worker_log_path(self.path), maxBytes=SLOW_LOG_MAX_BYTES, backupCount=SLOW_LOG_BACKUPS, encoding="utf-8")
+            handler.setFormatter(logging.Formatter("%(message)s"))
+            writer.addHandler(handler)
+            self._writer = writer
+        self._writer.info(json.dumps(record, default=str))
+        self.logged += 1
+
+    async def _explain(self, engine_name: str, statement: str, parameters) -> Optional[list]:
+        key = (engine_name, statement)
+        plan = self.plans.get(key)
+        if plan is not None:
+            return plan
+        engine = self.engines[engine_name]
+        prefix = _EXPLAIN_PREFIX.get(engine.dialect.name)
+        if prefix is None:
+            return None
+        try:
+            async with engine.connect() as connection:
+                result = await connection.exec_driver_sql(prefix + statement, parameters if parameters else ())
+                plan = [{column: str(value) for column, value in row._mapping.items()} for row in result.all()]
+        except Exception as e:
+            self.explain_failed += 1
+            logger.warning("EXPLAIN failed for a slow query: %s", e)
+            return None
+        self.explained += 1
+        self.plans.set(key, plan)
+        return plan
+
+    async def _run(self):
+        while True:
+            record, explain = await self._queue.get()
+            try:
+                if explain is not None:
+                    statement, parameters = explain
+                    record["plan"] = await self._explain(record["engine"], statement, parameters)
+                await asyncio.to_thread(self._write, record)
+            except Exception:
+                logger.exception("Could not write a slow query record")
+            finally:
+                self._queue.task_done()
+
+    # Called on app startup
+    def start(self):
+        if self.enabled and self._task is None:
+            self._queue = asyncio.Queue(maxsize=SLOW_LOG_QUEUE_SIZE)
+            self._task = asyncio.create_task(self._run(), name="slow-query-log")
+
+    # Called on app shutdown -- writes what is still queued
+    async def stop(self):
+        if self._task is not None:
+            await self._queue.join()
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+            self._queue = None
+
+    def metrics(self) -> dict:
+        return {
+            "threshold_ms": self.threshold_ms or 0,
+            "logged": self.logged,
+            "dropped": self.dropped,
+            "explained": self.explained,
+            "explain_failed": self.explain_failed,
+            "queued": self._queue.qsize() if self._queue is not None else 0,
+        }
+
+
+# Shared slow query log used by the engines in database.py
+slow_query_log = SlowQueryLog()
@@ -0,0 +1,204 @@
+# this is the file for the delta sync of the mobile app (GET /sync)
+# Instead of downloading the whole account again the app keeps the cursor of its last sync and asks for what changed
+# since then: the user's prescriptions, prescription details, notifications and side effects with a change_seq above
+# the cursor (each found through a (user_id, change_seq) index), plus a tombstone for every row deleted since
+# (sync_tombstone, written by the delete endpoints in the same transaction as the delete).
+# The client applies `deleted` first and then upserts the rows -- a row that comes back exists right now.
+# Every user has a change counter (sync_counter). A transaction that changes a user's rows first bumps the counter
+# with next_change_seq() and stamps the rows (or tombstones) it writes with the new value. The counter row stays
+# locked until that transaction commits, so the next writer of the same user gets a higher number only after it:
+# change_seq order is commit order, whatever the clocks of the app servers and the database say.
+# A sync reads the counter first and returns it as the cursor -- every change up to it is already committed, changes
+# committed while the sync runs are above it and come (again) next time (upserts don't mind).
+# The cursor is opaque to the client (encode_cursor in pagination.py). No cursor, one older than the tombstones kept
+# (SYNC_TOMBSTONE_DAYS) or one of an older SYNC_CURSOR_VERSION gets everything with full = true.
+# Prune old tombstones with: python -m <package>.sync (eg. nightly)
+import asyncio
+import logging
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, Iterable, Optional
+from fastapi import HTTPException
+from sqlalchemy import delete, insert
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.future import select
+from .database import AsyncSessionLocal
+from .models import Prescription, PrescriptionDetail, Medication, Notification, SideEffect, SyncCounter, SyncTombstone
+from .pagination import encode_cursor, decode_cursor, parse_datetime
+
+logger = logging.getLogger(__name__)
+
+SYNC_TOMBSTONE_DAYS = 90      # Tombstones kept -- an older cursor gets a full sync
+SYNC_CURSOR_VERSION = 2       # Bumped when the cursor contents change, older cursors get a full sync
+
+
+# cursor issue / tombstone prune times are naive UTC datetimes
+def _utcnow() -> datetime:
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def _counter_upsert(dialect_name: str):
+    change_seq = SyncCounter.change_seq
+    if dialect_name in ("mysql", "mariadb"):
+        from sqlalchemy.dialects.mysql import insert as mysql_insert
+        return mysql_insert(SyncCounter).on_duplicate_key_update(change_seq=change_seq + 1)
+    if dialect_name == "sqlite":
+        from sqlalchemy.dialects.sqlite import insert as dialect_insert
+    elif dialect_name == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert as dialect_insert
+    else:
+        raise ValueError(f"No sync counter upsert for the {dialect_name} dialect")
+    return dialect_insert(SyncCounter).on_conflict_do_update(
+        index_elements=[SyncCounter.user_id], set_={"change_seq": change_seq + 1}
+    )
+
+
+# Bump the change counter of each user and return the new values {user_id: change_seq} -- call in the transaction
+# that writes the rows, before the commit; the counter rows stay locked until then
+async def next_change_seqs(db: AsyncSession, user_ids: Iterable[str]) -> Dict[str, int]:
+    user_ids = sorted(set(user_ids))  # same lock order in every transaction -- no deadlocks
+    if not user_ids:
+        return {}
+    await db.execute(
+        _counter_upsert(db.get_bind().dialect.name), [{"user_id": user_id, "change_seq": 1} for user_id in user_ids]
+    )
+    result = await db.execute(
+        select(SyncCounter.user_id, SyncCounter.change_seq).where(SyncCounter.user_id.in_(user_ids))
+    )
+    return dict(result.all())
+
+
+async def next_change_seq(db: AsyncSession, user_id: str) -> int:
+    return (await next_change_seqs(db, [user_id]))[user_id]
+
+
+# Cursor -> the change_seq the client is current up to, None = the client needs a full sync
+def read_sync_cursor(cursor: Optional[str], now: datetime) -> Optional[int]:
+    if not cursor:
+        return None
+    try:
+        version, change_seq, issued_at = decode_cursor(cursor, int, int, parse_datetime)
+    except HTTPException:
+        decode_cursor(cursor, int, parse_datetime)  # a version 1 cursor (updated_at) -- still 400 Invalid cursor if not
+        return None
+    if version != SYNC_CURSOR_VERSION or issued_at < now - timedelta(days=SYNC_TOMBSTONE_DAYS):
+        return None
+    return change_seq
+
+
+# Record deleted rows of a user -- call in the transaction that deletes them, before the commit
+# keys are the primary keys (prescription_detail: (prescription_id, medication_id))
+async def record_deletes(db: AsyncSession, user_id: str, table_name: str, keys: Iterable[Any]):
+    rows = [
+        {
+            "user_id": user_id,
+            "table_name": table_name,
+            "row_key": ":".join(str(part) for part in key) if isinstance(key, tuple) else str(key),
+        }
+        for key in keys
+    ]
+    if rows:
+        change_seq = await next_change_seq(db, user_id)
+        await db.execute(insert(SyncTombstone), [{**row, "change_seq": change_seq} for row in rows])
+
+
+# Everything of the user changed after the cursor (None = everything), shaped like SyncResponse
+async def user_changes(db: AsyncSession, user_id: str, since: Optional[str]) -> Dict[str, Any]:
+    now = _utcnow()
+    changed_after = read_sync_cursor(since, now)
+    # the counter is read before the rows -- all changes up to it are committed
+    result = await db.execute(select(SyncCounter.change_seq).where(SyncCounter.user_id == user_id))
+    synced_to = result.scalar_one_or_none() or 0
+
+    prescriptions = select(
+        Prescription.prescription_id,
+        Prescription.user_id,
+        Prescription.prescription_date_start,
+        Prescription.prescription_date_end,
+        Prescription.prescription_status,
+        Prescription.updated_at,
+    ).where(Prescription.user_id == user_id)
+    details = (
+        select(
+            PrescriptionDetail.prescription_id,
+            PrescriptionDetail.medication_id,
+            Medication.medication_name,
+            PrescriptionDetail.presc_dose,
+            PrescriptionDetail.presc_qty,
+            PrescriptionDetail.presc_type,
+            PrescriptionDetail.presc_frequency,
+            PrescriptionDetail.updated_at,
+        )
+        .join(Prescription, Prescription.prescription_id == PrescriptionDetail.prescription_id)
+        .outerjoin(Medication, Medication.medication_id == PrescriptionDetail.medication_id)
+        .where(Prescription.user_id == user_id)
+    )
+    notifications = select(
+        Notification.notification_id,
+        Notification.user_id,
+        Notification.notification_type,
+        Notification.notification_message,
+        Notification.notification_date,
+        Notification.notification_status,
+        Notification.created_at,
+        Notification.updated_at,
+    ).where(Notification.user_id == user_id)
+    side_effects = select(
+        SideEffect.side_effects_id,
+        SideEffect.user_id,
+        SideEffect.medication_id,
+        SideEffect.side_effect_desc,
+        SideEffect.created_at,
+        SideEffect.updated_at,
+    ).where(SideEffect.user_id == user_id)
+
+    if changed_after is not None:
+        prescriptions = prescriptions.where(Prescription.change_seq > changed_after)
+        details = details.where(PrescriptionDetail.change_seq > changed_after)
+        notifications = notifications.where(Notification.change_seq > changed_after)
+        side_effects = side_effects.where(SideEffect.change_seq > changed_after)
+
+    changes = {
+        "cursor": encode_cursor([SYNC_CURSOR_VERSION, max(synced_to, changed_after or 0), now]),
+        "full": changed_after is None,
+        "prescriptions": await _rows(db, prescriptions.order_by(Prescription.prescription_id)),
+        "prescription_details": await _rows(db, details.order_by(PrescriptionDetail.prescription_id, PrescriptionDetail.medication_id)),
+        "notifications": await _rows(db, notifications.order_by(Notification.notification_id)),
+        "side_effects": await _rows(db, side_effects.order_by(SideEffect.side_effects_id)),
+        "deleted": [],
+    }
+    if changed_after is not None:
+        result = await db.execute(
+            select(SyncTombstone.table_name, SyncTombstone.row_key, SyncTombstone.deleted_at)
+            .where(SyncTombstone.user_id == user_id, SyncTombstone.change_seq > changed_after)
+            .order_by(SyncTombstone.change_seq, SyncTombstone.tombstone_id)
+        )
+        changes["deleted"] = [{"table": table, "key": key, "deleted_at": deleted_at} for table, key, deleted_at in result.all()]
+    return changes
+
+
+async def _rows(db: AsyncSession, query) -> list:
+    result = await db.execute(query)
+    return [dict(row._mapping) for row in result.all()]
+
+
+# Delete tombstones older than SYNC_TOMBSTONE_DAYS -- returns how many were deleted
+async def prune_tombstones(session_factory=AsyncSessionLocal) -> int:
+    async with session_factory() as session:
+        result = await session.execute(
+            delete(SyncTombstone).where(SyncTombstone.deleted_at < _utcnow() - timedelta(days=SYNC_TOMBSTONE_DAYS))
+        )
+        await session.commit()
+        return result.rowcount
+
+
+async def main():
+    from .database import close_connections
+    try:
+        print(f"Pruned {await prune_tombstones()} sync tombstones")
+    finally:
+        await close_connections()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(main())
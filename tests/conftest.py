@@ -0,0 +1,44 @@
+# this is the file for the test setup -- the API runs in-process (httpx ASGITransport) against a SQLite file
+# seeded the same way as bench_endpoints.py; run from the directory above the package: python -m pytest package/tests
+import os
+import random
+import shutil
+import tempfile
+import pytest
+
+# set before database.py / tokens.py are imported (by the fixtures below)
+_workdir = tempfile.mkdtemp(prefix="medication_app_tests_")
+os.environ["DATABASE_URL"] = f"sqlite+aiosqlite:///{os.path.join(_workdir, 'test.db')}"
+os.environ.pop("DATABASE_READ_URL", None)
+os.environ.setdefault("SECRET_KEY", "test-secret-key-not-for-production")
+os.environ.setdefault("APP_ENV", "bench")  # database settings profile (settings.py)
+
+SEED_ARGS = ["--medications", "10", "--users", "2", "--prescriptions", "5", "--details", "3",
+             "--notifications", "5", "--side-effects", "5", "--seed", "1"]
+
+
+@pytest.fixture(scope="session")
+def anyio_backend():
+    return "asyncio"
+
+
+# (client, BenchContext) -- one seeded database and one running app for the whole test session
+@pytest.fixture(scope="session")
+async def api(anyio_backend):
+    import httpx
+    from .. import database
+    from ..bench_endpoints import parse_args, seed
+    from ..main import app
+    from ..models import Base
+    from ..side_effect_rollup import rebuild_side_effect_rollup
+
+    async with database.engine.begin() as connection:
+        await connection.run_sync(Base.metadata.drop_all)
+        await connection.run_sync(Base.metadata.create_all)
+    ctx = await seed(database.AsyncSessionLocal, parse_args(SEED_ARGS), random.Random(1))
+    await rebuild_side_effect_rollup(database.AsyncSessionLocal)
+    async with app.router.lifespan_context(app):
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as client:
+            yield client, ctx
+    await database.close_connections()
+    shutil.rmtree(_workdir, ignore_errors=True)
@@ -0,0 +1,50 @@
+# Parsing of the free text dosing fields (dosing.py) -- the result is stored in presc_schedule and drives the calendar
+import time
+import pytest
+from ..dosing import MAX_DOSES_PER_DAY, decode_schedule, encode_schedule, parse_frequency, parse_schedule
+
+UNREADABLE = (None, None, ())
+
+
+@pytest.mark.parametrize("frequency, doses_per_day, interval_hours, times", [
+    ("twice a day", 2.0, 12.0, (480, 1200)),
+    ("every 8 hours", 3.0, 8.0, (0, 480, 960)),
+    ("8am and 8pm", 2.0, 12.0, (480, 1200)),
+    ("every other day", 0.5, 48.0, (480,)),
+    ("once weekly", 1 / 7, 168.0, (480,)),
+    ("every 1.5 hours", 16.0, 1.5, tuple(sorted((480 + i * 90) % 1440 for i in range(16)))),
+    ("every 0.5 days", 2.0, 12.0, (480, 1200)),
+])
+def test_parse_frequency(frequency, doses_per_day, interval_hours, times):
+    assert parse_frequency(frequency) == (pytest.approx(doses_per_day), pytest.approx(interval_hours), times)
+
+
+@pytest.mark.parametrize("frequency", [
+    "every 0 hours", "every 0.0 h", "every 0 days", "0 times a day",
+    "every 0.00001 hours", "every 0.001 hours",          # under a minute apart
+    "2000000 times a day", "99999999999 times a day",    # more than one a minute
+    "as needed", "",
+])
+def test_unreadable_frequency(frequency):
+    assert parse_frequency(frequency) == UNREADABLE
+
+
+def test_limits_are_readable():
+    doses_per_day, interval_hours, times = parse_frequency(f"{MAX_DOSES_PER_DAY} times a day")
+    assert doses_per_day == MAX_DOSES_PER_DAY and len(times) == MAX_DOSES_PER_DAY
+    doses_per_day, interval_hours, times = parse_frequency("every 0.02 hours")  # 1.2 minutes
+    assert doses_per_day == pytest.approx(1200) and len(times) == 1200
+
+
+def test_huge_count_is_rejected_quickly():
+    started = time.perf_counter()
+    parse_frequency("9999999999999 times a day")
+    parse_frequency("every 0.000000001 hours")
+    assert time.perf_counter() - started < 0.1
+
+
+def test_schedule_round_trip():
+    schedule = parse_schedule("every 8 hours", "0.5 g")
+    assert schedule.amount == 500.0 and schedule.unit == "mg"
+    assert decode_schedule(encode_schedule(schedule)) == schedule
+    assert encode_schedule(parse_schedule("every 0 hours")) is None
@@ -0,0 +1,64 @@
+# Statement budgets for the list / detail endpoints (query_tracker.py) -- each request is made with the caches
+# of the user dropped, so the budget is the cold path; a repeated statement (N+1) fails the test as well
+import pytest
+from ..query_tracker import QueryBudgetExceeded, query_budget
+from ..response_cache import response_cache
+from ..tokens import invalidate_principal
+
+pytestmark = pytest.mark.anyio
+
+
+async def _cold_request(client, user, method: str, url: str, budget: int, json=None):
+    await response_cache.invalidate(user.user_id)
+    invalidate_principal(user.user_id)
+    with query_budget(budget, label=f"{method} {url}"):
+        response = await client.request(method, url, headers=user.headers, json=json)
+    assert response.status_code == 200, response.text
+    return response
+
+
+@pytest.mark.parametrize("url, budget", [
+    ("/prescriptions/", 1),
+    ("/prescriptions/{prescription_id}", 1),
+    ("/prescriptions/{prescription_id}/details/", 3),
+    ("/notifications", 1),
+    ("/notifications/{notification_id}", 1),
+    ("/side_effects/", 1),
+    ("/side_effects/medication/{medication_id}/user/", 1),
+    ("/users/me", 1),
+])
+async def test_read_endpoints_stay_in_budget(api, url, budget):
+    client, ctx = api
+    user = ctx.user(0)
+    prescription_id = user.prescription_ids[0]
+    url = url.format(
+        prescription_id=prescription_id,
+        notification_id=user.notification_ids[0],
+        medication_id=user.medication_ids[prescription_id][0],
+    )
+    await _cold_request(client, user, "GET", url, budget)
+
+
+async def test_update_user_loads_the_user_once(api):
+    client, ctx = api
+    user = ctx.user(1)
+    response = await _cold_request(client, user, "PUT", "/users/me", 2, json={"user_height": 71})  # SELECT + UPDATE
+    assert response.json()["user_height"] == 71
+
+
+async def test_cached_response_runs_no_statements(api):
+    client, ctx = api
+    user = ctx.user(0)
+    await client.get("/prescriptions/", headers=user.headers)
+    with query_budget(0):
+        response = await client.get("/prescriptions/", headers=user.headers)
+    assert response.status_code == 200
+
+
+def test_repeated_statement_fails_the_budget():
+    from ..query_tracker import current_query_log
+    with pytest.raises(QueryBudgetExceeded, match="repeated"):
+        with query_budget(10):
+            log = current_query_log.get()
+            for _ in range(3):
+                log.add("SELECT user.user_id FROM user WHERE user.user_id = ?", ("u1",))
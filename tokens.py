@@ -1,7 +1,10 @@
 from datetime import datetime, timedelta, timezone
 from typing import Optional
 from typing import Annotated
-from .secret_secrets import SECRET_KEY as key 
+from contextlib import asynccontextmanager
+import hashlib
+import logging
+import os
 from .schemas import UserRead 
 from sqlalchemy.future import select
 from sqlalchemy.ext.asyncio import AsyncSession
@@ -13,23 +16,53 @@ from jwt.exceptions import InvalidTokenError
 from passlib.context import CryptContext
 from pydantic import BaseModel
 from .models import User  # Import your User model here
-from .database import get_db
-
-SECRET_KEY = key 
+from .database import get_db, read_sessionmaker, request_user_id, LazySession, SessionReleasingRoute
+from .hashing import pwd_context, password_hasher
+from .notification_dispatcher import notification_dispatcher, load_sender
+from .cache import LRUCache
+from .query_tracker import query_tracker
+from .slow_query_log import slow_query_log
+from .settings import settings
+
+logger = logging.getLogger(__name__)
+
+# SECRET_KEY in the environment is used when there is no secret_secrets.py (eg. the local benchmark)
+SECRET_KEY = os.environ.get("SECRET_KEY")
+if SECRET_KEY is None:
+    from .secret_secrets import SECRET_KEY as key 
+    SECRET_KEY = key 
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 60  # 60 minutes
 REFRESH_TOKEN_EXPIRE_DAYS = 60     # Expiration time for refresh tokens 60 days 
+TOKEN_CACHE_SIZE = 10000           # Max decoded tokens kept in memory per worker
+PRINCIPAL_CACHE_SIZE = 10000       # Max authenticated users kept in memory per worker
+PRINCIPAL_CACHE_TTL_SECONDS = 60   # How long a cached user is trusted before it is read from the database again
 
 
 # OAuth2PasswordBearer is a class that provides a standard way of getting the token from request headers
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
-# Initialize password hashing context (bcrypt)
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto") 
-
-app = FastAPI()
+# password hashing context (bcrypt) now lives in hashing.py with the worker pool
+
+# Startup / shutdown for the app
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    slow_query_log.start()  # EXPLAIN + write the slow statements off the request path
+    if settings.notification_sender:  # no sender configured -- notifications stay unsent instead of being marked sent
+        notification_dispatcher.sender = load_sender(settings.notification_sender)
+        notification_dispatcher.start()  # Fire notifications when their notification_date comes around
+    yield
+    await notification_dispatcher.stop()
+    password_hasher.shutdown()  # Stop the password hashing workers
+    await slow_query_log.stop()
+    if query_tracker.routes:
+        logger.info("%s", query_tracker.format_report())  # statements per route seen by this worker (dev profile)
+
+app = FastAPI(lifespan=lifespan)
+app.router.route_class = SessionReleasingRoute  # give the DB connection back before the response is serialized (database.py)
 
 
 # Helper function to hash passwords
+# NOTE: this blocks -- inside async handlers use hash_password_async instead
 def hash_password(password: str) -> str:
     return pwd_context.hash(password)
 
@@ -45,6 +78,13 @@ def verify_password(plain_password: str, hashed_password: str) -> bool:
     """
     return pwd_context.verify(plain_password, hashed_password)
 
+# Async versions of the helpers above -- bcrypt runs in the password hashing pool so the event loop stays free
+async def hash_password_async(password: str) -> str:
+    return await password_hasher.hash(password)
+
+async def verify_password_async(plain_password: str, hashed_password: str) -> bool:
+    return await password_hasher.verify(plain_password, hashed_password)
+
 
 def create_access_token(data: dict, expires_delta: timedelta | None = None):
     to_encode = data.copy()
@@ -66,9 +106,20 @@ def create_refresh_token(data: dict, expires_delta: timedelta | None = None):
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
+# Cache of decoded token payloads keyed by the sha256 digest of the token
+# entries expire at the token's own "exp" so an expired token is never served from here
+token_cache = LRUCache(maxsize=TOKEN_CACHE_SIZE)
+
 def verify_token(token: str) -> dict:
+    key = hashlib.sha256(token.encode()).digest()
+    payload = token_cache.get(key)
+    if payload is not None:
+        return dict(payload)  # copy so callers can't change the cached entry
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        # Only tokens with an expiry are cached (all tokens we create have one)
+        if isinstance(payload.get("exp"), (int, float)):
+            token_cache.set(key, dict(payload), expires_at=payload["exp"])
         return payload
     except InvalidTokenError:
         raise HTTPException(
@@ -103,8 +154,18 @@ async def get_current_user_and_refresh_token(token: str = Depends(oauth2_scheme)
     # Token is still valid, return the original token
     return {"access_token": token, "token_type": "bearer"}
 
-# Fetch the current user from the token
-async def get_current_user(token: str = Depends(oauth2_scheme), db: AsyncSession = Depends(get_db)) -> UserRead:
+# Cache of authenticated users (UserRead) keyed by user_id so protected calls don't hit the database every time
+# get_current_user hands out copies (model_copy, all the fields are immutable values) -- the cached one is never shared
+# update_user / delete_user call invalidate_principal, other workers pick up changes after the ttl
+principal_cache = LRUCache(maxsize=PRINCIPAL_CACHE_SIZE, ttl=PRINCIPAL_CACHE_TTL_SECONDS)
+
+# Remove a user from the principal cache (after the user is updated or deleted)
+def invalidate_principal(user_id: str):
+    principal_cache.pop(user_id)
+
+# Get only the user_id from the token -- no database call
+# use this for endpoints that only need the user_id claim (they only ever touch rows owned by that user_id)
+async def get_current_user_id(token: str = Depends(oauth2_scheme)) -> str:
     try:
         payload = verify_token(token)
     except HTTPException as e:
@@ -122,7 +183,25 @@ async def get_current_user(token: str = Depends(oauth2_scheme), db: AsyncSession
             detail="User not found",
             headers={"WWW-Authenticate": "Bearer"},
         )
-    
+    request_user_id.set(user_id)  # the user this request writes for (read-your-writes, see database.py)
+    return user_id
+
+# Session for read-only endpoints over the current user's own rows
+# the read replica, or the primary for a few seconds after the user's own write so they always see what they just saved
+# the engine is picked on first use, so a write another worker reported (response_cache.key) counts too
+async def get_user_read_db(user_id: str = Depends(get_current_user_id)):
+    session = LazySession(lambda: read_sessionmaker(user_id)())
+    try:
+        yield session
+    finally:
+        await session.close()
+
+# Fetch the current user from the token
+async def get_current_user(user_id: str = Depends(get_current_user_id), db: AsyncSession = Depends(get_db)) -> UserRead:
+    cached_user = principal_cache.get(user_id)
+    if cached_user is not None:
+        return cached_user.model_copy()  # every request gets its own copy -- a handler changing it can't touch the cache
+
     result = await db.execute(select(User).filter(User.user_id == user_id))
     user = result.scalars().first()
 
@@ -133,14 +212,16 @@ async def get_current_user(token: str = Depends(oauth2_scheme), db: AsyncSession
             headers={"WWW-Authenticate": "Bearer"},
         )
     
-    return UserRead.model_validate(user) # pydantic v2 use model_validate() UserRead is pydantic model 
+    user_data = UserRead.model_validate(user) # pydantic v2 use model_validate() UserRead is pydantic model 
+    principal_cache.set(user_id, user_data)
+    return user_data.model_copy()
 
 # Helper function to authenticate user credentials (username and password)
 async def authenticate_user(db: AsyncSession, user_id: str, user_pwd: str) -> UserRead:
     result = await db.execute(select(User).filter(User.user_id == user_id))
     user = result.scalars().first()
 
-    if user is None or not verify_password(user_pwd, user.user_pwd):
+    if user is None or not await verify_password_async(user_pwd, user.user_pwd):
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Invalid credentials",